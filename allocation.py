@@ -0,0 +1,109 @@
+"""
+Распределение мест по заявкам вместо «кто первый нажал».
+
+В дедлайн парковки открывается бронирование на следующую дату, и все пользователи нажимают кнопку в одну секунду.
+В режиме распределения (ALLOCATION.ENABLED) на эту дату заранее оставляют заявку,
+а в дедлайн одна задача раздаёт свободные места между заявками по политике ALLOCATION.POLICY:
+    random - случайный порядок;
+    usage  - случайный порядок, в котором у тех, кто реже брал место за USAGE_DAYS дней, шансы выше;
+    role   - по порядку ролей из ROLE_PRIORITY, внутри роли - случайный.
+Брони записываются одним INSERT в одной транзакции, не получившие места встают в очередь на дату
+в порядке распределения. До распределения дата закрыта для обычного бронирования и очереди (это проверяет bot.py),
+а места, которые остались после него, бронируются как обычно.
+"""
+import random
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+from peewee import fn
+
+from entities import db, AllocationRequest, ParkingSpot, Reservation, Role, User, WaitlistEntry
+
+POLICIES = ("random", "usage", "role")
+
+
+@dataclass(frozen=True)
+class AllocationResult:
+    booking_date: date
+    """ (пользователь, место) для тех, кому досталось место """
+    winners: list[tuple[User, ParkingSpot]]
+    """ Не получившие места в порядке распределения. Они поставлены в очередь на дату """
+    waitlisted: list[User]
+
+
+def get_usage_days(lot_id: int, user_ids: list[int], since: date, until: date) -> dict[int, int]:
+    """ Сколько дней с since по until включительно у каждого из пользователей была бронь на парковке """
+    return dict(Reservation.select(Reservation.user_id, fn.COUNT(Reservation.id)).where(
+        Reservation.lot_id == lot_id,
+        Reservation.booking_date.between(since, until),
+        Reservation.user_id.in_(user_ids)
+    ).group_by(Reservation.user_id).tuples())
+
+
+def order_candidates(candidates: list[User], policy: str, usage_days: dict[int, int],
+                     role_priority: list[str], rng: random.Random) -> list[User]:
+    """ Порядок, в котором заявки получают места """
+    if policy == "usage":
+        """ Случайная перестановка с весами 1 / (1 + дней с бронью): ключ random() ** (1 / вес), по убыванию """
+        return sorted(candidates, key=lambda user: rng.random() ** (1 + usage_days.get(user.id, 0)), reverse=True)
+
+    ordered = list(candidates)
+    rng.shuffle(ordered)
+    if policy == "role":
+        """ Сортировка устойчивая, поэтому внутри роли остаётся случайный порядок. Роли не из списка - последними """
+        priorities = {role_name: index for index, role_name in enumerate(role_priority)}
+        ordered.sort(key=lambda user: priorities.get(user.get_role_name(), len(priorities)))
+    return ordered
+
+
+def allocate(lot_id: int, booking_date: date, policy: str = "random", usage_days: int = 30,
+             role_priority: Optional[list[str]] = None,
+             rng: Optional[random.Random] = None) -> Optional[AllocationResult]:
+    """
+    Раздаёт свободные места парковки на дату по заявкам одной транзакцией.
+    Заявки на эту дату и на прошедшие даты после этого удаляются. Повторный вызов ничего не делает.
+    Возвращает None, если заявок на дату не было. Выполняется в пуле потоков БД
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Неизвестная политика распределения {policy!r}, возможные: {', '.join(POLICIES)}")
+    rng = rng or random.Random()
+
+    """ BEGIN IMMEDIATE: обычные брони ждут конца распределения, поэтому место не займут между чтением и записью """
+    with db.atomic('IMMEDIATE'):
+        requests = list(AllocationRequest.select(AllocationRequest, User, Role).join(User).join(Role).where(
+            AllocationRequest.lot_id == lot_id,
+            AllocationRequest.booking_date == booking_date
+        ).order_by(AllocationRequest.id))
+        AllocationRequest.delete().where(
+            AllocationRequest.lot_id == lot_id,
+            AllocationRequest.booking_date <= booking_date
+        ).execute()
+        if not requests:
+            return None
+
+        """ Брони, сделанные до включения распределения, остаются: у кого бронь уже есть, в распределении не участвует """
+        booked_user_ids = Reservation.get_booked_user_ids(lot_id, booking_date)
+        candidates = [request.user_id for request in requests if request.user_id.id not in booked_user_ids]
+        usage = {}
+        if policy == "usage" and candidates:
+            usage = get_usage_days(
+                lot_id, [user.id for user in candidates],
+                booking_date - timedelta(days=usage_days), booking_date - timedelta(days=1)
+            )
+        ordered = order_candidates(candidates, policy, usage, role_priority or [], rng)
+
+        winners = list(zip(ordered, ParkingSpot.get_booking_options(lot_id, booking_date)))
+        if winners:
+            Reservation.insert_many(
+                [(spot.id, booking_date, user.id, lot_id) for user, spot in winners],
+                fields=[Reservation.parking_spot_id, Reservation.booking_date, Reservation.user_id, Reservation.lot_id]
+            ).execute()
+
+        waitlisted = ordered[len(winners):]
+        if waitlisted:
+            WaitlistEntry.insert_many(
+                [{'user_id': user.id, 'booking_date': booking_date} for user in waitlisted]
+            ).on_conflict_ignore().execute()
+
+    return AllocationResult(booking_date=booking_date, winners=winners, waitlisted=waitlisted)
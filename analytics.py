@@ -0,0 +1,208 @@
+"""
+Аналитика загрузки парковок по свёрнутым итогам.
+
+Брони прошедших дней больше не меняются, поэтому они сворачиваются в две таблицы:
+итоги дня по парковке (DailyOccupancy) и дни использования за месяц по парам место-пользователь (MonthlyUsage).
+Свёртка инкрементальная: обрабатываются только дни после последнего свёрнутого,
+пачками по ROLLUP_BATCH_DAYS дней, каждая пачка - отдельная короткая транзакция.
+Брони берутся и из основной таблицы, и из архива, поэтому перенос в архив на итоги не влияет.
+Отчёт за несколько месяцев агрегируется в SQL по свёрнутым строкам, сами брони при этом не читаются.
+"""
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional
+
+from peewee import EXCLUDED, JOIN, fn
+
+from entities import (
+    db, ArchivedReservation, DailyOccupancy, MonthlyUsage, ParkingLot, ParkingSpot, Reservation, User)
+
+""" Сколько дней сворачивать одной транзакцией """
+ROLLUP_BATCH_DAYS = 31
+
+
+@dataclass(frozen=True)
+class OccupancyStats:
+    since: date
+    until: date
+    """ Сколько дней свёрнуто за период. Загрузка места - доля этих дней, когда оно было занято """
+    days_count: int
+    booked_count: int
+    """ Сумма активных мест по дням (место-дни) """
+    capacity: int
+    """ По дням недели, начиная с понедельника: (занято место-дней, всего место-дней) """
+    by_weekday: list[tuple[int, int]]
+    """ (имя места, дней занято) по убыванию загрузки """
+    by_spot: list[tuple[str, int]]
+    """ (id, username, first_name, last_name, дней с бронью) по убыванию. Для удалённых пользователей id равен None """
+    by_user: list[tuple[Optional[int], Optional[str], Optional[str], Optional[str], int]]
+
+
+def get_month_start(one_date: date) -> date:
+    return one_date.replace(day=1)
+
+
+def get_months_ago(one_date: date, months: int) -> date:
+    """ Первое число месяца, который на months раньше месяца one_date """
+    month_index = one_date.year * 12 + one_date.month - 1 - months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def select_reservation_rows(lot_id: int, since: date, until: date):
+    """ Брони парковки с since по until включительно из основной таблицы и архива: (дата, место, пользователь) """
+    live_rows = Reservation.select(
+        Reservation.booking_date,
+        Reservation.parking_spot_id.alias('parking_spot_id'),
+        Reservation.user_id.alias('user_id')
+    ).where(
+        Reservation.lot_id == lot_id,
+        Reservation.booking_date.between(since, until)
+    )
+    archived_rows = ArchivedReservation.select(
+        ArchivedReservation.booking_date,
+        ArchivedReservation.parking_spot_id,
+        ArchivedReservation.user_id
+    ).where(
+        ArchivedReservation.lot_id == lot_id,
+        ArchivedReservation.booking_date.between(since, until)
+    )
+    """ Одна бронь не бывает одновременно и в таблице, и в архиве, поэтому UNION ALL """
+    return (live_rows + archived_rows).alias('reservation_rows')
+
+
+def get_first_unrolled_date(lot_id: int) -> Optional[date]:
+    """ Первый ещё не свёрнутый день парковки. None - если у парковки не было ни одной брони """
+    last_date = DailyOccupancy.select(fn.MAX(DailyOccupancy.booking_date)).where(
+        DailyOccupancy.lot_id == lot_id
+    ).scalar()
+    if last_date is not None:
+        return date.fromisoformat(str(last_date)) + timedelta(days=1)
+
+    first_dates = [
+        Reservation.select(fn.MIN(Reservation.booking_date)).where(Reservation.lot_id == lot_id).scalar(),
+        ArchivedReservation.select(fn.MIN(ArchivedReservation.booking_date)).where(
+            ArchivedReservation.lot_id == lot_id
+        ).scalar()
+    ]
+    first_dates = [date.fromisoformat(str(first_date)) for first_date in first_dates if first_date is not None]
+    return min(first_dates) if first_dates else None
+
+
+def roll_up_batch(lot_id: int, since: date, until: date, spots_count: int) -> None:
+    """ Сворачивает дни парковки с since по until включительно одной транзакцией """
+    with db.atomic():
+        rows = select_reservation_rows(lot_id, since, until)
+
+        booked_by_date = {
+            date.fromisoformat(str(booking_date)): booked_count
+            for booking_date, booked_count in db.execute(
+                rows.select_from(rows.c.booking_date, fn.COUNT(rows.c.booking_date)).group_by(rows.c.booking_date)
+            )
+        }
+        days = [since + timedelta(days=offset) for offset in range((until - since).days + 1)]
+        DailyOccupancy.insert_many(
+            [
+                (lot_id, one_date, max(spots_count, booked_by_date.get(one_date, 0)), booked_by_date.get(one_date, 0))
+                for one_date in days
+            ],
+            fields=[
+                DailyOccupancy.lot_id, DailyOccupancy.booking_date,
+                DailyOccupancy.spots_count, DailyOccupancy.booked_count
+            ]
+        ).execute()
+
+        month = fn.strftime('%Y-%m-01', rows.c.booking_date)
+        usage_rows = list(db.execute(
+            rows.select_from(month, rows.c.parking_spot_id, rows.c.user_id, fn.COUNT(rows.c.booking_date))
+            .group_by(month, rows.c.parking_spot_id, rows.c.user_id)
+        ))
+        if usage_rows:
+            """ Пачка может начаться в середине месяца: дни добавляются к уже свёрнутым """
+            MonthlyUsage.insert_many(
+                [(lot_id,) + tuple(usage_row) for usage_row in usage_rows],
+                fields=[
+                    MonthlyUsage.lot_id, MonthlyUsage.month, MonthlyUsage.parking_spot_id,
+                    MonthlyUsage.user_id, MonthlyUsage.booked_days
+                ]
+            ).on_conflict(
+                conflict_target=[
+                    MonthlyUsage.lot_id, MonthlyUsage.month, MonthlyUsage.parking_spot_id, MonthlyUsage.user_id
+                ],
+                update={MonthlyUsage.booked_days: MonthlyUsage.booked_days + EXCLUDED.booked_days}
+            ).execute()
+
+
+def roll_up_lot(lot_id: int, until: date) -> int:
+    """
+    Сворачивает прошедшие дни парковки до until (не включая). Повторный вызов ничего не делает.
+    Количество мест в день берётся текущее: история включения и выключения мест не хранится.
+    Возвращает количество свёрнутых дней
+    """
+    since = get_first_unrolled_date(lot_id)
+    if since is None or since >= until:
+        return 0
+
+    spots_count = ParkingSpot.select().where(ParkingSpot.lot_id == lot_id, ParkingSpot.is_active).count()
+    rolled_count = 0
+    while since < until:
+        batch_until = min(since + timedelta(days=ROLLUP_BATCH_DAYS), until)
+        roll_up_batch(lot_id, since, batch_until - timedelta(days=1), spots_count)
+        rolled_count += (batch_until - since).days
+        since = batch_until
+    return rolled_count
+
+
+def roll_up(until: date) -> int:
+    """ Сворачивает прошедшие дни всех парковок. Выполняется в пуле потоков БД """
+    return sum(roll_up_lot(lot.id, until) for lot in ParkingLot.get_all_lots())
+
+
+def get_occupancy_stats(lot_id: int, months: int, today: date) -> OccupancyStats:
+    """
+    Загрузка парковки по вчерашний день за months месяцев, считая месяц вчерашнего дня.
+    Сначала досворачивает дни, которые ещё не свёрнуты. Выполняется в пуле потоков БД
+    """
+    roll_up_lot(lot_id, today)
+    until = today - timedelta(days=1)
+    since = get_months_ago(until, months - 1)
+
+    weekday = fn.strftime('%w', DailyOccupancy.booking_date)
+    by_weekday = [(0, 0)] * 7
+    days_count = 0
+    for sqlite_weekday, booked_count, capacity, weekday_days in DailyOccupancy.select(
+        weekday, fn.SUM(DailyOccupancy.booked_count), fn.SUM(DailyOccupancy.spots_count), fn.COUNT(DailyOccupancy.id)
+    ).where(
+        DailyOccupancy.lot_id == lot_id,
+        DailyOccupancy.booking_date.between(since, until)
+    ).group_by(weekday).tuples():
+        """ В SQLite неделя начинается с воскресенья """
+        by_weekday[(int(sqlite_weekday) + 6) % 7] = (booked_count, capacity)
+        days_count += weekday_days
+
+    booked_days = fn.SUM(MonthlyUsage.booked_days)
+    by_spot = list(MonthlyUsage.select(ParkingSpot.name, booked_days).join(
+        ParkingSpot, on=(MonthlyUsage.parking_spot_id == ParkingSpot.id)
+    ).where(
+        MonthlyUsage.lot_id == lot_id,
+        MonthlyUsage.month.between(since, get_month_start(until))
+    ).group_by(MonthlyUsage.parking_spot_id).order_by(booked_days.desc(), ParkingSpot.name).tuples())
+
+    by_user = list(MonthlyUsage.select(
+        User.id, User.username, User.first_name, User.last_name, booked_days
+    ).join(
+        User, JOIN.LEFT_OUTER, on=(MonthlyUsage.user_id == User.id)
+    ).where(
+        MonthlyUsage.lot_id == lot_id,
+        MonthlyUsage.month.between(since, get_month_start(until))
+    ).group_by(MonthlyUsage.user_id).order_by(booked_days.desc(), MonthlyUsage.user_id).tuples())
+
+    return OccupancyStats(
+        since=since,
+        until=until,
+        days_count=days_count,
+        booked_count=sum(booked for booked, _ in by_weekday),
+        capacity=sum(capacity for _, capacity in by_weekday),
+        by_weekday=by_weekday,
+        by_spot=by_spot,
+        by_user=by_user
+    )
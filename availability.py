@@ -0,0 +1,111 @@
+"""
+Индекс свободных мест в памяти процесса.
+
+У каждой парковки свой индекс. Для каждой даты окна бронирования хранится множество id свободных мест,
+поэтому вопрос «какие места свободны» не ходит в БД.
+Индекс загружается при старте, обновляется на каждом бронировании и отмене брони
+и периодически сверяется с БД (на случай, если брони меняли в обход бота).
+Даты вне окна в индексе отсутствуют - для них нужно спрашивать БД.
+"""
+from datetime import date
+from typing import Callable, Optional
+
+from entities import ParkingSpot, Reservation, run_in_db
+
+""" Сколько раз пытаться перечитать БД, если во время чтения менялись брони """
+RELOAD_ATTEMPTS = 3
+
+
+def get_spot_names(spots: dict[int, ParkingSpot]) -> dict[int, str]:
+    return {spot_id: spot.name for spot_id, spot in spots.items()}
+
+
+class AvailabilityIndex:
+    def __init__(self, lot_id: int):
+        self.lot_id = lot_id
+        self.spots: dict[int, ParkingSpot] = {}
+        self.free_spot_ids: dict[date, set[int]] = {}
+        """ Счётчик изменений нужен, чтобы не затереть свежие изменения результатом долгого чтения из БД """
+        self.changes_count = 0
+        """ Функции, которые вызываются с датой, на которую изменились свободные места """
+        self.change_listeners: list[Callable[[date], None]] = []
+
+    def notify(self, changed_date: date) -> None:
+        for listener in self.change_listeners:
+            listener(changed_date)
+
+    def get_free_spots(self, checking_date: date) -> Optional[list[ParkingSpot]]:
+        """ Свободные места на дату по порядку id. None - если даты нет в индексе """
+        free_spot_ids = self.free_spot_ids.get(checking_date)
+        if free_spot_ids is None:
+            return None
+        return [self.spots[spot_id] for spot_id in sorted(free_spot_ids)]
+
+    def mark_booked(self, booking_date: date, spot_id: int) -> None:
+        free_spot_ids = self.free_spot_ids.get(booking_date)
+        if free_spot_ids is None or spot_id not in free_spot_ids:
+            return
+        free_spot_ids.discard(spot_id)
+        self.changes_count += 1
+        self.notify(booking_date)
+
+    def mark_free(self, booking_date: date, spot_id: int) -> None:
+        free_spot_ids = self.free_spot_ids.get(booking_date)
+        if free_spot_ids is None or spot_id in free_spot_ids or spot_id not in self.spots:
+            return
+        free_spot_ids.add(spot_id)
+        self.changes_count += 1
+        self.notify(booking_date)
+
+    def read_snapshot(self, dates: list[date]) -> tuple[dict[int, ParkingSpot], dict[date, set[int]]]:
+        """ Читает места и брони парковки на даты двумя запросами. Выполняется в пуле потоков БД """
+        spots = {
+            spot.id: spot for spot in ParkingSpot.select().where(
+                ParkingSpot.lot_id == self.lot_id,
+                ParkingSpot.is_active
+            ).order_by(ParkingSpot.id)
+        }
+        free_spot_ids = {one_date: set(spots) for one_date in dates}
+
+        booked = (Reservation
+                  .select(Reservation.booking_date, Reservation.parking_spot_id)
+                  .where(Reservation.lot_id == self.lot_id, Reservation.booking_date.in_(dates))
+                  .tuples())
+        for booking_date, spot_id in booked:
+            free_spot_ids[booking_date].discard(spot_id)
+
+        return spots, free_spot_ids
+
+    def apply_snapshot(self, spots: dict[int, ParkingSpot], free_spot_ids: dict[date, set[int]]) -> int:
+        """ Заменяет содержимое индекса. Возвращает количество дат, на которые индекс разошёлся с БД """
+        diverged_dates = [
+            one_date for one_date in free_spot_ids
+            if one_date in self.free_spot_ids and self.free_spot_ids[one_date] != free_spot_ids[one_date]
+        ]
+        if get_spot_names(spots) != get_spot_names(self.spots):
+            changed_dates = set(self.free_spot_ids) | set(free_spot_ids)
+        else:
+            changed_dates = set(self.free_spot_ids) ^ set(free_spot_ids) | set(diverged_dates)
+
+        self.spots = spots
+        self.free_spot_ids = free_spot_ids
+
+        for changed_date in changed_dates:
+            self.notify(changed_date)
+        return len(diverged_dates)
+
+    async def reload(self, dates: list[date]) -> Optional[int]:
+        """
+        Перечитывает индекс из БД на указанные даты, остальные даты выбрасываются.
+        Если во время чтения брони менялись, чтение повторяется.
+        Возвращает количество дат, на которые индекс разошёлся с БД, или None, если сверить не удалось
+        """
+        for _ in range(RELOAD_ATTEMPTS):
+            changes_count = self.changes_count
+            spots, free_spot_ids = await run_in_db(self.read_snapshot, dates)
+
+            if changes_count == self.changes_count:
+                return self.apply_snapshot(spots, free_spot_ids)
+
+        print("Не удалось сверить индекс свободных мест с БД: брони постоянно меняются")
+        return None
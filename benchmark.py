@@ -0,0 +1,137 @@
+"""
+Замер задержки обработки обновлений под конкурентной нагрузкой.
+
+Запуск (из директории с settings.yml):
+    python3 benchmark.py --updates 2000 --concurrency 50
+
+Скрипт создаёт временную БД, наполняет её пользователями и местами
+и прогоняет смесь «тяжёлых» (бронирование, список свободных мест) и
+«лёгких» (/help) обновлений в двух режимах:
+    blocking - запросы к БД выполняются прямо в event loop (как было раньше);
+    executor - запросы к БД выполняются через run_in_db в пуле потоков.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+from config import get_settings
+from entities import db, init_db, Role, User, ParkingLot, ParkingSpot, Reservation, run_in_db
+from migrations import migrate
+
+ROLE_NAMES = ["ADMINISTRATOR", "AUDITOR", "CLIENT"]
+
+
+def prepare_database(db_path: str, users_count: int, spots_count: int) -> None:
+    """ Создаёт и наполняет временную БД """
+    init_db(db_path)
+    migrate()
+    Role.load_roles(ROLE_NAMES)
+    lot_settings = get_settings().parking_lots[0]
+    lot_id = ParkingLot.load_lots([lot_settings])[lot_settings.name]
+    User.load_users([
+        {
+            "username": f"user{i}",
+            "first_name": f"First{i}",
+            "last_name": f"Last{i}",
+            "role": "CLIENT",
+            "telegram_id": 1000 + i,
+            "lot_id": lot_id
+        }
+        for i in range(users_count)
+    ])
+    ParkingSpot.load_spots({lot_id: [str(i) for i in range(spots_count)]})
+
+
+def heavy_update(telegram_id: int, booking_date: date) -> None:
+    """ Типичная работа хэндлера бронирования с БД """
+    requester = User.get_user_by_id(telegram_id)
+    if Reservation.get_user_reservation(requester, booking_date) is not None:
+        return
+    available_spots = ParkingSpot.get_booking_options(requester.lot_id_id, booking_date)
+    if available_spots:
+        Reservation.book_spot(spot_id=random.choice(available_spots).id, booking_date=booking_date, user=requester)
+
+
+async def simulate_update(mode: str, telegram_id: int, booking_date: date, is_heavy: bool) -> tuple[bool, float]:
+    started = time.perf_counter()
+    if is_heavy:
+        if mode == "executor":
+            await run_in_db(heavy_update, telegram_id, booking_date)
+        else:
+            heavy_update(telegram_id, booking_date)
+    """ Имитация отправки ответа в Bot API """
+    await asyncio.sleep(0)
+    return is_heavy, time.perf_counter() - started
+
+
+async def run_mode(mode: str, args: argparse.Namespace) -> list[tuple[bool, float]]:
+    Reservation.delete().execute()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    booking_dates = [date.today() + timedelta(days=i) for i in range(args.days)]
+
+    async def one_update(i: int) -> tuple[bool, float]:
+        async with semaphore:
+            return await simulate_update(
+                mode,
+                telegram_id=1000 + random.randrange(args.users),
+                booking_date=random.choice(booking_dates),
+                is_heavy=random.random() < args.heavy_share
+            )
+
+    return await asyncio.gather(*(one_update(i) for i in range(args.updates)))
+
+
+def percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def format_latencies(latencies: list[float]) -> str:
+    """ Перцентили и среднее задержек в миллисекундах. Общий формат для benchmark.py и load_test.py """
+    return (
+        f"p50 {percentile(latencies, 50) * 1000:7.2f} ms, "
+        f"p95 {percentile(latencies, 95) * 1000:7.2f} ms, "
+        f"p99 {percentile(latencies, 99) * 1000:7.2f} ms, "
+        f"mean {statistics.mean(latencies) * 1000:7.2f} ms"
+    )
+
+
+def print_results(title: str, latencies: list[float], elapsed: float) -> None:
+    if not latencies:
+        return
+    print(f"{title:>15}: {len(latencies) / elapsed:8.1f} upd/s, {format_latencies(latencies)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Замер задержки хэндлеров под нагрузкой")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--spots", type=int, default=300)
+    parser.add_argument("--days", type=int, default=4)
+    parser.add_argument("--heavy-share", type=float, default=0.3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepare_database(os.path.join(tmp_dir, "benchmark.db"), args.users, args.spots)
+        User.reload_cache()
+
+        for mode in ("blocking", "executor"):
+            started = time.perf_counter()
+            results = asyncio.run(run_mode(mode, args))
+            elapsed = time.perf_counter() - started
+            print_results(mode, [latency for _, latency in results], elapsed)
+            print_results("  light", [latency for is_heavy, latency in results if not is_heavy], elapsed)
+            print_results("  heavy", [latency for is_heavy, latency in results if is_heavy], elapsed)
+
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,47 @@
+import asyncio
+import functools
+import os
+import signal
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, date
+from typing import Awaitable, Callable, Iterator, Optional
 
-import yaml
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.base import BaseSession
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State, default_state
-from aiogram.types import Message
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, BufferedInputFile
 from aiogram.types import (
     ReplyKeyboardRemove, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery)
 
-from entities import Reservation, User, ParkingSpot, Guest, Role
-
-from peewee import DoesNotExist
+from entities import (
+    Reservation, User, ParkingLot, ParkingSpot, Guest, WaitlistEntry, AllocationRequest, BookingResult, run_in_db,
+    optimize_db, incremental_vacuum, close_db, import_config)
+from availability import AvailabilityIndex
+from analytics import OccupancyStats, get_occupancy_stats, roll_up
+from allocation import allocate
+from config import SETTINGS_FILE, get_settings, reload_settings
+from callbacks import (
+    CallbackPayload, BookSpot, SpotsPage, CancelReservation, JoinWaitlist, RequestAllocation, CalendarButton, GuestsPage,
+    ChooseGuest, ChooseRole, encode_callback, decode_callback)
 
 """ Текст, который будет выводить бот в сообщениях """
 TEXT_BUTTON_1 = "Забронируй мне место 🅿️"
 TEXT_BUTTON_2 = "Отправь отчёт по брони за 2 недели 📝"
 TEXT_BUTTON_3 = "Отмени бронь ❌"
 TEXT_BUTTON_4 = "Покажи свободные места на текущую дату 🕒"
+TEXT_BUTTON_5 = "Забронируй на несколько дней 📅"
+TEXT_BUTTON_6 = "Статистика загрузки 📊"
 START_MESSAGE = "Привет!\nМеня зовут Анна.\nПомогу забронировать место на парковке."
 HELP_MESSAGE = "/start - и мы начнём диалог сначала 👀\n/help - выводит данную подсказку 💁🏻‍♀️"
 ALL_SPOT_ARE_BUSY_MESSAGE = "к сожалению, все места заняты 😢"
+SPOT_TAKEN_MESSAGE = "Ой, это место только что заняли 🙈"
+ALREADY_BOOKED_MESSAGE = "У Вас уже есть бронь на эту дату 🙂"
 DATE_REQUEST_MESSAGE = 'Сейчас посмотрим, что я могу Вам предложить'
 ACCESS_IS_NOT_ALLOWED_MESSAGE = "Нет 🙅🏻‍♀️"
 UNKNOWN_USER_MESSAGE_1 = "Эммм ... Мы с Вами знакомы? 👀"
@@ -31,6 +51,7 @@ UNKNOWN_TEXT_MESSAGE = "Эммм ... 👀"
 UNKNOWN_ERROR_MESSAGE = "Произошла какая-то ошибка. Мне так жаль 😢"
 NO_RESERVATIONS_MESSAGE = "Кажется, пока никто ничего не забронировал 😒"
 CANCEL_SUCCESS_MESSAGE = "Хорошо, удалила. 🫴🏻"
+CANCEL_NOT_FOUND_MESSAGE = "Такой брони у Вас нет 🤷🏻‍♀️"
 TEXT_ADD_USER_BUTTON = "Добавить пользователя 👤"
 TEXT_DELETE_USER_BUTTON = "Удалить пользователя 🪣"
 INPUT_USERNAME_MESSAGE = "Введите username пользователя.\nЕсли его нет, введите 0"
@@ -46,17 +67,59 @@ TEXT_CHOOSE_USER_FOR_DELETE_MESSAGE = "Хорошо. Мне нужно знат
 TEXT_UNCORRECT_USER_ID_MESSAGE = "Не совсем поняла Вас 🤨"
 TEXT_DELETE_USER_SUCCESS_MESSAGE = "Вычеркнула из списка пользователей. Я буду по нему скучать 😢 ... хотя кого я обманываю 💃🏼."
 TEXT_DELETE_USER_CANCEL_MESSAGE = "Хорошо. Сделаем вид, что ничего не было 💅"
+DELETED_USER_NAME = "[ДАННЫЕ УДАЛЕНЫ]"
+REPORT_FILE_MESSAGE = "Отчёт получился большим, поэтому отправляю его файлом 📎"
+CALENDAR_MESSAGE = "Отметьте дни, на которые нужно место, и нажмите «Забронировать выбранные»"
+CALENDAR_BOOK_BUTTON = "Забронировать выбранные ✅"
+CALENDAR_NOTHING_SELECTED_MESSAGE = "Вы не выбрали ни одного дня 🤷🏻‍♀️"
+CALENDAR_EXPIRED_MESSAGE = "Этот календарь уже неактуален. Откройте его заново 🙂"
+CALENDAR_DAY_UNAVAILABLE_MESSAGE = "На этот день забронировать не получится"
+CALENDAR_RESULT_MESSAGE = "Вот что получилось:\n"
+WEEKDAY_NAMES = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+GUESTS_PAGE_MESSAGE = "Ко мне обращались следующие пользователи (страница {} из {}):\n"
+GUESTS_PREVIOUS_PAGE_BUTTON = "◀️"
+GUESTS_NEXT_PAGE_BUTTON = "▶️"
+SPOTS_PREVIOUS_PAGE_BUTTON = "◀️"
+SPOTS_NEXT_PAGE_BUTTON = "▶️"
+GUEST_EXPIRED_MESSAGE = "Этот запрос уже неактуален: гостя нет в списке. Начните добавление заново 🙂"
+WAITLIST_BUTTON = "Встать в очередь ⏳"
+WAITLIST_JOINED_MESSAGE = "Поставила Вас в очередь на {}. Вы {}-й. Если место освободится, сразу забронирую его за Вами 🙂"
+WAITLIST_ASSIGNED_MESSAGE = 'Освободилось место "{}" на {}. Забронировала его за Вами 🎉'
+WAITLIST_EXPIRED_MESSAGE = "Эта дата уже прошла 🤷🏻‍♀️"
+ALLOCATION_BUTTON = "Заявка на {} 🎲"
+ALLOCATION_REQUESTED_MESSAGE = "Приняла заявку на {}. Заявок уже: {}. В {:02d}:00 распределю места и сразу напишу 🙂"
+ALLOCATION_PENDING_MESSAGE = "Места на {} распределяются по заявкам. Как только распределю, сразу напишу 🙂"
+ALLOCATION_CLOSED_MESSAGE = "Заявки на эту дату уже не принимаются 🤷🏻‍♀️"
+ALLOCATION_WON_MESSAGE = 'По заявке Вам досталось место "{}" на {} 🎉'
+ALLOCATION_WAITLISTED_MESSAGE = (
+    "На {} мест по заявкам на всех не хватило 😢 Поставила Вас в очередь: если место освободится, "
+    "сразу забронирую его за Вами"
+)
+DIGEST_AUDITORS_MESSAGE = "Доброе утро! Вот брони на {}:\n\n"
+DIGEST_CLIENTS_MESSAGE = "На {} ещё свободно мест: {}. Забронировать? 🅿️"
+ANALYTICS_MESSAGE = "Загрузка парковки с {} по {}: {}% ({} из {} место-дней)\n"
+ANALYTICS_WEEKDAYS_TITLE = "\nПо дням недели:\n"
+ANALYTICS_SPOTS_TITLE = "\nПо местам:\n"
+ANALYTICS_USERS_TITLE = "\nПо пользователям (дней с бронью):\n"
+
+""" Ограничение Telegram на длину одного сообщения """
+TELEGRAM_MESSAGE_MAX_LENGTH = 4096
+""" Если отчёт не помещается в столько сообщений, он отправляется файлом """
+REPORT_MAX_MESSAGES = 5
+""" Сколько мест показывать в одном ряду клавиатуры бронирования """
+SPOT_KEYBOARD_ROW_WIDTH = 4
+"""
+Telegram не принимает инлайн-клавиатуры больше чем из 100 кнопок.
+Остальные места - на следующих страницах: на странице остаётся место для ряда перехода и кнопки заявки
+"""
+SPOT_KEYBOARD_PAGE_SIZE = 96
+""" Длина полосы в текстовых диаграммах статистики """
+CHART_WIDTH = 10
 
 ROLE_ADMINISTRATOR = "ADMINISTRATOR"
 ROLE_AUDITOR = "AUDITOR"
 ROLE_CLIENT = "CLIENT"
 
-# Получаем данные из файла настроек
-with open('settings.yml', 'r') as file:
-    CONSTANTS = yaml.safe_load(file)
-
-TODAY_DEADLINE_CLOCK_FOR_CLIENTS = CONSTANTS["TODAY_DEADLINE_CLOCK_FOR_CLIENTS"]
-
 
 class FSMFillForm(StatesGroup):
     # Создаем экземпляры класса State, последовательно
@@ -65,64 +128,587 @@ class FSMFillForm(StatesGroup):
     add_user = State()  # Состояние ожидания добавления нового пользователя в БД
     choose_role = State()  # Состояние ожидания выбора роли нового пользователя
     book_spot = State()  # Состаяние ожидания подтверждение на бронирование места
+    choose_booking_days = State()  # Состояние выбора дней в календаре бронирования
     choose_user_for_delete = State()  # Состояние выбора пользователя для удаления
 
 
 def get_inline_keyboard_for_booking(
         available_spots: list[ParkingSpot],
-        available_date: datetime.date) -> InlineKeyboardMarkup:
+        available_date: datetime.date,
+        page: int = 0) -> InlineKeyboardMarkup:
+    """ Страница клавиатуры свободных мест. Номер страницы за пределами списка сдвигается на ближайшую """
+    pages_count = max(1, (len(available_spots) + SPOT_KEYBOARD_PAGE_SIZE - 1) // SPOT_KEYBOARD_PAGE_SIZE)
+    page = min(max(0, page), pages_count - 1)
+    page_start = page * SPOT_KEYBOARD_PAGE_SIZE
     buttons_list = []
 
-    """ Создаём кнопку для каждой доступной даты """
-    for one_spot in available_spots:
-        available_date_str = available_date.strftime("%Y-%m-%d")
+    """ Создаём кнопку для каждого свободного места. Кнопки раскладываем по рядам фиксированной ширины """
+    for one_spot in available_spots[page_start:page_start + SPOT_KEYBOARD_PAGE_SIZE]:
         one_button: InlineKeyboardButton = InlineKeyboardButton(
             text=one_spot.name,
-            callback_data=f'book {one_spot.name} {available_date_str}')
+            callback_data=encode_callback(BookSpot(one_spot.id, available_date)))
         buttons_list.append(one_button)
 
+    rows = [
+        buttons_list[row_start:row_start + SPOT_KEYBOARD_ROW_WIDTH]
+        for row_start in range(0, len(buttons_list), SPOT_KEYBOARD_ROW_WIDTH)
+    ]
+
+    navigation_buttons = []
+    if page > 0:
+        navigation_buttons.append(InlineKeyboardButton(
+            text=SPOTS_PREVIOUS_PAGE_BUTTON, callback_data=encode_callback(SpotsPage(available_date, page - 1))))
+    if page < pages_count - 1:
+        navigation_buttons.append(InlineKeyboardButton(
+            text=SPOTS_NEXT_PAGE_BUTTON, callback_data=encode_callback(SpotsPage(available_date, page + 1))))
+    if navigation_buttons:
+        rows.append(navigation_buttons)
+
     """ Создаем объект инлайн-клавиатуры """
     keyboard: InlineKeyboardMarkup = InlineKeyboardMarkup(
-        inline_keyboard=[buttons_list])
+        inline_keyboard=rows)
     return keyboard
 
 
-""" Получаем данные из файла настроек """
-with open('settings.yml', 'r') as file:
-    CONSTANTS = yaml.safe_load(file)
-API_TOKEN = CONSTANTS['API_TOKEN']
+def get_inline_keyboard_for_waitlist(booking_date: date) -> InlineKeyboardMarkup:
+    """ Кнопка постановки в очередь на дату, когда все места заняты """
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=WAITLIST_BUTTON, callback_data=encode_callback(JoinWaitlist(booking_date)))
+    ]])
+
+
+def is_allocation_enabled() -> bool:
+    return get_settings().section('ALLOCATION').get('ENABLED', False)
+
+
+"""
+Последняя дата, распределение на которую уже прошло, по парковкам.
+В режиме распределения даты после неё закрыты для обычного бронирования: иначе их разбирали бы в календаре
+или в первую секунду после дедлайна, ещё до распределения
+"""
+allocated_dates: dict[int, date] = {}
+
+
+def get_last_open_date(lot: ParkingLot) -> date:
+    """ Последняя дата, которую можно бронировать напрямую. Без режима распределения ограничения нет """
+    if not is_allocation_enabled():
+        return date.max
+    return allocated_dates.get(lot.id, date.min)
+
+
+def get_allocation_date(lot: ParkingLot) -> date:
+    """ Дата, заявки на которую принимаются сейчас: она откроется для бронирования в следующий дедлайн парковки """
+    return get_first_booking_date(lot) + timedelta(days=1)
+
+
+def add_allocation_button(
+        keyboard: Optional[InlineKeyboardMarkup], lot: ParkingLot) -> Optional[InlineKeyboardMarkup]:
+    """
+    В режиме распределения добавляет к клавиатуре кнопку заявки на следующую дату.
+    Клавиатура может быть из кэша, поэтому собирается новая, а не меняется переданная
+    """
+    if not is_allocation_enabled():
+        return keyboard
+
+    allocation_date = get_allocation_date(lot)
+    rows = keyboard.inline_keyboard if keyboard is not None else []
+    return InlineKeyboardMarkup(inline_keyboard=rows + [[
+        InlineKeyboardButton(
+            text=ALLOCATION_BUTTON.format(allocation_date),
+            callback_data=encode_callback(RequestAllocation(allocation_date))
+        )
+    ]])
+
+
+"""
+Кэш свободных мест и готовых клавиатур бронирования: (id парковки, дата) -> (свободные места, клавиатура).
+Заполняется из индекса свободных мест парковки и сбрасывается, когда индекс меняется на эту дату
+"""
+spot_keyboards_cache: dict[tuple[int, date], tuple[list[ParkingSpot], Optional[InlineKeyboardMarkup]]] = {}
+
+""" Парковки по id. Перечитываются при старте, при сверке индексов и при перезагрузке настроек """
+parking_lots: dict[int, ParkingLot] = {}
+
+""" Свободные места на даты окна бронирования по парковкам. Обновляются при бронировании и отмене брони """
+availability_by_lot: dict[int, AvailabilityIndex] = {}
+
+
+def invalidate_spot_keyboard(lot_id: int, booking_date: date) -> None:
+    spot_keyboards_cache.pop((lot_id, booking_date), None)
 
-bot: Bot = Bot(token=API_TOKEN)
+
+def get_availability(lot_id: int) -> AvailabilityIndex:
+    """ Индекс свободных мест парковки. Индекс новой парковки пуст, пока его не перечитает reload_availability """
+    index = availability_by_lot.get(lot_id)
+    if index is None:
+        index = AvailabilityIndex(lot_id)
+        index.change_listeners.append(functools.partial(invalidate_spot_keyboard, lot_id))
+        availability_by_lot[lot_id] = index
+    return index
+
+
+async def get_booking_options_with_keyboard(
+        lot_id: int, booking_date: date) -> tuple[list[ParkingSpot], Optional[InlineKeyboardMarkup]]:
+    """ Свободные места парковки на дату и первая страница клавиатуры для их бронирования (None, если мест нет) """
+    cached = spot_keyboards_cache.get((lot_id, booking_date))
+    if cached is not None:
+        return cached
+
+    available_spots = get_availability(lot_id).get_free_spots(booking_date)
+    if available_spots is None:
+        """ Даты нет в индексе - спрашиваем БД и не кэшируем, потому что индекс эту дату не отслеживает """
+        available_spots = await run_in_db(ParkingSpot.get_booking_options, lot_id, booking_date)
+        keyboard = get_inline_keyboard_for_booking(available_spots, booking_date) if available_spots else None
+        return available_spots, keyboard
+
+    keyboard = get_inline_keyboard_for_booking(available_spots, booking_date) if available_spots else None
+    cached = (available_spots, keyboard)
+    spot_keyboards_cache[(lot_id, booking_date)] = cached
+    return cached
+
+
+def create_fsm_storage() -> BaseStorage:
+    """ Хранилище состояний диалогов: в БД бота (по умолчанию) или в памяти процесса """
+    settings = get_settings()
+    if settings.get('FSM_STORAGE', 'sqlite') == 'memory':
+        return MemoryStorage()
+
+    from fsm_storage import SqliteStorage
+    return SqliteStorage(ttl_seconds=settings.get('FSM_STATE_TTL_HOURS', 24) * 60 * 60)
+
+
+""" Хэндлеры регистрируются в диспетчере при импорте, а бот, хранилище диалогов и middleware создаются в setup_bot """
+bot: Optional[Bot] = None
 dp: Dispatcher = Dispatcher()
+outgoing_queue = None
+
 
+def setup_bot(session: Optional[BaseSession] = None) -> Bot:
+    """
+    Создаёт бота по настройкам и подключает хранилище диалогов, очередь исходящих сообщений и метрики.
+    session - своя сессия Bot API (например, заглушка нагрузочного теста): middleware подключаются к ней же
+    """
+    global bot, outgoing_queue
+    if bot is not None:
+        return bot
+
+    settings = get_settings()
+    dp.fsm.storage = create_fsm_storage()
+    bot = Bot(token=settings.api_token, session=session)
+
+    """ Очередь исходящих сообщений подключается первой, чтобы метрики Bot API замеряли сами запросы, а не постановку в очередь """
+    outgoing_settings = settings.section('OUTGOING')
+    if outgoing_settings.get('ENABLED', True):
+        from outgoing import OutgoingQueue
+        outgoing_queue = OutgoingQueue(
+            global_rate=outgoing_settings.get('GLOBAL_MESSAGES_PER_SECOND', 30),
+            chat_rate=outgoing_settings.get('CHAT_MESSAGES_PER_SECOND', 1),
+            chat_burst=outgoing_settings.get('CHAT_BURST', 3),
+            max_queue_size=outgoing_settings.get('MAX_QUEUE_SIZE', 1000),
+            max_retries=outgoing_settings.get('MAX_RETRIES', 3)
+        )
+        bot.session.middleware(outgoing_queue)
+
+    metrics_settings = settings.section('METRICS')
+    if metrics_settings.get('ENABLED', False):
+        from metrics import setup_metrics
+        setup_metrics(dp, bot, metrics_settings, get_callback_handler_name)
+    return bot
+
+
+async def purge_expired_states_periodically() -> None:
+    """ Раз в час удаляет брошенные состояния диалогов """
+    while True:
+        removed_count = await dp.storage.purge_expired()
+        if removed_count > 0:
+            print(f"Удалено брошенных состояний диалогов: {removed_count}")
+        await asyncio.sleep(60 * 60)
+
+
+""" Фоновые задачи бота. Ссылки храним, чтобы задачи не удалил сборщик мусора """
+background_tasks: set[asyncio.Task] = set()
+
+
+def start_background_task(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def get_availability_window(lot: ParkingLot) -> list[date]:
+    """ Даты, свободные места на которые держим в памяти: те же, что и в календаре бронирования парковки """
+    return get_calendar_dates(get_first_booking_date(lot))
+
+
+async def reload_availability() -> int:
+    """
+    Перечитывает парковки и индексы свободных мест каждой из них.
+    Возвращает количество дат, на которые индексы разошлись с БД
+    """
+    global parking_lots
+    parking_lots = {lot.id: lot for lot in await run_in_db(ParkingLot.get_all_lots)}
 
-async def is_user_unauthorized(message: Message):
-    authorized_ids = [user.telegram_id for user in User.select()]
+    diverged_count = 0
+    for lot in parking_lots.values():
+        diverged_count += await get_availability(lot.id).reload(get_availability_window(lot)) or 0
+    return diverged_count
 
-    if message.from_user.id not in authorized_ids:
-        return True
-    return False
+
+async def reconcile_availability_periodically() -> None:
+    """ Периодически сверяет индексы свободных мест с БД и сдвигает окна дат """
+    while True:
+        await asyncio.sleep(get_settings().get('AVAILABILITY_RECONCILE_MINUTES', 5) * 60)
+        diverged_count = await reload_availability()
+        if diverged_count:
+            print(f"Индекс свободных мест разошёлся с БД на дат: {diverged_count}. Исправлено")
+
+        """ Очереди на даты, которые выпали из окна бронирования, больше не нужны """
+        for lot in parking_lots.values():
+            await run_in_db(WaitlistEntry.delete_expired, lot.id, get_first_booking_date(lot))
+
+        """ Распределение, пропущенное в дедлайн, проходит здесь. До него дата закрыта для бронирования """
+        await allocate_all_spots()
+
+
+async def optimize_db_periodically() -> None:
+    """ Периодически выполняет PRAGMA optimize и checkpoint журнала WAL """
+    interval_minutes = get_settings().section('DATABASE').get('OPTIMIZE_INTERVAL_MINUTES', 60)
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        await run_in_db(optimize_db)
+
+
+async def archive_reservations() -> int:
+    """
+    Переносит брони старше RETENTION.KEEP_DAYS в архив пачками.
+    Каждая пачка - отдельная короткая транзакция, поэтому бронирования между пачками не ждут.
+    После переноса освобождённое место постепенно возвращается ОС
+    """
+    retention_settings = get_settings().section('RETENTION')
+    cutoff_date = date.today() - timedelta(days=retention_settings.get('KEEP_DAYS', 180))
+    batch_size = retention_settings.get('BATCH_SIZE', 500)
+
+    archived_count = 0
+    while True:
+        batch_count = await run_in_db(Reservation.archive_before, cutoff_date, batch_size)
+        archived_count += batch_count
+        if batch_count < batch_size:
+            break
+
+    if archived_count > 0:
+        print(f"Перенесено в архив броней: {archived_count}")
+        await run_in_db(incremental_vacuum, retention_settings.get('VACUUM_PAGES', 1000))
+    return archived_count
+
+
+async def archive_reservations_periodically() -> None:
+    while True:
+        await archive_reservations()
+        await asyncio.sleep(get_settings().section('RETENTION').get('INTERVAL_HOURS', 24) * 60 * 60)
+
+
+""" Перезагрузки настроек выполняются по одной, даже если сигнал пришёл во время предыдущей """
+config_reload_lock = asyncio.Lock()
+
+
+async def reload_config() -> bool:
+    """
+    Перечитывает settings.yml и приводит парковки, места и пользователей в БД к новым настройкам, не останавливая бота.
+    Обновления, которые обрабатываются в это время, дорабатывают как обычно: изменения идут через тот же пул потоков БД,
+    а индекс свободных мест перечитывается с учётом броней, сделанных во время перезагрузки.
+    Токен, БД, способ получения обновлений и другие настройки, которые читаются при запуске, применяются после перезапуска.
+    Рассылки для новых парковок тоже начнутся после перезапуска
+    """
+    async with config_reload_lock:
+        try:
+            settings = reload_settings()
+            spots_counts, users_counts = await run_in_db(import_config, settings)
+        except Exception as error:
+            print(f"Не удалось перечитать {SETTINGS_FILE}, остаются прежние настройки: {error}")
+            return False
+
+        await reload_availability()
+        await allocate_all_spots()
+
+    spots_added, spots_reactivated, spots_deactivated = spots_counts
+    users_added, users_updated, users_removed = users_counts
+    print(
+        f"Настройки перечитаны. Места: добавлено {spots_added}, включено {spots_reactivated}, "
+        f"выключено {spots_deactivated}. "
+        f"Пользователи: добавлено {users_added}, обновлено {users_updated}, удалено {users_removed}"
+    )
+    return True
+
+
+def get_settings_mtime() -> Optional[float]:
+    try:
+        return os.stat(SETTINGS_FILE).st_mtime
+    except OSError:
+        return None
+
+
+async def watch_settings_file(interval_seconds: float) -> None:
+    """ Перечитывает настройки, когда меняется время изменения settings.yml """
+    known_mtime = get_settings_mtime()
+    while True:
+        await asyncio.sleep(interval_seconds)
+        mtime = get_settings_mtime()
+        if mtime is not None and mtime != known_mtime:
+            known_mtime = mtime
+            await reload_config()
+
+
+def get_auditors_report_date(lot: ParkingLot) -> date:
+    """ Аудиторы получают отчёт за сегодня до дедлайна парковки, после него - за завтра """
+    current_date = date.today()
+
+    if datetime.now().hour >= lot.today_deadline_clock_for_auditors:
+        return current_date + timedelta(days=1)
+    return current_date
+
+
+async def run_daily(clock: str, job, *args) -> None:
+    """
+    Запускает job(*args) каждый день в указанное время (ЧЧ:ММ).
+    Запуски, пропущенные пока бот был остановлен, не догоняются
+    """
+    run_at = datetime.strptime(clock, "%H:%M").time()
+
+    while True:
+        now = datetime.now()
+        next_run = datetime.combine(now.date(), run_at)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+        try:
+            await job(*args)
+        except Exception as error:
+            print(f"Ошибка ежедневной задачи {job.__name__}: {error}")
+
+
+async def broadcast(chat_ids: list[int], send) -> int:
+    """
+    Рассылка пачками: send(chat_id) - корутина отправки одному получателю.
+    Темп отправки держит очередь исходящих сообщений, а если она выключена - пауза между пачками.
+    Возвращает количество получателей, которым удалось отправить
+    """
+    batch_size = get_settings().section('DIGESTS').get('BATCH_SIZE', 25)
+    sent_count = 0
+
+    for batch_start in range(0, len(chat_ids), batch_size):
+        batch = chat_ids[batch_start:batch_start + batch_size]
+        results = await asyncio.gather(*(send(chat_id) for chat_id in batch), return_exceptions=True)
+
+        for chat_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось отправить рассылку в чат {chat_id}: {result}")
+            else:
+                sent_count += 1
+
+        if outgoing_queue is None:
+            await asyncio.sleep(1)
+
+    return sent_count
+
+
+async def send_auditors_digest(lot_id: int) -> None:
+    """ Утренний отчёт по броням парковки для тех, кому доступен отчёт. Считается один раз на всех получателей """
+    lot = parking_lots.get(lot_id)
+    if lot is None:
+        return
+    report_date = get_auditors_report_date(lot)
+    report_messages = await run_in_db(build_day_report, lot_id, report_date)
+
+    recipients = [
+        user.telegram_id for user in User.get_cached_users()
+        if user.lot_id_id == lot_id and user.get_role_name() in (ROLE_ADMINISTRATOR, ROLE_AUDITOR)
+    ]
+    sent_count = await broadcast(recipients, lambda chat_id: send_report(chat_id, report_messages, remove_keyboard=False))
+    print(f"Отчёт по парковке {lot.name} на {report_date} разослан: {sent_count} из {len(recipients)}")
+
+
+async def send_clients_reminder(lot_id: int) -> None:
+    """ Напоминание о свободных местах парковки тем, кто может бронировать, но ещё не забронировал """
+    lot = parking_lots.get(lot_id)
+    if lot is None:
+        return
+    booking_date = get_first_booking_date(lot)
+    if booking_date > get_last_open_date(lot):
+        return
+    available_spots, inline_keyboard = await get_booking_options_with_keyboard(lot_id, booking_date)
+    if len(available_spots) == 0:
+        return
+
+    booked_user_ids = await run_in_db(Reservation.get_booked_user_ids, lot_id, booking_date)
+    recipients = [
+        user.telegram_id for user in User.get_cached_users()
+        if user.lot_id_id == lot_id
+        and user.get_role_name() in (ROLE_ADMINISTRATOR, ROLE_CLIENT) and user.id not in booked_user_ids
+    ]
+    text = DIGEST_CLIENTS_MESSAGE.format(booking_date, len(available_spots))
+
+    sent_count = await broadcast(
+        recipients,
+        lambda chat_id: bot.send_message(chat_id=chat_id, text=text, reply_markup=inline_keyboard)
+    )
+    print(
+        f"Напоминание о свободных местах парковки {lot.name} на {booking_date} разослано: "
+        f"{sent_count} из {len(recipients)}"
+    )
+
+
+async def allocate_spots(lot_id: int) -> None:
+    """
+    Раздаёт места парковки на открывшуюся дату по заявкам, открывает дату для бронирования и рассылает результаты.
+    Запускается в дедлайн парковки, а для надёжности ещё при старте и при каждой сверке индексов:
+    если распределение уже прошло, заявок на дату нет и вызов ничего не делает
+    """
+    lot = parking_lots.get(lot_id)
+    if lot is None:
+        return
+    allocation_settings = get_settings().section('ALLOCATION')
+    booking_date = get_first_booking_date(lot)
+    result = await run_in_db(
+        allocate,
+        lot_id,
+        booking_date,
+        policy=allocation_settings.get('POLICY', "random"),
+        usage_days=allocation_settings.get('USAGE_DAYS', 30),
+        role_priority=allocation_settings.get('ROLE_PRIORITY', [ROLE_ADMINISTRATOR, ROLE_CLIENT])
+    )
+    """ Брони по заявкам уже записаны, поэтому дату можно открывать для обычного бронирования """
+    allocated_dates[lot_id] = max(allocated_dates.get(lot_id, date.min), booking_date)
+    if result is None:
+        return
+
+    availability = get_availability(lot_id)
+    texts = {}
+    for user, spot in result.winners:
+        availability.mark_booked(result.booking_date, spot.id)
+        texts[user.telegram_id] = ALLOCATION_WON_MESSAGE.format(spot.name, result.booking_date)
+    for user in result.waitlisted:
+        texts[user.telegram_id] = ALLOCATION_WAITLISTED_MESSAGE.format(result.booking_date)
+
+    sent_count = await broadcast(list(texts), lambda chat_id: bot.send_message(chat_id=chat_id, text=texts[chat_id]))
+    print(
+        f"Места парковки {lot.name} на {result.booking_date} распределены: получили {len(result.winners)}, "
+        f"в очереди {len(result.waitlisted)}. Результаты разосланы: {sent_count} из {len(texts)}"
+    )
+
+
+async def allocate_all_spots() -> None:
+    """ Распределение по всем парковкам. Ошибка на одной парковке не мешает остальным """
+    if not is_allocation_enabled():
+        return
+    for lot_id in list(parking_lots):
+        try:
+            await allocate_spots(lot_id)
+        except Exception as error:
+            print(f"Ошибка распределения мест: {error}")
+
+
+async def roll_up_occupancy() -> None:
+    """ Сворачивает брони прошедших дней для статистики, чтобы запрос статистики не делал этого сам """
+    rolled_count = await run_in_db(roll_up, date.today())
+    if rolled_count > 0:
+        print(f"Свёрнуто дней для статистики: {rolled_count}")
+
+
+@dp.startup()
+async def on_startup() -> None:
+    if hasattr(dp.storage, 'purge_expired'):
+        start_background_task(purge_expired_states_periodically())
+    start_background_task(optimize_db_periodically())
+    await reload_availability()
+    start_background_task(reconcile_availability_periodically())
+    settings = get_settings()
+
+    """ kill -HUP <pid> перечитывает места и пользователей из settings.yml """
+    if hasattr(signal, 'SIGHUP'):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: start_background_task(reload_config())
+        )
+    watch_seconds = settings.section('CONFIG_IMPORT').get('WATCH_SECONDS', 0)
+    if watch_seconds > 0:
+        start_background_task(watch_settings_file(watch_seconds))
+
+    if settings.section('RETENTION').get('ENABLED', False):
+        start_background_task(archive_reservations_periodically())
+    """ Дни, прошедшие пока бот был остановлен, сворачиваются сразу, дальше - раз в сутки """
+    start_background_task(roll_up_occupancy())
+    start_background_task(run_daily(settings.section('ANALYTICS').get('ROLLUP_TIME', "00:05"), roll_up_occupancy))
+    if is_allocation_enabled():
+        """
+        Места по заявкам раздаются в дедлайн парковки, когда открывается бронирование на следующую дату.
+        При старте распределение проходит до приёма обновлений: пока его нет, бронировать даты парковки нельзя
+        """
+        await allocate_all_spots()
+        for lot in parking_lots.values():
+            start_background_task(run_daily(f"{lot.today_deadline_clock_for_clients:02d}:00", allocate_spots, lot.id))
+    digest_settings = settings.section('DIGESTS')
+    if digest_settings.get('ENABLED', False):
+        """
+        У каждой парковки свои рассылки. По умолчанию отчёт приходит, когда брони клиентов парковки на сегодня закрыты,
+        а напоминание - за час до этого
+        """
+        for lot in parking_lots.values():
+            deadline_clock = lot.today_deadline_clock_for_clients
+            start_background_task(run_daily(
+                digest_settings.get('AUDITORS_TIME', f"{deadline_clock:02d}:00"),
+                send_auditors_digest,
+                lot.id
+            ))
+            start_background_task(run_daily(
+                digest_settings.get('CLIENTS_TIME', f"{(deadline_clock - 1) % 24:02d}:00"),
+                send_clients_reminder,
+                lot.id
+            ))
+
+
+@dp.shutdown()
+async def on_shutdown() -> None:
+    if outgoing_queue is not None and not await outgoing_queue.join(timeout=10):
+        print("Не все исходящие сообщения успели отправиться до остановки")
+    for task in list(background_tasks):
+        task.cancel()
+    await run_in_db(optimize_db)
+    close_db()
+
+
+def get_first_booking_date(lot: ParkingLot) -> date:
+    """ Ближайшая дата для бронирования на парковке: сегодня до её дедлайна, после него - завтра """
+    current_date = date.today()
+
+    if datetime.now().hour >= lot.today_deadline_clock_for_clients:
+        return current_date + timedelta(days=1)
+    return current_date
 
 
 async def send_refusal_unauthorized(message: Message):
     await message.answer(UNKNOWN_USER_MESSAGE_1)
 
 
+@functools.lru_cache(maxsize=None)
 def create_start_menu_keyboard(
         is_show_book_button: bool,
         is_show_report_button: bool,
         is_show_cancel_button: bool,
         is_show_adduser_button: bool = False,
         is_show_delete_user_button: bool = False,
-        is_show_free_spots_button: bool = False
+        is_show_free_spots_button: bool = False,
+        is_show_calendar_button: bool = False,
+        is_show_analytics_button: bool = False
 ) -> ReplyKeyboardMarkup:
-    """ Создаёт клавиатуру, которая будет выводиться на команду /start """
+    """ Создаёт клавиатуру, которая будет выводиться на команду /start. Каждый вариант строится один раз """
     book_button: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_1)
     report_button: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_2)
     cancel_reservation_button: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_3)
     add_user_button: KeyboardButton = KeyboardButton(text=TEXT_ADD_USER_BUTTON)
     delete_user_button: KeyboardButton = KeyboardButton(text=TEXT_DELETE_USER_BUTTON)
     show_free_spots: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_4)
+    calendar_button: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_5)
+    analytics_button: KeyboardButton = KeyboardButton(text=TEXT_BUTTON_6)
 
     buttons_list = []
 
@@ -143,6 +729,10 @@ def create_start_menu_keyboard(
         buttons_list.append([delete_user_button])
     if is_show_free_spots_button:
         buttons_list.append([show_free_spots])
+    if is_show_calendar_button:
+        buttons_list.append([calendar_button])
+    if is_show_analytics_button:
+        buttons_list.append([analytics_button])
 
     """ Создаем объект клавиатуры, добавляя в него кнопки """
     keyboard: ReplyKeyboardMarkup = ReplyKeyboardMarkup(
@@ -153,31 +743,9 @@ def create_start_menu_keyboard(
     return keyboard
 
 
-@dp.message(Command(commands=["start"]))
-async def process_start_command(message: Message, state: FSMContext):
-    """ Этот хэндлер обрабатывает команду "/start" """
-
-    """ Проверяем зарегистрирован ли пользователь """
-    if await is_user_unauthorized(message):
-
-        """ Проверяем, если этот пользователь уже обращался к боту, то заносить его повторно не нужно """
-        guest = Guest.select().where(
-            (Guest.username == message.from_user.username) &
-            (Guest.first_name == message.from_user.first_name) &
-            (Guest.last_name == message.from_user.last_name)
-        ).first()
-        if guest is None:
-            """ Добавляем нового гостя в БД """
-            new_guest = Guest.create(
-                username=message.from_user.username,
-                first_name=message.from_user.first_name,
-                last_name=message.from_user.last_name,
-                telegram_id=message.from_user.id
-            )
-            new_guest.save()
-
-        await send_refusal_unauthorized(message)
-        return 0
+@functools.lru_cache(maxsize=None)
+def get_start_menu_keyboard(user_role: str, has_booking: bool) -> ReplyKeyboardMarkup:
+    """ Меню для роли пользователя с учётом того, есть ли у него бронь на ближайшую дату """
 
     """ Переменные, указывающие на то, какие кнопки меню будут доступны в дальнейшем """
     show_book_button = False
@@ -186,61 +754,96 @@ async def process_start_command(message: Message, state: FSMContext):
     show_add_user_button = False
     show_delete_user_button = False
     show_free_spots_now = False
+    show_calendar_button = False
+    show_analytics_button = False
 
     """ Топорно пропишем полномочия на кнопки меню """
-    user_telegram_id = message.from_user.id
-    user_role = User.get_user_role(user_telegram_id)
-
     if user_role == ROLE_ADMINISTRATOR:
         show_book_button = True
         show_report_button = True
         show_add_user_button = True
         show_free_spots_now = True
         show_delete_user_button = True
+        show_calendar_button = True
+        show_analytics_button = True
     elif user_role == ROLE_AUDITOR:
         show_report_button = True
         show_free_spots_now = True
+        show_analytics_button = True
     elif user_role == ROLE_CLIENT:
         show_book_button = True
+        show_calendar_button = True
+
+    """ Если бронь есть, то показываем кнопку отмены, а кнопку бронирования убираем """
+    if has_booking:
+        show_cancel_button = True
+        show_book_button = False
+
+    return create_start_menu_keyboard(
+        show_book_button,
+        show_report_button,
+        show_cancel_button,
+        show_add_user_button,
+        show_delete_user_button,
+        show_free_spots_now,
+        show_calendar_button,
+        show_analytics_button
+    )
+
 
-    user_id = message.from_user.id
-    requester = User.get_user_by_id(user_id)
+"""
+Недавно записанные гости: telegram_id -> время записи (time.monotonic).
+Размер ограничен, чтобы волна незнакомцев не съела память: вытесняются самые старые записи
+"""
+recent_guests: OrderedDict[int, float] = OrderedDict()
 
+
+def is_guest_registration_needed(telegram_id: int) -> bool:
+    """ Нужно ли записывать гостя в БД: да, если он не обращался к боту в течение TTL """
+    now = time.monotonic()
+    registered_at = recent_guests.get(telegram_id)
+    if registered_at is not None and now - registered_at < get_settings().section('GUESTS').get('SEEN_TTL_MINUTES', 60) * 60:
+        return False
+
+    recent_guests[telegram_id] = now
+    recent_guests.move_to_end(telegram_id)
+    while len(recent_guests) > get_settings().section('GUESTS').get('SEEN_CACHE_SIZE', 10000):
+        recent_guests.popitem(last=False)
+    return True
+
+
+@dp.message(Command(commands=["start"]))
+async def process_start_command(message: Message, state: FSMContext):
+    """ Этот хэндлер обрабатывает команду "/start" """
+
+    """ Проверяем зарегистрирован ли пользователь """
+    requester = User.get_user_by_id(message.from_user.id)
     if requester is None:
-        print("Ошибка")
-        return 0
 
-    current_date = date.today()
-    current_time = datetime.now().time()
+        """ Запоминаем гостя в БД. Повторные /start того же гостя в течение TTL в БД не ходят """
+        if is_guest_registration_needed(message.from_user.id):
+            await run_in_db(
+                Guest.register_guest,
+                username=message.from_user.username,
+                first_name=message.from_user.first_name,
+                last_name=message.from_user.last_name,
+                telegram_id=message.from_user.id,
+                max_guests=get_settings().section('GUESTS').get('MAX_STORED', 500)
+            )
 
-    if current_time.hour >= TODAY_DEADLINE_CLOCK_FOR_CLIENTS:
-        checking_date = current_date + timedelta(days=1)
-    else:
-        checking_date = current_date
+        await send_refusal_unauthorized(message)
+        return 0
 
-    """ Проверяем есть ли у пользователя уже брони на текущую дату """
-    reserved_spots = Reservation.select().where(
-        Reservation.booking_date == checking_date,
-        Reservation.user_id == requester.id
-    ).count()
+    checking_date = get_first_booking_date(requester.get_lot())
 
-    """ Если есть, то показываем кнопку отмены, а кнопку бронирования убираем """
-    if reserved_spots > 0:
-        show_cancel_button = True
-        show_book_button = False
+    """ Проверяем есть ли у пользователя уже брони на текущую дату """
+    reserved_spot = await run_in_db(Reservation.get_user_reservation, requester, checking_date)
 
     await state.clear()
 
     await message.answer(
         START_MESSAGE,
-        reply_markup=create_start_menu_keyboard(
-            show_book_button,
-            show_report_button,
-            show_cancel_button,
-            show_add_user_button,
-            show_delete_user_button,
-            show_free_spots_now
-        )
+        reply_markup=get_start_menu_keyboard(requester.get_role_name(), reserved_spot is not None)
     )
 
 
@@ -254,99 +857,114 @@ async def process_help_command(message: Message):
 async def process_answer_book(message: Message):
     """ Этот хэндлер срабатывает на просьбу забронировать место """
 
-    if await is_user_unauthorized(message):
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    user_id = message.from_user.id
-    if User.get_user_role(user_id) == ROLE_AUDITOR:
+    if requester.get_role_name() == ROLE_AUDITOR:
         await message.reply(
             ACCESS_IS_NOT_ALLOWED_MESSAGE
         )
         return 0
 
-    requester_id = message.from_user.id
-    requester = User.get_user_by_id(requester_id)
+    lot = requester.get_lot()
+    checking_date = get_first_booking_date(lot)
 
-    if requester is None:
-        print("Ошибка")
+    """ Дедлайн уже прошёл, а распределение на открывшуюся дату ещё идёт """
+    if checking_date > get_last_open_date(lot):
+        await message.reply(text=ALLOCATION_PENDING_MESSAGE.format(checking_date))
         return 0
 
-    current_date = date.today()
-    current_time = datetime.now().time()
+    reserved_place = await run_in_db(Reservation.get_user_reservation, requester, checking_date)
 
-    if current_time.hour >= TODAY_DEADLINE_CLOCK_FOR_CLIENTS:
-        checking_date = current_date + timedelta(days=1)
-    else:
-        checking_date = current_date
-
-    reservations_by_user_count = Reservation.select(Reservation, User).join(User).where(
-        Reservation.user_id == requester.id,
-        Reservation.user_id.first_name == requester.first_name,
-        Reservation.booking_date == checking_date
-    ).count()
-
-    if reservations_by_user_count > 0:
+    if reserved_place is not None:
         await message.reply(
             text=f"У Вас уже есть забронированное место:",
             reply_markup=ReplyKeyboardRemove()
         )
-        reserved_place = Reservation.get(
-            Reservation.booking_date == checking_date,
-            Reservation.user_id == requester.id
-        )
         await message.answer(
-            text=f"Место: {reserved_place.parking_spot_id.name}, дата: {reserved_place.booking_date}"
+            text=f"Место: {reserved_place.parking_spot_id.name}, дата: {reserved_place.booking_date}",
+            reply_markup=add_allocation_button(None, lot)
         )
         return 0
 
-    current_date = date.today()
-    current_time = datetime.now().time()
-
-    if current_time.hour >= TODAY_DEADLINE_CLOCK_FOR_CLIENTS:
-        date_for_book = current_date + timedelta(days=1)
-    else:
-        date_for_book = current_date
-
-    available_spots = ParkingSpot.get_booking_options(date_for_book)
+    available_spots, inline_keyboard = await get_booking_options_with_keyboard(requester.lot_id_id, checking_date)
 
+    """ В режиме распределения рядом с местами на ближайшую дату - кнопка заявки на следующую """
     if len(available_spots) > 0:
-        inline_keyboard = get_inline_keyboard_for_booking(available_spots, date_for_book)
-
         await message.reply(
             text=" ".join([DATE_REQUEST_MESSAGE, "на", str(checking_date)]),
-            reply_markup=inline_keyboard
+            reply_markup=add_allocation_button(inline_keyboard, lot)
         )
     else:
         await message.reply(
             text=f"Такс ...\nНа {checking_date}, {ALL_SPOT_ARE_BUSY_MESSAGE}",
-            reply_markup=ReplyKeyboardRemove()
+            reply_markup=add_allocation_button(get_inline_keyboard_for_waitlist(checking_date), lot)
         )
 
 
-@dp.callback_query(lambda c: c.data.startswith('book'))
-async def process_button_callback(callback_query: CallbackQuery):
-    """ Обработчик события нажатия на inline-кнопку с предлагаемой датой брони """
+"""
+Хэндлеры inline-кнопок по типу данных кнопки: тип -> (хэндлер, состояние диалога, хэндлер для другого состояния).
+Все нажатия приходят в один хэндлер process_callback_query, который разбирает callback_data
+и за одно обращение к словарю находит нужный хэндлер, вместо того чтобы проверять фильтры всех хэндлеров по очереди
+"""
+CallbackHandler = Callable[[CallbackQuery, CallbackPayload, FSMContext], Awaitable]
+callback_handlers: dict[type, tuple[CallbackHandler, Optional[State], Optional[CallbackHandler]]] = {}
 
-    """ Получаем данные из нажатой кнопки """
-    button_data = callback_query.data
-    query_data = button_data.split()
-    booking_spot = query_data[1]  # <- Выбранное парковочное место
-    booking_date = query_data[2]  # <- Выбранная дата бронирования
-    requester_username = callback_query.from_user.username
 
-    print("query_data: ", query_data)
+def callback_handler(payload_type: type, state: Optional[State] = None):
+    """ Регистрирует хэндлер кнопок payload_type. Если задано state, хэндлер срабатывает только в этом состоянии """
+    def register(handler: CallbackHandler) -> CallbackHandler:
+        callback_handlers[payload_type] = (handler, state, None)
+        return handler
+    return register
 
-    if requester_username == "":
-        requester_username = callback_query.from_user.first_name
 
-    all_spots = ParkingSpot.select()
-    booking_spot_obj = ParkingSpot.get_parking_spot_by_name(booking_spot, all_spots)
-    print("booking_spot_obj: ", booking_spot_obj)
-    if booking_spot_obj is None:
-        print("Ошибка. Парковочное место не найдено.")
+def callback_state_mismatch_handler(payload_type: type):
+    """ Регистрирует хэндлер кнопок payload_type для случая, когда диалог не в нужном состоянии """
+    def register(handler: CallbackHandler) -> CallbackHandler:
+        payload_handler, state, _ = callback_handlers[payload_type]
+        callback_handlers[payload_type] = (payload_handler, state, handler)
+        return handler
+    return register
+
+
+def resolve_callback_handler(payload: CallbackPayload, raw_state: Optional[str]) -> Optional[CallbackHandler]:
+    """ Хэндлер кнопки с учётом состояния диалога. None - нажатие в другом состоянии, для которого хэндлера нет """
+    handler, required_state, state_mismatch_handler = callback_handlers[type(payload)]
+    if required_state is not None and raw_state != required_state.state:
+        return state_mismatch_handler
+    return handler
+
+
+def get_callback_handler_name(callback_query: CallbackQuery, data: dict) -> Optional[str]:
+    """ Имя хэндлера кнопки для метрик: иначе все нажатия записывались бы как process_callback_query """
+    payload = decode_callback(callback_query.data)
+    handler = None if payload is None else resolve_callback_handler(payload, data.get("raw_state"))
+    return None if handler is None else handler.__name__
+
+
+@dp.callback_query()
+async def process_callback_query(callback_query: CallbackQuery, state: FSMContext, raw_state: Optional[str]):
+    payload = decode_callback(callback_query.data)
+    if payload is None:
+        """ Кнопка из старой версии бота или подделанные данные """
+        await callback_query.answer()
         return 0
 
+    handler = resolve_callback_handler(payload, raw_state)
+    if handler is None:
+        return 0
+    return await handler(callback_query, payload, state)
+
+
+@callback_handler(BookSpot)
+async def process_button_callback(callback_query: CallbackQuery, payload: BookSpot, state: FSMContext):
+    """ Обработчик события нажатия на inline-кнопку с предлагаемой датой брони """
+    booking_date_obj = payload.booking_date  # <- Выбранная дата бронирования
+    booking_date = str(booking_date_obj)
+
     requester_id = callback_query.from_user.id
     requester_user = User.get_user_by_id(requester_id)
 
@@ -356,18 +974,64 @@ async def process_button_callback(callback_query: CallbackQuery):
             text=UNKNOWN_ERROR_MESSAGE)
         return 0
 
-    """ Проверяем, что слот свободен. Если да, то создаём запись в БД """
-    if booking_spot_obj.is_spot_free(booking_date):
-        Reservation.create_reservation(
-            spot_id=booking_spot_obj.id,
-            date=booking_date,
-            user=requester_user
+    """ Кнопка могла прийти из сообщения до дедлайна, а дата ещё распределяется по заявкам """
+    if booking_date_obj > get_last_open_date(requester_user.get_lot()):
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=ALLOCATION_PENDING_MESSAGE.format(booking_date))
+        return 0
+
+    """
+    Место берём из индекса свободных мест парковки пользователя, в БД идём, только если его там нет.
+    Место с другой парковки не найдётся ни там, ни там
+    """
+    lot_id = requester_user.lot_id_id
+    availability = get_availability(lot_id)
+    booking_spot_obj = availability.spots.get(payload.spot_id)
+    if booking_spot_obj is None:
+        booking_spot_obj = await run_in_db(
+            ParkingSpot.get_or_none,
+            (ParkingSpot.id == payload.spot_id) & (ParkingSpot.lot_id == lot_id) & ParkingSpot.is_active
         )
+    if booking_spot_obj is None:
+        print("Ошибка. Парковочное место не найдено.")
+        return 0
+
+    """ Бронируем одним запросом. Занятость места проверяет уникальный индекс в БД """
+    booking_result = await run_in_db(
+        Reservation.book_spot,
+        spot_id=booking_spot_obj.id,
+        booking_date=booking_date_obj,
+        user=requester_user
+    )
+
+    if booking_result == BookingResult.ALREADY_BOOKED:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=ALREADY_BOOKED_MESSAGE)
+        return 0
+
+    """ Место занято: либо нами, либо кем-то раньше, и тогда индекс был устаревшим """
+    availability.mark_booked(booking_date_obj, booking_spot_obj.id)
+
+    if booking_result == BookingResult.SPOT_TAKEN:
+        """ Место успели занять. Сразу предлагаем оставшиеся свободные """
+        available_spots, inline_keyboard = await get_booking_options_with_keyboard(lot_id, booking_date_obj)
+        if len(available_spots) > 0:
+            await callback_query.message.edit_text(
+                text=" ".join([SPOT_TAKEN_MESSAGE, DATE_REQUEST_MESSAGE, "на", booking_date]),
+                reply_markup=inline_keyboard
+            )
+        else:
+            await callback_query.message.edit_text(
+                text=f"{SPOT_TAKEN_MESSAGE}\nНа {booking_date}, {ALL_SPOT_ARE_BUSY_MESSAGE}",
+                reply_markup=get_inline_keyboard_for_waitlist(booking_date_obj)
+            )
+        await callback_query.answer(text=SPOT_TAKEN_MESSAGE)
+        return 0
 
     """ Отправляем ответ пользователю """
     await bot.send_message(
         chat_id=callback_query.message.chat.id,
-        text=f'Хорошо 😊 \nЗабронировала Вам место "{booking_spot}" на {booking_date}',
+        text=f'Хорошо 😊 \nЗабронировала Вам место "{booking_spot_obj.name}" на {booking_date}',
         reply_markup=ReplyKeyboardRemove()
     )
 
@@ -382,85 +1046,197 @@ async def process_button_callback(callback_query: CallbackQuery):
     )
 
 
-if __name__ == '__main__':
-    dp.run_polling(bot)
-
-
 def run_bot():
     print("Запускаю бота...")
-    dp.run_polling(bot)
+    settings = get_settings()
+    setup_bot()
+    if settings.get('UPDATES_MODE', 'polling') == 'webhook':
+        from webhook import run_webhook
+        run_webhook(dp, bot, settings.section('WEBHOOK'))
+    else:
+        dp.run_polling(bot)
+
+
+def get_user_display_name(username: Optional[str], first_name: Optional[str], last_name: Optional[str],
+                          is_deleted: bool = False) -> str:
+    """ Имя пользователя для отчётов: username, а если его нет - имя и фамилия """
+    if is_deleted:
+        return DELETED_USER_NAME
+    if (username == "") or (username is None):
+        return " ".join([name for name in (first_name, last_name) if name])
+    return username
+
+
+def iter_report_lines(report_rows: Iterator[tuple]) -> Iterator[str]:
+    """ Строки отчёта по броням из строк Reservation.get_report_rows """
+    for booking_date, spot_name, user_id, username, first_name, last_name in report_rows:
+        user_name = get_user_display_name(username, first_name, last_name, is_deleted=user_id is None)
+        yield f"Дата бронирования: {booking_date}. Место: {spot_name}. Пользователь: {user_name}.\n\n"
+
+
+def split_into_messages(lines: Iterator[str], prefix: str = "",
+                        max_length: int = TELEGRAM_MESSAGE_MAX_LENGTH) -> list[str]:
+    """ Собирает строки в сообщения, каждое из которых не длиннее max_length. Строки не разрываются """
+    messages = []
+    current_parts = [prefix]
+    current_length = len(prefix)
+    has_lines = False
+
+    for line in lines:
+        has_lines = True
+        if current_length + len(line) > max_length and current_length > 0:
+            messages.append("".join(current_parts))
+            current_parts = []
+            current_length = 0
+
+        """ Строку длиннее лимита приходится резать """
+        while len(line) > max_length:
+            messages.append(line[:max_length])
+            line = line[max_length:]
+
+        current_parts.append(line)
+        current_length += len(line)
+
+    if not has_lines:
+        return []
+
+    messages.append("".join(current_parts))
+    return messages
+
+
+def build_reservations_report(lot_id: int, since: date) -> list[str]:
+    """ Формирует отчёт по броням парковки в виде списка сообщений. Выполняется в пуле потоков БД """
+    return split_into_messages(
+        iter_report_lines(Reservation.get_report_rows(lot_id, since)),
+        prefix=BEFORE_SEND_REPORT_MESSAGE
+    )
+
+
+def build_day_report(lot_id: int, report_date: date) -> list[str]:
+    """ Отчёт по броням парковки на один день для утренней рассылки. Выполняется в пуле потоков БД """
+    return split_into_messages(
+        iter_report_lines(Reservation.get_report_rows(lot_id, report_date, report_date)),
+        prefix=DIGEST_AUDITORS_MESSAGE.format(report_date)
+    )
+
+
+def get_chart_bar(share: float) -> str:
+    """ Полоса текстовой диаграммы для доли от 0 до 1 """
+    filled = round(min(max(share, 0), 1) * CHART_WIDTH)
+    return "█" * filled + "░" * (CHART_WIDTH - filled)
+
+
+def get_percent(part: int, whole: int) -> int:
+    return round(part * 100 / whole) if whole > 0 else 0
+
+
+def iter_analytics_lines(stats: OccupancyStats) -> Iterator[str]:
+    """ Строки статистики загрузки: итог, диаграммы по дням недели и по местам, дни с бронью по пользователям """
+    yield ANALYTICS_MESSAGE.format(
+        stats.since, stats.until, get_percent(stats.booked_count, stats.capacity), stats.booked_count, stats.capacity
+    )
+
+    yield ANALYTICS_WEEKDAYS_TITLE
+    for weekday_name, (booked_count, capacity) in zip(WEEKDAY_NAMES, stats.by_weekday):
+        share = booked_count / capacity if capacity > 0 else 0
+        yield f"{weekday_name} {get_chart_bar(share)} {get_percent(booked_count, capacity)}%\n"
+
+    yield ANALYTICS_SPOTS_TITLE
+    for spot_name, booked_days in stats.by_spot:
+        yield (
+            f"{get_chart_bar(booked_days / stats.days_count)} {get_percent(booked_days, stats.days_count)}% "
+            f"{spot_name}\n"
+        )
+
+    yield ANALYTICS_USERS_TITLE
+    for user_id, username, first_name, last_name, booked_days in stats.by_user:
+        user_name = get_user_display_name(username, first_name, last_name, is_deleted=user_id is None)
+        yield f"{booked_days} - {user_name}\n"
+
+
+def build_analytics_report(lot_id: int, months: int) -> list[str]:
+    """
+    Статистика загрузки парковки в виде списка сообщений. Пустой список - если свёрнутых дней за период нет.
+    Выполняется в пуле потоков БД
+    """
+    stats = get_occupancy_stats(lot_id, months, date.today())
+    if stats.days_count == 0:
+        return []
+    return split_into_messages(iter_analytics_lines(stats))
+
+
+async def send_report(chat_id: int, report_messages: list[str], remove_keyboard: bool = True) -> None:
+    """
+    Отправляет отчёт сообщениями, а большой - файлом, чтобы не засыпать чат сообщениями.
+    remove_keyboard=False - для рассылки: она приходит сама по себе и не должна убирать клавиатуру пользователя
+    """
+    reply_markup = ReplyKeyboardRemove() if remove_keyboard else None
+    if len(report_messages) == 0:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=NO_RESERVATIONS_MESSAGE
+        )
+        return
+
+    if len(report_messages) > REPORT_MAX_MESSAGES:
+        report_file = BufferedInputFile(
+            "".join(report_messages).encode("utf-8"),
+            filename=f"report_{date.today()}.txt"
+        )
+        await bot.send_document(
+            chat_id=chat_id,
+            document=report_file,
+            caption=REPORT_FILE_MESSAGE,
+            reply_markup=reply_markup
+        )
+        return
+
+    for one_message in report_messages:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=one_message,
+            reply_markup=reply_markup
+        )
 
 
 @dp.message(F.text == TEXT_BUTTON_2)
 async def process_answer_send_report(message: Message):
     """ Обработчик запроса на выгрузку отчёта по занятым местам """
 
-    if await is_user_unauthorized(message):
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    user_id = message.from_user.id
-    if User.get_user_role(user_id) == ROLE_CLIENT:
+    if requester.get_role_name() == ROLE_CLIENT:
         await message.reply(
             ACCESS_IS_NOT_ALLOWED_MESSAGE
         )
         return 0
 
     """ Вычисление даты две недели назад """
-    two_weeks_ago = datetime.now() - timedelta(weeks=2)
-    """ Выполнение запроса на выборку """
-    reservations = Reservation.select().where(Reservation.booking_date >= two_weeks_ago)
-    report = ""
-    """ Вывод результатов """
-    for reservation in reservations:
-        try:
-            user_name = reservation.user_id.username
-        except DoesNotExist:
-            user_name = "[ДАННЫЕ УДАЛЕНЫ]"
-
-        if (user_name == "") or (user_name is None):
-            user_name = " ".join([reservation.user_id.first_name, reservation.user_id.last_name])
-        report += f"Дата бронирования: {reservation.booking_date}. "
-        report += f"Место: {reservation.parking_spot_id.name}. "
-        report += f"Пользователь: {user_name}.\n\n"
-
-    if report == "":
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=NO_RESERVATIONS_MESSAGE
-        )
-        return 0
-
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=f"{BEFORE_SEND_REPORT_MESSAGE}{report}",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    two_weeks_ago = date.today() - timedelta(weeks=2)
+    report_messages = await run_in_db(build_reservations_report, requester.lot_id_id, two_weeks_ago)
+    await send_report(message.chat.id, report_messages)
 
 
 @dp.message(F.text == TEXT_BUTTON_4)
 async def process_answer_free_spots(message: Message):
     """ Обработчик запроса на выгрузку отчёта по свободным местам """
 
-    if await is_user_unauthorized(message):
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    user_id = message.from_user.id
-    if User.get_user_role(user_id) == ROLE_CLIENT:
+    if requester.get_role_name() == ROLE_CLIENT:
         await message.reply(
             ACCESS_IS_NOT_ALLOWED_MESSAGE
         )
         return 0
 
-    current_date = date.today()
-    current_time = datetime.now().time()
-
-    if current_time.hour >= TODAY_DEADLINE_CLOCK_FOR_CLIENTS:
-        date_for_book = current_date + timedelta(days=1)
-    else:
-        date_for_book = current_date
-    available_spots = ParkingSpot.get_booking_options(date_for_book)
+    date_for_book = get_first_booking_date(requester.get_lot())
+    available_spots, _ = await get_booking_options_with_keyboard(requester.lot_id_id, date_for_book)
 
     spots_name = []
     for one_spot in available_spots:
@@ -474,39 +1250,191 @@ async def process_answer_free_spots(message: Message):
     )
 
 
-@dp.message(F.text == TEXT_BUTTON_3)
-async def process_cancel(message: Message):
-    """ Этот хэндлер срабатывает на просьбу отменить бронь """
-    if await is_user_unauthorized(message):
+@dp.message(F.text == TEXT_BUTTON_6)
+async def process_answer_analytics(message: Message):
+    """ Обработчик запроса статистики загрузки парковки за последние месяцы """
+
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    user_id = message.from_user.id
-    if User.get_user_role(user_id) == ROLE_AUDITOR:
+    if requester.get_role_name() == ROLE_CLIENT:
         await message.reply(
             ACCESS_IS_NOT_ALLOWED_MESSAGE
         )
         return 0
 
-    requester_id = message.from_user.id
-    requester = User.get_user_by_id(requester_id)
+    months = get_settings().section('ANALYTICS').get('MONTHS', 3)
+    report_messages = await run_in_db(build_analytics_report, requester.lot_id_id, months)
+    await send_report(message.chat.id, report_messages)
 
+
+def get_calendar_dates(first_date: date) -> list[date]:
+    """ Даты окна бронирования, начиная с first_date """
+    return [first_date + timedelta(days=offset) for offset in range(get_settings().reservation_period_days)]
+
+
+def get_open_calendar_dates(lot: ParkingLot, first_date: date) -> list[date]:
+    """
+    Даты, которые можно выбрать в календаре парковки. Даты, которые ещё будут распределяться по заявкам, не показываются.
+    Отбрасывается только хвост окна, поэтому номера дней в уже показанном календаре не сдвигаются
+    """
+    last_open_date = get_last_open_date(lot)
+    return [one_date for one_date in get_calendar_dates(first_date) if one_date <= last_open_date]
+
+
+def get_inline_keyboard_for_calendar(
+        dates: list[date],
+        occupancy: dict[date, tuple[int, bool]],
+        selected_offsets: list[int]) -> InlineKeyboardMarkup:
+    """
+    Календарь бронирования: одна кнопка на день.
+    В callback_data передаётся только смещение дня от первой даты календаря,
+    поэтому данные кнопки всегда укладываются в ограничение Telegram в 64 байта
+    """
+    rows = []
+
+    for offset, one_date in enumerate(dates):
+        free_count, is_booked_by_user = occupancy[one_date]
+        day_title = f"{one_date.strftime('%d.%m')} {WEEKDAY_NAMES[one_date.weekday()]}"
+
+        if is_booked_by_user:
+            text = f"🅿️ {day_title} - у Вас бронь"
+            callback_data = encode_callback(CalendarButton('n'))
+        elif free_count == 0:
+            text = f"{day_title} - мест нет"
+            callback_data = encode_callback(CalendarButton('n'))
+        else:
+            mark = "✅ " if offset in selected_offsets else ""
+            text = f"{mark}{day_title} - свободно {free_count}"
+            callback_data = encode_callback(CalendarButton('t', offset))
+
+        rows.append([InlineKeyboardButton(text=text, callback_data=callback_data)])
+
+    rows.append([InlineKeyboardButton(text=CALENDAR_BOOK_BUTTON, callback_data=encode_callback(CalendarButton('b')))])
+
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@dp.message(F.text == TEXT_BUTTON_5)
+async def process_answer_calendar(message: Message, state: FSMContext):
+    """ Этот хэндлер показывает календарь для бронирования на несколько дней """
+
+    requester = User.get_user_by_id(message.from_user.id)
     if requester is None:
-        print("Ошибка")
+        await send_refusal_unauthorized(message)
         return 0
 
-    current_date = date.today()
-    current_time = datetime.now().time()
+    if requester.get_role_name() == ROLE_AUDITOR:
+        await message.reply(
+            ACCESS_IS_NOT_ALLOWED_MESSAGE
+        )
+        return 0
 
-    if current_time.hour >= TODAY_DEADLINE_CLOCK_FOR_CLIENTS:
-        checking_date = current_date + timedelta(days=1)
-    else:
-        checking_date = current_date
+    first_date = get_first_booking_date(requester.get_lot())
+    dates = get_open_calendar_dates(requester.get_lot(), first_date)
+    if len(dates) == 0:
+        await message.reply(text=ALLOCATION_PENDING_MESSAGE.format(first_date))
+        return 0
+    occupancy = await run_in_db(Reservation.get_period_occupancy, requester, dates)
 
-    reservation_by_user = Reservation.select().where(
-        Reservation.user_id == requester.id,
-        Reservation.booking_date == checking_date
-    ).first()
+    await state.set_state(FSMFillForm.choose_booking_days)
+    await state.set_data({"calendar_start": first_date.isoformat(), "selected": []})
+
+    await message.answer(
+        text=CALENDAR_MESSAGE,
+        reply_markup=get_inline_keyboard_for_calendar(dates, occupancy, [])
+    )
+
+
+@callback_handler(CalendarButton, FSMFillForm.choose_booking_days)
+async def process_button_calendar(callback_query: CallbackQuery, payload: CalendarButton, state: FSMContext):
+    """ Обработчик кнопок календаря: выбор дней и бронирование выбранных """
+    action = payload.action
+
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None:
+        await callback_query.answer(text=UNKNOWN_USER_MESSAGE_1)
+        return 0
+
+    if action == 'n':
+        await callback_query.answer(text=CALENDAR_DAY_UNAVAILABLE_MESSAGE)
+        return 0
+
+    calendar_data = await state.get_data()
+    dates = get_open_calendar_dates(requester.get_lot(), date.fromisoformat(calendar_data["calendar_start"]))
+    selected_offsets = calendar_data["selected"]
+
+    if action == 't':
+        """ Отмечаем или снимаем отметку с дня """
+        offset = payload.offset
+        if offset in selected_offsets:
+            selected_offsets.remove(offset)
+        elif 0 <= offset < len(dates):
+            selected_offsets.append(offset)
+        await state.update_data(selected=selected_offsets)
+
+        occupancy = await run_in_db(Reservation.get_period_occupancy, requester, dates)
+        await callback_query.message.edit_reply_markup(
+            reply_markup=get_inline_keyboard_for_calendar(dates, occupancy, selected_offsets)
+        )
+        await callback_query.answer()
+        return 0
+
+    """ Бронируем все выбранные дни одной транзакцией """
+    if len(selected_offsets) == 0:
+        await callback_query.answer(text=CALENDAR_NOTHING_SELECTED_MESSAGE)
+        return 0
+
+    selected_dates = [dates[offset] for offset in sorted(selected_offsets) if offset < len(dates)]
+    booking_results = await run_in_db(
+        Reservation.book_days, requester, selected_dates, get_last_open_date(requester.get_lot())
+    )
+    availability = get_availability(requester.lot_id_id)
+    for booking_date, (booking_result, spot) in booking_results.items():
+        if booking_result == BookingResult.BOOKED:
+            availability.mark_booked(booking_date, spot.id)
+    await state.clear()
+
+    result_lines = []
+    for booking_date, (booking_result, spot) in booking_results.items():
+        if booking_result == BookingResult.BOOKED:
+            result_lines.append(f"{booking_date} - место {spot.name}")
+        elif booking_result == BookingResult.ALREADY_BOOKED:
+            result_lines.append(f"{booking_date} - у Вас уже есть бронь")
+        elif booking_result == BookingResult.CLOSED:
+            result_lines.append(f"{booking_date} - места распределяются по заявкам")
+        else:
+            result_lines.append(f"{booking_date} - {ALL_SPOT_ARE_BUSY_MESSAGE}")
+
+    await callback_query.message.edit_text(text=CALENDAR_RESULT_MESSAGE + "\n".join(result_lines))
+    await callback_query.answer(text=SUCCESS_MESSAGE)
+
+
+@callback_state_mismatch_handler(CalendarButton)
+async def process_button_calendar_expired(callback_query: CallbackQuery, payload: CalendarButton, state: FSMContext):
+    """ Нажатие на кнопку календаря, диалог которого уже завершён """
+    await callback_query.answer(text=CALENDAR_EXPIRED_MESSAGE)
+
+
+@dp.message(F.text == TEXT_BUTTON_3)
+async def process_cancel(message: Message):
+    """ Этот хэндлер срабатывает на просьбу отменить бронь """
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
+        await send_refusal_unauthorized(message)
+        return 0
+
+    if requester.get_role_name() == ROLE_AUDITOR:
+        await message.reply(
+            ACCESS_IS_NOT_ALLOWED_MESSAGE
+        )
+        return 0
+
+    checking_date = get_first_booking_date(requester.get_lot())
+
+    reservation_by_user = await run_in_db(Reservation.get_user_reservation, requester, checking_date)
 
     if reservation_by_user is None:
         await message.answer(text="У Вас нет брони")
@@ -514,7 +1442,7 @@ async def process_cancel(message: Message):
     else:
         one_button: InlineKeyboardButton = InlineKeyboardButton(
             text="Отменить",
-            callback_data=f'cancel {reservation_by_user.id}')
+            callback_data=encode_callback(CancelReservation(reservation_by_user.id)))
 
         """ Создаем объект инлайн-клавиатуры """
         keyboard: InlineKeyboardMarkup = InlineKeyboardMarkup(
@@ -526,23 +1454,29 @@ async def process_cancel(message: Message):
         )
 
 
-@dp.callback_query(lambda c: c.data.startswith('cancel'))
-async def process_button_cancel(callback_query: CallbackQuery):
-    """ Получаем данные из нажатой кнопки """
-    button_data = callback_query.data
-    query_data = button_data.split()
-    reservation_id = query_data[1]
-    Reservation.delete().where(Reservation.id == reservation_id).execute()
+@callback_handler(CancelReservation)
+async def process_button_cancel(callback_query: CallbackQuery, payload: CancelReservation, state: FSMContext):
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None:
+        await callback_query.answer(text=ACCESS_IS_NOT_ALLOWED_MESSAGE)
+        return 0
 
-    await callback_query.answer(
-        text=CANCEL_SUCCESS_MESSAGE,
-        reply_markup=ReplyKeyboardRemove()
+    """ Номер брони пришёл из кнопки, поэтому отменяется только бронь самого нажавшего на его парковке """
+    cancelled_reservation, new_owner = await run_in_db(
+        Reservation.cancel_and_reassign, payload.reservation_id, requester
     )
+    if cancelled_reservation is None:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=CANCEL_NOT_FOUND_MESSAGE)
+        return 0
 
-    await callback_query.answer(
-        text="Успешно",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    """ Если место сразу отдали ожидающему в очереди, свободным оно так и не становится """
+    if new_owner is None:
+        get_availability(cancelled_reservation.lot_id_id).mark_free(
+            cancelled_reservation.booking_date, cancelled_reservation.parking_spot_id_id
+        )
+
+    await callback_query.answer(text=CANCEL_SUCCESS_MESSAGE)
 
     """ Отправляем ответ пользователю """
     await bot.send_message(
@@ -551,25 +1485,134 @@ async def process_button_cancel(callback_query: CallbackQuery):
         reply_markup=ReplyKeyboardRemove()
     )
 
+    """ Сообщаем ожидавшему в очереди, что место теперь его """
+    if new_owner is not None:
+        await bot.send_message(
+            chat_id=new_owner.telegram_id,
+            text=WAITLIST_ASSIGNED_MESSAGE.format(
+                cancelled_reservation.parking_spot_id.name, cancelled_reservation.booking_date
+            )
+        )
+
+
+@callback_handler(SpotsPage)
+async def process_button_spots_page(callback_query: CallbackQuery, payload: SpotsPage, state: FSMContext):
+    """ Переход на другую страницу клавиатуры свободных мест """
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None or requester.get_role_name() == ROLE_AUDITOR:
+        await callback_query.answer(text=ACCESS_IS_NOT_ALLOWED_MESSAGE)
+        return 0
+
+    booking_date = payload.booking_date
+    lot = requester.get_lot()
+    if booking_date < get_first_booking_date(lot):
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=WAITLIST_EXPIRED_MESSAGE)
+        return 0
+    if booking_date > get_last_open_date(lot):
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=ALLOCATION_PENDING_MESSAGE.format(booking_date))
+        return 0
+
+    """ Список мест берётся из того же кэша, что и первая страница, собирается только сама страница """
+    available_spots, _ = await get_booking_options_with_keyboard(requester.lot_id_id, booking_date)
+    if len(available_spots) > 0:
+        keyboard = get_inline_keyboard_for_booking(available_spots, booking_date, payload.page)
+    else:
+        keyboard = get_inline_keyboard_for_waitlist(booking_date)
+    await callback_query.message.edit_reply_markup(reply_markup=add_allocation_button(keyboard, lot))
+    await callback_query.answer()
+
+
+@callback_handler(JoinWaitlist)
+async def process_button_waitlist(callback_query: CallbackQuery, payload: JoinWaitlist, state: FSMContext):
+    """ Постановка в очередь на дату, на которую все места заняты """
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None or requester.get_role_name() == ROLE_AUDITOR:
+        await callback_query.answer(text=ACCESS_IS_NOT_ALLOWED_MESSAGE)
+        return 0
+
+    booking_date = payload.booking_date
+    if booking_date < get_first_booking_date(requester.get_lot()):
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=WAITLIST_EXPIRED_MESSAGE)
+        return 0
+
+    """ До распределения в очередь не встают: иначе она обгоняла бы тех, кто оставил заявку """
+    if booking_date > get_last_open_date(requester.get_lot()):
+        await callback_query.answer(text=ALLOCATION_PENDING_MESSAGE.format(booking_date))
+        return 0
+
+    """ Пока пользователь думал, место могло освободиться - тогда просто предлагаем его """
+    available_spots, inline_keyboard = await get_booking_options_with_keyboard(requester.lot_id_id, booking_date)
+    if len(available_spots) > 0:
+        await callback_query.message.edit_text(
+            text=" ".join([DATE_REQUEST_MESSAGE, "на", str(booking_date)]),
+            reply_markup=inline_keyboard
+        )
+        await callback_query.answer()
+        return 0
+
+    position = await run_in_db(WaitlistEntry.add_user, requester, booking_date)
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+
+    if position is None:
+        await callback_query.answer(text=ALREADY_BOOKED_MESSAGE)
+        return 0
+
+    await callback_query.answer()
+    await bot.send_message(
+        chat_id=callback_query.message.chat.id,
+        text=WAITLIST_JOINED_MESSAGE.format(booking_date, position)
+    )
+
+
+@callback_handler(RequestAllocation)
+async def process_button_allocation(callback_query: CallbackQuery, payload: RequestAllocation, state: FSMContext):
+    """ Заявка на место в распределении, которое пройдёт в дедлайн парковки """
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None or requester.get_role_name() == ROLE_AUDITOR:
+        await callback_query.answer(text=ACCESS_IS_NOT_ALLOWED_MESSAGE)
+        return 0
+
+    """ Кнопка со вчерашнего сообщения или распределение выключили - заявку не принимаем """
+    lot = requester.get_lot()
+    if not is_allocation_enabled() or payload.booking_date != get_allocation_date(lot):
+        await callback_query.answer(text=ALLOCATION_CLOSED_MESSAGE)
+        return 0
+
+    requests_count = await run_in_db(AllocationRequest.add_user, requester, payload.booking_date)
+    if requests_count is None:
+        await callback_query.answer(text=ALREADY_BOOKED_MESSAGE)
+        return 0
+
+    await callback_query.answer()
+    await bot.send_message(
+        chat_id=callback_query.message.chat.id,
+        text=ALLOCATION_REQUESTED_MESSAGE.format(
+            payload.booking_date, requests_count, lot.today_deadline_clock_for_clients
+        )
+    )
+
 
 # Этот хэндлер будет срабатывать на команду добавления нового пользователя в состоянии по умолчанию
 @dp.message(F.text == TEXT_ADD_USER_BUTTON, StateFilter(default_state))
 async def process_adduser_command(message: Message, state: FSMContext):
-    if await is_user_unauthorized(message):
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    user_id = message.from_user.id
-    if User.get_user_role(user_id) == ROLE_AUDITOR:
+    if requester.get_role_name() == ROLE_AUDITOR:
         await message.reply(
             ACCESS_IS_NOT_ALLOWED_MESSAGE
         )
         return 0
 
-    guests = Guest.select()
+    guests, guests_count = await run_in_db(Guest.get_guests_page, 0, get_settings().section('GUESTS').get('PAGE_SIZE', 10))
 
     """ Если не было гостей, то выводим сообщение """
-    if len(guests) == 0:
+    if guests_count == 0:
         await bot.send_message(
             chat_id=message.chat.id,
             text=NO_GUESTS_MESSAGE,
@@ -577,52 +1620,73 @@ async def process_adduser_command(message: Message, state: FSMContext):
         )
         return 0
 
-    for guest in guests:
-        pass
+    text, keyboard = get_guests_page_message(guests, guests_count, 0)
+    await message.answer(
+        text=text,
+        reply_markup=keyboard
+    )
 
-    buttons_list = []
+    await state.set_state(FSMFillForm.add_user)
 
-    """ Создаём кнопку для каждого пользователя в таблице guests """
-    for guest in guests:
-        one_button: InlineKeyboardButton = InlineKeyboardButton(
-            text=str(guest),
-            callback_data=f'adduser {guest.id}')
-        buttons_list.append(one_button)
 
-    """ Создаем объект инлайн-клавиатуры """
-    keyboard: InlineKeyboardMarkup = InlineKeyboardMarkup(
-        inline_keyboard=[buttons_list])
+def get_guests_page_message(guests: list[Guest], guests_count: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """ Страница выбора гостя: по гостю в ряду и кнопки перехода между страницами """
+    page_size = get_settings().section('GUESTS').get('PAGE_SIZE', 10)
+    pages_count = max(1, (guests_count + page_size - 1) // page_size)
 
-    await message.answer(
-        text="Ко мне обращались следующие пользователи:\n",
+    """ Создаём кнопку для каждого гостя на странице """
+    rows = [
+        [InlineKeyboardButton(text=str(guest), callback_data=encode_callback(ChooseGuest(guest.id)))]
+        for guest in guests
+    ]
+
+    navigation_buttons = []
+    if page > 0:
+        navigation_buttons.append(
+            InlineKeyboardButton(text=GUESTS_PREVIOUS_PAGE_BUTTON, callback_data=encode_callback(GuestsPage(page - 1))))
+    if page < pages_count - 1:
+        navigation_buttons.append(
+            InlineKeyboardButton(text=GUESTS_NEXT_PAGE_BUTTON, callback_data=encode_callback(GuestsPage(page + 1))))
+    if navigation_buttons:
+        rows.append(navigation_buttons)
+
+    return GUESTS_PAGE_MESSAGE.format(page + 1, pages_count), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@callback_handler(GuestsPage, FSMFillForm.add_user)
+async def process_button_guests_page(callback_query: CallbackQuery, payload: GuestsPage, state: FSMContext):
+    """ Переход на другую страницу списка гостей """
+    page = max(0, payload.page)
+    guests, guests_count = await run_in_db(Guest.get_guests_page, page, get_settings().section('GUESTS').get('PAGE_SIZE', 10))
+
+    text, keyboard = get_guests_page_message(guests, guests_count, page)
+    await callback_query.message.edit_text(
+        text=text,
         reply_markup=keyboard
     )
-
-    await state.set_state(FSMFillForm.add_user)
+    await callback_query.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith('adduser'), StateFilter(FSMFillForm.add_user))
-async def process_button_addguest(callback_query: CallbackQuery, state: FSMContext):
+@callback_handler(ChooseGuest, FSMFillForm.add_user)
+async def process_button_addguest(callback_query: CallbackQuery, payload: ChooseGuest, state: FSMContext):
     """ Обрабатываем событие добавления нового пользователя """
-    button_data = callback_query.data
-    query_data = button_data.split()
-    guest_id = query_data[1]
+    guest_id = payload.guest_id
 
     buttons_list = []
     buttons_list.append(
         InlineKeyboardButton(
             text=str(ROLE_ADMINISTRATOR),
-            callback_data=f'addrole {guest_id} {ROLE_ADMINISTRATOR}')
+            callback_data=encode_callback(ChooseRole(guest_id, ROLE_ADMINISTRATOR)))
     )
     buttons_list.append(
         InlineKeyboardButton(
             text=str(ROLE_AUDITOR),
-            callback_data=f'addrole {guest_id} {ROLE_AUDITOR}')
+            callback_data=encode_callback(ChooseRole(guest_id, ROLE_AUDITOR)))
     )
     buttons_list.append(
         InlineKeyboardButton(
             text=str(ROLE_CLIENT),
-            callback_data=f'addrole {guest_id} {ROLE_CLIENT}')
+            callback_data=encode_callback(ChooseRole(guest_id, ROLE_CLIENT)))
     )
 
     """ Создаем объект инлайн-клавиатуры """
@@ -642,25 +1706,22 @@ async def process_button_addguest(callback_query: CallbackQuery, state: FSMConte
     )
 
 
-@dp.callback_query(lambda c: c.data.startswith('addrole'), StateFilter(FSMFillForm.add_user))
-async def process_button_choose_role(callback_query: CallbackQuery, state: FSMContext):
-    """ Обрабатываем событие добавления нового пользователя """
-    button_data = callback_query.data
-    query_data = button_data.split()
-    guest_id = query_data[1]
-    guest_role = query_data[2]
-
-    guest = Guest.get_by_id(guest_id)
-
-    new_user = User.create(
-        username=guest.username,
-        first_name=guest.first_name,
-        last_name=guest.last_name,
-        role_id=Role.select().where(Role.name == guest_role),
-        telegram_id=guest.telegram_id
-    )
-    new_user.save()
-    guest.delete_guest()
+@callback_handler(ChooseRole, FSMFillForm.add_user)
+async def process_button_choose_role(callback_query: CallbackQuery, payload: ChooseRole, state: FSMContext):
+    """ Обрабатываем событие добавления нового пользователя. Гость попадает на парковку того, кто его добавил """
+    requester = User.get_user_by_id(callback_query.from_user.id)
+    if requester is None:
+        await callback_query.answer(text=UNKNOWN_USER_MESSAGE_1)
+        return 0
+
+    """ Гостя могли вытеснить из списка или уже добавить повторным нажатием """
+    try:
+        await run_in_db(User.create_from_guest, payload.guest_id, payload.role, requester.lot_id_id)
+    except Guest.DoesNotExist:
+        await state.clear()
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.answer(text=GUEST_EXPIRED_MESSAGE)
+        return 0
 
     await callback_query.message.answer(text=USER_ADDED_SUCCESS_MESSAGE)
 
@@ -668,12 +1729,19 @@ async def process_button_choose_role(callback_query: CallbackQuery, state: FSMCo
 @dp.message(F.text == TEXT_DELETE_USER_BUTTON)
 async def process_delete_user(message: Message, state: FSMContext):
     """ Обработчик команды удаления пользователя """
-
-    if await is_user_unauthorized(message):
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
         await send_refusal_unauthorized(message)
         return 0
 
-    all_users_str = User.get_all_users()
+    if requester.get_role_name() != ROLE_ADMINISTRATOR:
+        await message.reply(
+            ACCESS_IS_NOT_ALLOWED_MESSAGE
+        )
+        return 0
+
+    """ Администратор видит и удаляет только пользователей своей парковки """
+    all_users_str = await run_in_db(User.get_all_users, requester.lot_id_id)
     all_users = "\n".join(all_users_str)
 
     await message.reply(text=TEXT_CHOOSE_USER_FOR_DELETE_MESSAGE, reply_markup=ReplyKeyboardRemove())
@@ -696,7 +1764,19 @@ async def process_delete_specific_user(message: Message, state: FSMContext):
         await state.clear()
         return 0
 
-    User.delete_user_by_id(user_input)
+    requester = User.get_user_by_id(message.from_user.id)
+    if requester is None:
+        await send_refusal_unauthorized(message)
+        await state.clear()
+        return 0
+
+    """ Роль могли сменить, пока диалог ждал ввода """
+    if requester.get_role_name() != ROLE_ADMINISTRATOR:
+        await message.reply(ACCESS_IS_NOT_ALLOWED_MESSAGE)
+        await state.clear()
+        return 0
+
+    await run_in_db(User.delete_user_by_id, user_input, requester.lot_id_id)
 
     await message.reply(text=TEXT_DELETE_USER_SUCCESS_MESSAGE)
     await state.clear()
@@ -0,0 +1,162 @@
+"""
+Данные inline-кнопок (callback_data).
+
+Каждый вид кнопки - датакласс с коротким кодом операции в OPCODE.
+Кнопка кодируется как код операции и значения полей через двоеточие: "b:2s:kq".
+Числа записываются в 36-ричной системе, даты - номером дня от DAY_EPOCH,
+поэтому данные кнопки короче, чем текст, и не зависят от названий мест.
+Telegram ограничивает callback_data 64 байтами - encode_callback проверяет это сразу при создании кнопки.
+decode_callback по коду операции за одно обращение к словарю находит тип кнопки и возвращает готовый объект.
+"""
+from dataclasses import dataclass, fields
+from datetime import date, timedelta
+from typing import ClassVar, Optional, Union
+
+""" Ограничение Telegram на размер callback_data """
+CALLBACK_DATA_MAX_BYTES = 64
+SEPARATOR = ":"
+""" День, от которого отсчитываются даты в кнопках """
+DAY_EPOCH = date(2024, 1, 1)
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+@dataclass(frozen=True)
+class BookSpot:
+    """ Бронирование места на день """
+    OPCODE: ClassVar[str] = "b"
+    spot_id: int
+    booking_date: date
+
+
+@dataclass(frozen=True)
+class SpotsPage:
+    """ Страница клавиатуры свободных мест на дату """
+    OPCODE: ClassVar[str] = "p"
+    booking_date: date
+    page: int
+
+
+@dataclass(frozen=True)
+class CancelReservation:
+    OPCODE: ClassVar[str] = "c"
+    reservation_id: int
+
+
+@dataclass(frozen=True)
+class JoinWaitlist:
+    OPCODE: ClassVar[str] = "w"
+    booking_date: date
+
+
+@dataclass(frozen=True)
+class RequestAllocation:
+    """ Заявка на место в распределении на дату """
+    OPCODE: ClassVar[str] = "a"
+    booking_date: date
+
+
+@dataclass(frozen=True)
+class CalendarButton:
+    """ Кнопка календаря бронирования: t - отметить день offset, b - забронировать отмеченные, n - день недоступен """
+    OPCODE: ClassVar[str] = "k"
+    action: str
+    offset: int = 0
+
+
+@dataclass(frozen=True)
+class GuestsPage:
+    OPCODE: ClassVar[str] = "g"
+    page: int
+
+
+@dataclass(frozen=True)
+class ChooseGuest:
+    OPCODE: ClassVar[str] = "u"
+    guest_id: int
+
+
+@dataclass(frozen=True)
+class ChooseRole:
+    OPCODE: ClassVar[str] = "r"
+    guest_id: int
+    role: str
+
+
+CallbackPayload = Union[
+    BookSpot, SpotsPage, CancelReservation, JoinWaitlist, RequestAllocation, CalendarButton, GuestsPage, ChooseGuest,
+    ChooseRole
+]
+
+PAYLOAD_TYPES: dict[str, type] = {
+    payload_type.OPCODE: payload_type
+    for payload_type in (
+        BookSpot, SpotsPage, CancelReservation, JoinWaitlist, RequestAllocation, CalendarButton, GuestsPage,
+        ChooseGuest, ChooseRole
+    )
+}
+
+""" Типы полей каждой кнопки по порядку. Аннотации в датаклассах - обычные классы, поэтому их можно брать как есть """
+PAYLOAD_FIELDS: dict[type, list[tuple[str, type]]] = {
+    payload_type: [(one_field.name, one_field.type) for one_field in fields(payload_type)]
+    for payload_type in PAYLOAD_TYPES.values()
+}
+
+
+def encode_number(number: int) -> str:
+    if number < 0:
+        return "-" + encode_number(-number)
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append(DIGITS[digit])
+        if number == 0:
+            return "".join(reversed(digits))
+
+
+def encode_value(value) -> str:
+    if isinstance(value, date):
+        return encode_number((value - DAY_EPOCH).days)
+    if isinstance(value, int):
+        return encode_number(value)
+    if SEPARATOR in value:
+        raise ValueError(f"Значение {value!r} в данных кнопки не должно содержать {SEPARATOR!r}")
+    return value
+
+
+def decode_value(text: str, value_type: type):
+    if value_type is date:
+        return DAY_EPOCH + timedelta(days=int(text, 36))
+    if value_type is int:
+        return int(text, 36)
+    return text
+
+
+def encode_callback(payload: CallbackPayload) -> str:
+    """ Данные кнопки для callback_data. Бросает ValueError, если они не укладываются в 64 байта """
+    data = SEPARATOR.join(
+        [payload.OPCODE] + [encode_value(getattr(payload, name)) for name, _ in PAYLOAD_FIELDS[type(payload)]]
+    )
+    if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+        raise ValueError(f"Данные кнопки длиннее {CALLBACK_DATA_MAX_BYTES} байт: {data}")
+    return data
+
+
+def decode_callback(data: Optional[str]) -> Optional[CallbackPayload]:
+    """ Объект кнопки из callback_data. None - если данные от неизвестной или устаревшей кнопки """
+    if not data:
+        return None
+    opcode, *values = data.split(SEPARATOR)
+    payload_type = PAYLOAD_TYPES.get(opcode)
+    if payload_type is None:
+        return None
+
+    payload_fields = PAYLOAD_FIELDS[payload_type]
+    if len(values) != len(payload_fields):
+        return None
+    try:
+        return payload_type(*[
+            decode_value(text, value_type) for text, (_, value_type) in zip(values, payload_fields)
+        ])
+    except (ValueError, OverflowError):
+        """ OverflowError - дата за пределами date, например, в подделанной кнопке """
+        return None
@@ -0,0 +1,146 @@
+"""
+Настройки бота из settings.yml.
+
+Файл читается один раз - при первом обращении к get_settings(), а не при импорте модулей.
+Обязательные параметры проверяются при чтении, остальные разделы доступны через section() и get().
+reload_settings() перечитывает файл: им пользуется перезагрузка мест и пользователей без перезапуска бота.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import yaml
+
+SETTINGS_FILE = 'settings.yml'
+
+ROLE_NAMES = ("ADMINISTRATOR", "AUDITOR", "CLIENT")
+
+""" Имя парковки, если в настройках задан только общий список PARKING_SPOTS """
+DEFAULT_LOT_NAME = "Парковка"
+
+
+@dataclass(frozen=True)
+class ParkingLotSettings:
+    name: str
+    parking_spots: list[str]
+    today_deadline_clock_for_clients: int
+    today_deadline_clock_for_auditors: int
+
+
+@dataclass(frozen=True)
+class Settings:
+    api_token: str
+    db_name: str
+    reservation_period_days: int
+    """ Парковки по порядку из настроек. Пользователи без парковки относятся к первой """
+    parking_lots: list[ParkingLotSettings]
+    """ У каждого пользователя в поле lot - имя его парковки """
+    users: list[dict]
+    """ Весь файл настроек - для необязательных разделов """
+    raw: dict = field(repr=False)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.raw.get(key, default)
+
+    def section(self, name: str) -> dict:
+        """ Раздел настроек (WEBHOOK, DATABASE, ...). Отсутствующий раздел - пустой словарь """
+        return self.raw.get(name) or {}
+
+
+def require(constants: dict, key: str, expected_type: type) -> Any:
+    if key not in constants:
+        raise ValueError(f"В {SETTINGS_FILE} не задан {key}")
+    value = constants[key]
+    if not isinstance(value, expected_type) or isinstance(value, bool):
+        raise ValueError(f"{key} в {SETTINGS_FILE} должен быть {expected_type.__name__}, а не {value!r}")
+    return value
+
+
+def require_clock(constants: dict, key: str) -> int:
+    clock = require(constants, key, int)
+    if not 0 <= clock <= 23:
+        raise ValueError(f"{key} в {SETTINGS_FILE} должен быть часом от 0 до 23, а не {clock}")
+    return clock
+
+
+def load_settings(path: str = SETTINGS_FILE) -> Settings:
+    """ Читает и проверяет файл настроек. При ошибке в файле бросает ValueError """
+    with open(path, 'r') as file:
+        constants = yaml.safe_load(file) or {}
+    if not isinstance(constants, dict):
+        raise ValueError(f"{path} должен содержать словарь настроек")
+
+    reservation_period_days = require(constants, 'RESERVATION_PERIOD_DAYS', int)
+    if reservation_period_days < 1:
+        raise ValueError(f"RESERVATION_PERIOD_DAYS в {path} должен быть больше 0")
+
+    parking_lots = load_parking_lots(constants)
+    lot_names = {lot.name for lot in parking_lots}
+
+    users = []
+    for user in constants.get('USERS') or []:
+        if not isinstance(user, dict) or not isinstance(user.get('telegram_id'), int):
+            raise ValueError(f"У пользователя {user!r} в USERS нет telegram_id")
+        if user.get('role') not in ROLE_NAMES:
+            raise ValueError(f"У пользователя {user['telegram_id']} в USERS неизвестная роль {user.get('role')!r}")
+        lot_name = str(user.get('lot') or parking_lots[0].name)
+        if lot_name not in lot_names:
+            raise ValueError(f"У пользователя {user['telegram_id']} в USERS неизвестная парковка {lot_name!r}")
+        users.append({**user, 'lot': lot_name})
+
+    return Settings(
+        api_token=require(constants, 'API_TOKEN', str),
+        db_name=require(constants, 'DB_NAME', str),
+        reservation_period_days=reservation_period_days,
+        parking_lots=parking_lots,
+        users=users,
+        raw=constants
+    )
+
+
+def load_parking_lots(constants: dict) -> list[ParkingLotSettings]:
+    """
+    Парковки из PARKING_LOTS. Без этого раздела - одна парковка с местами из PARKING_SPOTS.
+    Часы дедлайнов, не заданные у парковки, берутся из общих TODAY_DEADLINE_CLOCK_FOR_*
+    """
+    lots_constants = constants.get('PARKING_LOTS')
+    if not lots_constants:
+        lots_constants = [{'name': DEFAULT_LOT_NAME, 'PARKING_SPOTS': require(constants, 'PARKING_SPOTS', list)}]
+    if not isinstance(lots_constants, list):
+        raise ValueError(f"PARKING_LOTS в {SETTINGS_FILE} должен быть списком парковок")
+
+    parking_lots = []
+    for lot_constants in lots_constants:
+        if not isinstance(lot_constants, dict) or not lot_constants.get('name'):
+            raise ValueError(f"У парковки {lot_constants!r} в PARKING_LOTS нет name")
+        clocks = {
+            key: require_clock(lot_constants if key in lot_constants else constants, key)
+            for key in ('TODAY_DEADLINE_CLOCK_FOR_CLIENTS', 'TODAY_DEADLINE_CLOCK_FOR_AUDITORS')
+        }
+        parking_lots.append(ParkingLotSettings(
+            name=str(lot_constants['name']),
+            parking_spots=[str(name) for name in require(lot_constants, 'PARKING_SPOTS', list)],
+            today_deadline_clock_for_clients=clocks['TODAY_DEADLINE_CLOCK_FOR_CLIENTS'],
+            today_deadline_clock_for_auditors=clocks['TODAY_DEADLINE_CLOCK_FOR_AUDITORS']
+        ))
+
+    if len({lot.name for lot in parking_lots}) != len(parking_lots):
+        raise ValueError("Имена парковок в PARKING_LOTS должны быть разными")
+    return parking_lots
+
+
+settings: Optional[Settings] = None
+
+
+def get_settings() -> Settings:
+    """ Настройки, прочитанные один раз на весь процесс """
+    global settings
+    if settings is None:
+        settings = load_settings()
+    return settings
+
+
+def reload_settings() -> Settings:
+    """ Перечитывает файл настроек. Если файл с ошибкой, прежние настройки остаются в силе """
+    global settings
+    settings = load_settings()
+    return settings
@@ -1,20 +1,136 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Iterator
+import asyncio
+import functools
+import itertools
+import threading
+import time
+import csv
 import peewee
-import yaml
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from enum import Enum
 from peewee import *
+from playhouse.sqlite_ext import AutoIncrementField
 
-# Получаем данные из файла настроек
-with open('settings.yml', 'r') as file:
-    CONSTANTS = yaml.safe_load(file)
+from config import ParkingLotSettings, Settings, get_settings
 
-reservation_period_days = CONSTANTS['RESERVATION_PERIOD_DAYS']
-db_name = CONSTANTS['DB_NAME']
-db = SqliteDatabase(db_name)
 
-TODAY_DEADLINE_CLOCK_FOR_CLIENTS = CONSTANTS["TODAY_DEADLINE_CLOCK_FOR_CLIENTS"]
-TODAY_DEADLINE_CLOCK_FOR_AUDITORS = CONSTANTS["TODAY_DEADLINE_CLOCK_FOR_AUDITORS"]
+class ObservedSqliteDatabase(SqliteDatabase):
+    """ SqliteDatabase, который сообщает подписчикам текст и длительность каждого запроса """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_listeners = []
+
+    def execute_sql(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            for listener in self.query_listeners:
+                listener(sql, duration)
+
+
+def get_db_pragmas(db_settings: dict) -> list[tuple[str, object]]:
+    """ PRAGMA, которые применяются к каждому новому соединению с БД """
+    return [
+        # Действует только для новой БД и должна идти до journal_mode = wal.
+        # Существующую БД нужно один раз перестроить через VACUUM
+        ('auto_vacuum', db_settings.get('AUTO_VACUUM', 'incremental')),
+        ('journal_mode', db_settings.get('JOURNAL_MODE', 'wal')),
+        ('synchronous', db_settings.get('SYNCHRONOUS', 'normal')),
+        # Отрицательное значение cache_size задаётся в КиБ
+        ('cache_size', -1 * db_settings.get('CACHE_SIZE_KB', 16000)),
+        ('mmap_size', db_settings.get('MMAP_SIZE_MB', 64) * 1024 * 1024),
+        ('busy_timeout', db_settings.get('BUSY_TIMEOUT_MS', 5000)),
+    ]
+
+
+""" Файл БД и PRAGMA задаются в init_db, чтобы импорт модуля не читал настройки и не трогал БД """
+db = ObservedSqliteDatabase(None)
+is_wal_mode = False
+
+"""
+Все обращения к БД из хэндлеров выполняются в отдельном пуле потоков, чтобы не блокировать event loop.
+У каждого потока пула своё долгоживущее соединение с БД (peewee хранит соединения в thread-local).
+Соединение открывается сразу при старте потока, чтобы PRAGMA применялись один раз, а не при каждом запросе
+"""
+db_executor: Optional[ThreadPoolExecutor] = None
+db_workers_count = 0
+
+
+def open_worker_connection() -> None:
+    db.connect(reuse_if_open=True)
+
+
+def close_worker_connection(barrier: threading.Barrier) -> None:
+    """ Закрывает соединение своего потока и ждёт остальные потоки, чтобы каждый поток пула взял ровно одну задачу """
+    if not db.is_closed():
+        db.close()
+    try:
+        barrier.wait(timeout=5)
+    except threading.BrokenBarrierError:
+        pass
+
+
+def init_db(db_name: Optional[str] = None) -> None:
+    """ Открывает БД из настроек (или файл db_name) и создаёт пул потоков для запросов к ней """
+    global is_wal_mode, db_executor, db_workers_count
+    settings = get_settings()
+    db_settings = settings.section('DATABASE')
+    db.init(db_name or settings.db_name, pragmas=get_db_pragmas(db_settings))
+    is_wal_mode = str(db_settings.get('JOURNAL_MODE', 'wal')).lower() == 'wal'
+
+    if db_executor is None:
+        db_workers_count = settings.get('DB_WORKERS', 1)
+        db_executor = ThreadPoolExecutor(
+            max_workers=db_workers_count,
+            thread_name_prefix="db",
+            initializer=open_worker_connection
+        )
+
+
+""" Кэш авторизованных пользователей: telegram_id -> User (вместе с ролью) """
+users_cache: dict[int, User] = {}
+is_users_cache_loaded = False
+
+
+def optimize_db() -> None:
+    """ Обновляет статистику планировщика запросов и переносит журнал WAL в основной файл БД """
+    db.execute_sql('PRAGMA optimize')
+    if is_wal_mode:
+        db.execute_sql('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+def incremental_vacuum(pages: int) -> None:
+    """ Возвращает ОС до pages свободных страниц. Работает, только если в БД включён auto_vacuum = incremental """
+    if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        db.execute_sql(f'PRAGMA incremental_vacuum({int(pages)})')
+
+
+def close_db() -> None:
+    """
+    Дожидается завершения запросов в пуле потоков и закрывает соединения.
+    Соединения thread-local, поэтому каждый поток пула закрывает своё сам
+    """
+    global db_executor
+    if db_executor is not None:
+        barrier = threading.Barrier(db_workers_count)
+        for _ in range(db_workers_count):
+            db_executor.submit(close_worker_connection, barrier)
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if not db.is_closed():
+        db.close()
+
+
+async def run_in_db(func, *args, **kwargs):
+    """ Выполняет синхронную функцию работы с БД в пуле потоков и возвращает её результат """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
 
 """ Сущности, описывающие хранимые в БД записи """
 
@@ -24,67 +140,151 @@ class BaseModel(Model):
         database = db
 
 
-class ParkingSpot(BaseModel):
-    name = CharField()
+""" Сколько строк записывать одним INSERT и одной транзакцией при загрузке конфига """
+IMPORT_CHUNK_SIZE = 500
+
+
+class ParkingLot(BaseModel):
+    """ Парковка: у неё свои места, пользователи, брони и часы дедлайнов """
+    name = CharField(unique=True)
+    today_deadline_clock_for_clients = IntegerField()
+    today_deadline_clock_for_auditors = IntegerField()
 
     class Meta:
-        table_name = 'parking_spots'
+        table_name = 'parking_lots'
 
     def __repr__(self):
         return self.name
 
-    def get_name(self):
-        return self.name
-
     @staticmethod
-    def load_spots(spots_list: list) -> list:
-        """ Функция загрузки парковочных мест из конфига"""
-        spots_obj_array = []
+    def load_lots(lots: list[ParkingLotSettings]) -> dict[str, int]:
+        """
+        Добавляет парковки из конфига и обновляет у них часы дедлайнов.
+        Парковки, убранные из конфига, не удаляются (на них ссылаются брони), а их места выключает load_spots.
+        Возвращает id парковок по имени
+        """
+        existing_lots = {lot.name: lot for lot in ParkingLot.select()}
+
+        with db.atomic():
+            for lot_settings in lots:
+                clocks = (lot_settings.today_deadline_clock_for_clients, lot_settings.today_deadline_clock_for_auditors)
+                lot = existing_lots.get(lot_settings.name)
+                if lot is None:
+                    existing_lots[lot_settings.name] = ParkingLot.create(
+                        name=lot_settings.name,
+                        today_deadline_clock_for_clients=clocks[0],
+                        today_deadline_clock_for_auditors=clocks[1]
+                    )
+                elif (lot.today_deadline_clock_for_clients, lot.today_deadline_clock_for_auditors) != clocks:
+                    ParkingLot.update(
+                        today_deadline_clock_for_clients=clocks[0],
+                        today_deadline_clock_for_auditors=clocks[1]
+                    ).where(ParkingLot.id == lot.id).execute()
 
-        for one in spots_list:
-            spot_obj = ParkingSpot(name=one)
-            spots_obj_array.append(spot_obj)
-            spot_obj.save()
+        return {name: lot.id for name, lot in existing_lots.items()}
 
-        return spots_obj_array
+    @staticmethod
+    def get_all_lots() -> list[ParkingLot]:
+        return list(ParkingLot.select().order_by(ParkingLot.id))
 
-    def is_spot_free(self, checking_date) -> bool:
-        """ Проверка свободно ли парковочное место на определённую дату """
 
-        check_query = Reservation.select().where(
-            Reservation.booking_date == checking_date,
-            Reservation.parking_spot_id == self.id
+class ParkingSpot(BaseModel):
+    name = CharField()
+    """ Место, убранное из конфига, не удаляется (на него ссылаются брони), а перестаёт предлагаться """
+    is_active = BooleanField(default=True)
+    lot_id = ForeignKeyField(ParkingLot, backref='spots', index=False)
+
+    class Meta:
+        table_name = 'parking_spots'
+        indexes = (
+            # Места парковки; отдельный индекс по lot_id не нужен
+            (('lot_id', 'name'), False),
         )
 
-        if len(check_query) == 0:
-            return True
-        else:
-            return False
+    def __repr__(self):
+        return self.name
+
+    def get_name(self):
+        return self.name
 
     @staticmethod
-    def get_booking_options(date_for_book: date) -> list[ParkingSpot]:
-        """ Функция, получающая доступные для бронирования варианты """
+    def load_spots(spots_by_lot: dict[int, list]) -> tuple[int, int, int]:
+        """
+        Приводит места в БД к спискам из конфига (id парковки -> имена мест), сопоставляя их по парковке и имени.
+        Места парковок, которых нет в spots_by_lot, выключаются. Можно вызывать при каждом запуске.
+        Возвращает количество добавленных, снова включённых и выключенных мест
+        """
+        spot_keys = [
+            (lot_id, str(name)) for lot_id, spots_list in spots_by_lot.items() for name in dict.fromkeys(spots_list)
+        ]
+        existing_spots = {(spot.lot_id_id, spot.name): spot for spot in ParkingSpot.select()}
+
+        new_keys = [key for key in spot_keys if key not in existing_spots]
+        reactivated_ids = [
+            existing_spots[key].id for key in spot_keys
+            if key in existing_spots and not existing_spots[key].is_active
+        ]
+        spot_keys_set = set(spot_keys)
+        deactivated_ids = [
+            spot.id for key, spot in existing_spots.items()
+            if key not in spot_keys_set and spot.is_active
+        ]
+
+        for chunk in chunked(new_keys, IMPORT_CHUNK_SIZE):
+            with db.atomic():
+                ParkingSpot.insert_many(chunk, fields=[ParkingSpot.lot_id, ParkingSpot.name]).execute()
+        for is_active, spot_ids in ((True, reactivated_ids), (False, deactivated_ids)):
+            for chunk in chunked(spot_ids, IMPORT_CHUNK_SIZE):
+                with db.atomic():
+                    ParkingSpot.update(is_active=is_active).where(ParkingSpot.id.in_(chunk)).execute()
+
+        return len(new_keys), len(reactivated_ids), len(deactivated_ids)
 
-        available_spots_for_book = []
-        all_spots = ParkingSpot.select()
+    @staticmethod
+    def get_booking_options(lot_id: int, date_for_book: date) -> list[ParkingSpot]:
+        """ Функция, получающая доступные для бронирования места парковки одним запросом """
+        booked_spots = Reservation.select(Reservation.parking_spot_id).where(
+            Reservation.lot_id == lot_id,
+            Reservation.booking_date == date_for_book
+        )
 
-        for one_spot in all_spots:
-            if one_spot.is_spot_free(date_for_book):
-                available_spots_for_book.append(one_spot)
+        available_spots_for_book = ParkingSpot.select().where(
+            ParkingSpot.lot_id == lot_id,
+            ParkingSpot.is_active,
+            ParkingSpot.id.not_in(booked_spots)
+        ).order_by(ParkingSpot.id)
 
-        return available_spots_for_book
+        return list(available_spots_for_book)
 
     @staticmethod
-    def get_parking_spot_by_name(spot_name: str, all_spots: list[ParkingSpot]) -> Optional[ParkingSpot]:
-        check_query = ParkingSpot.select().where(
-            ParkingSpot.name == spot_name
-        )
-        if len(check_query) == 0:
-            return None
-        else:
-            for one_spot in all_spots:
-                if one_spot.name == spot_name:
-                    return one_spot
+    def get_booking_options_for_period(lot_id: int, dates_for_book: list[date]) -> dict[date, list[ParkingSpot]]:
+        """
+        Доступные для бронирования места парковки сразу на несколько дат.
+        Все места и все брони за период читаются за один проход, без запроса на каждую дату
+        """
+        if not dates_for_book:
+            return {}
+
+        all_spots = list(ParkingSpot.select().where(
+            ParkingSpot.lot_id == lot_id,
+            ParkingSpot.is_active
+        ).order_by(ParkingSpot.id))
+
+        booked_spots_ids = {one_date: set() for one_date in dates_for_book}
+        reservations = Reservation.select(Reservation.booking_date, Reservation.parking_spot_id).where(
+            Reservation.lot_id == lot_id,
+            Reservation.booking_date.between(min(dates_for_book), max(dates_for_book))
+        ).tuples()
+        for booking_date, spot_id in reservations:
+            if booking_date in booked_spots_ids:
+                booked_spots_ids[booking_date].add(spot_id)
+
+        available_spots_by_date = {}
+        for one_date in dates_for_book:
+            booked = booked_spots_ids[one_date]
+            available_spots_by_date[one_date] = [spot for spot in all_spots if spot.id not in booked]
+
+        return available_spots_by_date
 
 
 class Role(BaseModel):
@@ -97,16 +297,16 @@ class Role(BaseModel):
         return self.name
 
     @staticmethod
-    def load_roles(roles_list: list) -> list:
-        """ Запись в БД информации по ролям """
-        roles_obj_array = []
+    def load_roles(roles_list: list) -> int:
+        """ Добавляет в БД недостающие роли. Возвращает количество добавленных """
+        existing_names = {role.name for role in Role.select()}
+        new_names = [name for name in dict.fromkeys(roles_list) if name not in existing_names]
 
-        for one in roles_list:
-            role_obj = Role(name=one)
-            roles_obj_array.append(role_obj)
-            role_obj.save()
+        if new_names:
+            with db.atomic():
+                Role.insert_many([(name,) for name in new_names], fields=[Role.name]).execute()
 
-        return roles_obj_array
+        return len(new_names)
 
 
 class User(BaseModel):
@@ -114,7 +314,8 @@ class User(BaseModel):
     first_name = CharField(null=True)
     last_name = CharField(null=True)
     role_id = ForeignKeyField(Role, backref="role_id")
-    telegram_id = IntegerField(null=False)
+    telegram_id = IntegerField(null=False, index=True)
+    lot_id = ForeignKeyField(ParkingLot, backref='users')
 
     class Meta:
         table_name = 'users'
@@ -125,82 +326,186 @@ class User(BaseModel):
     def __str__(self):
         return f"User: {self.id} {self.username} {self.last_name} {self.first_name}"
 
+    def get_role_name(self) -> str:
+        """ Имя роли пользователя. Для пользователей из кэша роль уже подгружена, запроса в БД нет """
+        return self.role_id.name
+
+    def get_lot(self) -> ParkingLot:
+        """ Парковка пользователя. Для пользователей из кэша она уже подгружена, запроса в БД нет """
+        return self.lot_id
+
     @staticmethod
-    def load_users(users: list[dict]) -> list:
-        """ Функция загрузки пользователей из конфига """
-        users_list_obj = []
-        roles = Role.select()
+    def reload_cache() -> None:
+        """ Перечитывает всех пользователей вместе с ролями и парковками одним запросом и подменяет кэш целиком """
+        global users_cache, is_users_cache_loaded
 
-        for user_data in users:
-            for role in roles:
-                if user_data["role"] == role.name:
-                    user_obj = User.create(
-                        username=user_data["username"],
-                        first_name=user_data["first_name"],
-                        last_name=user_data["last_name"],
-                        role_id=role.id,
-                        telegram_id=user_data["telegram_id"]
-                    )
-                    users_list_obj.append(user_obj)
-                    user_obj.save()
+        new_cache = {}
+        for user in User.select(User, Role, ParkingLot).join(Role).switch(User).join(ParkingLot):
+            new_cache[user.telegram_id] = user
 
-        return users_list_obj
+        users_cache = new_cache
+        is_users_cache_loaded = True
 
     @staticmethod
-    def add_user(username: str, first_name: str, last_name: str, role_id: int):
-        if username is not None:
-            User.create(
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                role_id=Role.select().where(Role.id == role_id)
-            )
+    def load_users(users: list[dict], remove_missing: bool = False) -> tuple[int, int, int]:
+        """
+        Приводит пользователей в БД к списку из конфига, сопоставляя их по telegram_id.
+        Можно вызывать при каждом запуске: новые добавляются, у существующих обновляются имя, роль и парковка
+        (id парковки - в поле lot_id).
+        Пользователи, которых нет в списке, удаляются только при remove_missing
+        (иначе пропали бы добавленные через бота).
+        Возвращает количество добавленных, обновлённых и удалённых пользователей
+        """
+        role_ids = {role.name: role.id for role in Role.select()}
+        existing_users = {
+            telegram_id: (user_id, username, first_name, last_name, role_id, lot_id)
+            for user_id, telegram_id, username, first_name, last_name, role_id, lot_id in User.select(
+                User.id, User.telegram_id, User.username, User.first_name, User.last_name, User.role_id, User.lot_id
+            ).tuples()
+        }
+
+        new_rows = []
+        changed_rows = []
+        imported_ids = set()
+        for user_data in users:
+            role_id = role_ids.get(user_data["role"])
+            if role_id is None:
+                print(f"Пропускаю пользователя {user_data['telegram_id']}: неизвестная роль {user_data['role']}")
+                continue
+            lot_id = user_data.get("lot_id")
+            if lot_id is None:
+                print(f"Пропускаю пользователя {user_data['telegram_id']}: неизвестная парковка {user_data.get('lot')}")
+                continue
+
+            telegram_id = int(user_data["telegram_id"])
+            if telegram_id in imported_ids:
+                continue
+            imported_ids.add(telegram_id)
+
+            fields = (user_data["username"], user_data["first_name"], user_data["last_name"], role_id, lot_id)
+            existing = existing_users.get(telegram_id)
+            if existing is None:
+                new_rows.append(fields + (telegram_id,))
+            elif existing[1:] != fields:
+                changed_rows.append((existing[0],) + fields)
+
+        removed_ids = []
+        if remove_missing:
+            removed_ids = [
+                existing[0] for telegram_id, existing in existing_users.items() if telegram_id not in imported_ids
+            ]
+
+        for chunk in chunked(new_rows, IMPORT_CHUNK_SIZE):
+            with db.atomic():
+                User.insert_many(chunk, fields=[
+                    User.username, User.first_name, User.last_name, User.role_id, User.lot_id, User.telegram_id
+                ]).execute()
+        for chunk in chunked(changed_rows, IMPORT_CHUNK_SIZE):
+            with db.atomic():
+                User.bulk_update(
+                    [User(id=user_id, username=username, first_name=first_name, last_name=last_name,
+                          role_id=role_id, lot_id=lot_id)
+                     for user_id, username, first_name, last_name, role_id, lot_id in chunk],
+                    fields=[User.username, User.first_name, User.last_name, User.role_id, User.lot_id]
+                )
+        for chunk in chunked(removed_ids, IMPORT_CHUNK_SIZE):
+            with db.atomic():
+                User.delete().where(User.id.in_(chunk)).execute()
+
+        User.reload_cache()
+        return len(new_rows), len(changed_rows), len(removed_ids)
 
     @staticmethod
-    def get_all_users() -> Optional[list[str]]:
-        users_obj: peewee.ModelSelect = User.select()
+    def create_from_guest(guest_id: int, role_name: str, lot_id: int) -> User:
+        """ Переводит гостя в пользователи парковки lot_id с указанной ролью """
+        guest = Guest.get_by_id(guest_id)
+
+        new_user = User.create(
+            username=guest.username,
+            first_name=guest.first_name,
+            last_name=guest.last_name,
+            role_id=Role.select().where(Role.name == role_name),
+            telegram_id=guest.telegram_id,
+            lot_id=lot_id
+        )
+        guest.delete_guest()
+
+        User.reload_cache()
+        return new_user
+
+    @staticmethod
+    def get_all_users(lot_id: int) -> Optional[list[str]]:
+        users_obj: peewee.ModelSelect = User.select().where(User.lot_id == lot_id)
         users_str = []
         for user in users_obj:
             users_str.append(str(user))
         return users_str
 
     @staticmethod
-    def delete_user_by_id(user_id: int) -> bool:
+    def delete_user_by_id(user_id: int, lot_id: int) -> bool:
+        """ Удаляет пользователя, только если он с парковки lot_id """
         is_success = True
 
         try:
-            user = User.get(User.id == user_id)
+            user = User.get(User.id == user_id, User.lot_id == lot_id)
             user.delete_instance()
         except Exception:
             is_success = False
 
+        User.reload_cache()
         return is_success
 
     @staticmethod
     def get_user_by_id(the_user_id_i_want: int) -> Optional[User]:
-        """ Функция, возвращающая нужного пользователя по его telegram id из БД """
-        query: peewee.ModelSelect = User.select().where(User.telegram_id == the_user_id_i_want)
+        """ Функция, возвращающая нужного пользователя по его telegram id из кэша """
+        if not is_users_cache_loaded:
+            User.reload_cache()
 
-        if len(query) == 0:
-            return None
-        else:
-            return query[0]
+        return users_cache.get(the_user_id_i_want)
+
+    @staticmethod
+    def get_cached_users() -> list[User]:
+        """ Все пользователи из кэша, без обращения к БД """
+        if not is_users_cache_loaded:
+            User.reload_cache()
+
+        return list(users_cache.values())
 
     @staticmethod
     def get_user_role(user_telegram_id) -> Optional[str]:
         user = User.get_user_by_id(user_telegram_id)
         if user is None:
             return None
-        return user.role_id.name
+        return user.get_role_name()
+
+
+class BookingResult(Enum):
+    """ Результат попытки бронирования """
+    BOOKED = "booked"  # <- Место забронировано
+    SPOT_TAKEN = "spot_taken"  # <- Место уже занято кем-то другим
+    ALREADY_BOOKED = "already_booked"  # <- У пользователя уже есть бронь на эту дату
+    CLOSED = "closed"  # <- Дата ещё не открыта: места на неё распределяются по заявкам
 
 
 class Reservation(BaseModel):
-    booking_date = DateField()
+    """ AUTOINCREMENT: номер отменённой брони не достаётся новой, поэтому старая кнопка «Отменить» её не найдёт """
+    id = AutoIncrementField()
+    booking_date = DateField(index=True)
     user_id = ForeignKeyField(User, backref="username_id")
     parking_spot_id = ForeignKeyField(ParkingSpot, backref='parking_spot_id')
+    """ Парковка места - копия ParkingSpot.lot_id, чтобы выборки по парковке и дате шли по одному индексу """
+    lot_id = ForeignKeyField(ParkingLot, backref='reservations', index=False)
 
     class Meta:
         table_name = 'reservations'
+        indexes = (
+            # Одно место на дату может быть занято только один раз
+            (('parking_spot_id', 'booking_date'), True),
+            # У пользователя не больше одной брони на дату
+            (('user_id', 'booking_date'), True),
+            # Свободные места и отчёты по парковке за дату или период
+            (('lot_id', 'booking_date', 'parking_spot_id'), False),
+        )
 
     def __repr__(self):
         return self.booking_date
@@ -210,15 +515,291 @@ class Reservation(BaseModel):
 
     def create_reservation(spot_id: int, date: str, user: User) -> None:
         """ Создание новой записи в БД о бронировании парковочного места """
-        new_reservation = Reservation.create(parking_spot_id=spot_id, booking_date=date, user_id=user.id)
+        new_reservation = Reservation.create(
+            parking_spot_id=spot_id, booking_date=date, user_id=user.id, lot_id=user.lot_id_id
+        )
         new_reservation.save()
 
+    @staticmethod
+    def book_spot(spot_id: int, booking_date: date, user: User) -> BookingResult:
+        """
+        Атомарное бронирование одним INSERT.
+        Занятость места и наличие брони у пользователя проверяют уникальные индексы,
+        поэтому два одновременных запроса не смогут занять одно и то же место.
+        Место должно быть с парковки пользователя - это проверяет вызывающий код
+        """
+        try:
+            Reservation.insert(
+                parking_spot_id=spot_id,
+                booking_date=booking_date,
+                user_id=user.id,
+                lot_id=user.lot_id_id
+            ).execute()
+        except IntegrityError as error:
+            if "user_id" in str(error):
+                return BookingResult.ALREADY_BOOKED
+            return BookingResult.SPOT_TAKEN
+
+        return BookingResult.BOOKED
+
+    @staticmethod
+    def book_days(user: User, dates: list[date],
+                  last_open_date: date = date.max) -> dict[date, tuple[BookingResult, Optional[ParkingSpot]]]:
+        """
+        Бронирует по одному свободному месту парковки пользователя на каждую из дат в одной транзакции.
+        Свободные места на все даты читаются одним проходом.
+        SPOT_TAKEN в результате означает, что на дату не осталось мест,
+        CLOSED - что дата позже last_open_date и места на неё ещё будут распределяться по заявкам
+        """
+        results = {booking_date: (BookingResult.CLOSED, None) for booking_date in dates if booking_date > last_open_date}
+        dates = [booking_date for booking_date in dates if booking_date <= last_open_date]
+
+        with db.atomic():
+            available_spots_by_date = ParkingSpot.get_booking_options_for_period(user.lot_id_id, dates)
+
+            for booking_date in dates:
+                results[booking_date] = (BookingResult.SPOT_TAKEN, None)
+
+                for spot in available_spots_by_date[booking_date]:
+                    with db.atomic():
+                        booking_result = Reservation.book_spot(spot.id, booking_date, user)
+
+                    if booking_result == BookingResult.BOOKED:
+                        results[booking_date] = (booking_result, spot)
+                        break
+                    if booking_result == BookingResult.ALREADY_BOOKED:
+                        results[booking_date] = (booking_result, None)
+                        break
+
+        return results
+
+    @staticmethod
+    def get_period_occupancy(user: User, dates: list[date]) -> dict[date, tuple[int, bool]]:
+        """
+        Для каждой даты: сколько мест парковки пользователя свободно и есть ли у него бронь.
+        Брони за весь период считаются одним агрегирующим запросом
+        """
+        if not dates:
+            return {}
+
+        lot_id = user.lot_id_id
+        spots_count = ParkingSpot.select().where(ParkingSpot.lot_id == lot_id, ParkingSpot.is_active).count()
+        occupancy = {one_date: (spots_count, False) for one_date in dates}
+
+        booked_by_date = Reservation.select(
+            Reservation.booking_date,
+            fn.SUM(Case(None, [(ParkingSpot.is_active, 1)], 0)),
+            fn.SUM(Case(None, [(Reservation.user_id == user.id, 1)], 0))
+        ).join(ParkingSpot).where(
+            Reservation.lot_id == lot_id,
+            Reservation.booking_date.between(min(dates), max(dates))
+        ).group_by(Reservation.booking_date).tuples()
+
+        for booking_date, booked_count, user_booked_count in booked_by_date:
+            if booking_date in occupancy:
+                occupancy[booking_date] = (max(spots_count - booked_count, 0), user_booked_count > 0)
+
+        return occupancy
+
+    @staticmethod
+    def get_user_reservation(user: User, booking_date: date) -> Optional[Reservation]:
+        """ Бронь пользователя на дату вместе с парковочным местом (одним запросом) """
+        return Reservation.select(Reservation, ParkingSpot).join(ParkingSpot).where(
+            Reservation.user_id == user.id,
+            Reservation.booking_date == booking_date
+        ).first()
+
+    @staticmethod
+    def get_booked_user_ids(lot_id: int, booking_date: date) -> set[int]:
+        """ id пользователей, у которых есть бронь на парковке на дату """
+        return set(Reservation.select(Reservation.user_id).where(
+            Reservation.lot_id == lot_id,
+            Reservation.booking_date == booking_date
+        ).scalars())
+
+    @staticmethod
+    def get_report_rows(lot_id: int, since: date, until: date = date.max) -> Iterator[tuple]:
+        """
+        Брони парковки с даты since по until включительно вместе с местом и пользователем одним запросом.
+        Строки отдаются потоком, без кэширования всей выборки.
+        Для удалённых пользователей поля пользователя равны None (LEFT JOIN).
+        Сначала идут брони из архива: все они старше броней в основной таблице
+        """
+        live_rows = Reservation.select(
+            Reservation.booking_date,
+            ParkingSpot.name,
+            User.id,
+            User.username,
+            User.first_name,
+            User.last_name
+        ).join(ParkingSpot).switch(Reservation).join(User, JOIN.LEFT_OUTER).where(
+            Reservation.lot_id == lot_id,
+            Reservation.booking_date.between(since, until)
+        ).order_by(Reservation.booking_date, ParkingSpot.id).tuples()
+
+        return itertools.chain(
+            ArchivedReservation.get_report_rows(lot_id, since, until).iterator(),
+            live_rows.iterator()
+        )
+
+    @staticmethod
+    def archive_before(cutoff_date: date, batch_size: int) -> int:
+        """
+        Переносит в архив до batch_size броней с датой раньше cutoff_date одной транзакцией.
+        Возвращает количество перенесённых броней (0 - переносить больше нечего)
+        """
+        with db.atomic():
+            batch = list(Reservation.select(
+                Reservation.id,
+                Reservation.booking_date,
+                Reservation.parking_spot_id,
+                ParkingSpot.name,
+                Reservation.user_id,
+                Reservation.lot_id
+            ).join(ParkingSpot, JOIN.LEFT_OUTER).where(
+                Reservation.booking_date < cutoff_date
+            ).order_by(Reservation.booking_date).limit(batch_size).tuples())
+
+            if len(batch) == 0:
+                return 0
+
+            archived_at = datetime.now()
+            ArchivedReservation.insert_many(
+                [(reservation_id, booking_date, spot_id, spot_name, user_id, lot_id, archived_at)
+                 for reservation_id, booking_date, spot_id, spot_name, user_id, lot_id in batch],
+                fields=[
+                    ArchivedReservation.id,
+                    ArchivedReservation.booking_date,
+                    ArchivedReservation.parking_spot_id,
+                    ArchivedReservation.parking_spot_name,
+                    ArchivedReservation.user_id,
+                    ArchivedReservation.lot_id,
+                    ArchivedReservation.archived_at
+                ]
+            ).on_conflict_ignore().execute()
+
+            Reservation.delete().where(Reservation.id.in_([row[0] for row in batch])).execute()
+
+        return len(batch)
+
+    @staticmethod
+    def cancel_and_reassign(reservation_id: int, user: User) -> tuple[Optional[Reservation], Optional[User]]:
+        """
+        Отменяет бронь пользователя user и в той же транзакции отдаёт место первому в очереди на эту дату
+        на той же парковке, поэтому освободившееся место никто не успеет перехватить.
+        Возвращает отменённую бронь (вместе с местом) и нового владельца места (None, если очередь пуста).
+        Чужая или уже отменённая бронь не трогается: тогда возвращается (None, None)
+        """
+        with db.atomic():
+            reservation = Reservation.select(Reservation, ParkingSpot).join(ParkingSpot).where(
+                Reservation.id == reservation_id,
+                Reservation.user_id == user.id,
+                Reservation.lot_id == user.lot_id_id
+            ).first()
+            if reservation is None:
+                return None, None
+            """ Бронь могли отменить между чтением и удалением - тогда место уже не наше, и отдавать его нельзя """
+            deleted_count = Reservation.delete().where(
+                Reservation.id == reservation.id,
+                Reservation.user_id == user.id
+            ).execute()
+            if deleted_count == 0:
+                return None, None
+
+            while True:
+                entry = WaitlistEntry.get_first(reservation.lot_id_id, reservation.booking_date)
+                if entry is None:
+                    return reservation, None
+                entry.delete_instance()
+
+                waiting_user = User.get_or_none(User.id == entry.user_id_id)
+                if waiting_user is None:
+                    continue
+
+                with db.atomic():
+                    booking_result = Reservation.book_spot(
+                        reservation.parking_spot_id_id, reservation.booking_date, waiting_user
+                    )
+                """ Если ожидающий уже успел забронировать другое место, отдаём следующему """
+                if booking_result == BookingResult.BOOKED:
+                    return reservation, waiting_user
+
+
+class ArchivedReservation(BaseModel):
+    """
+    Старые брони, перенесённые из reservations, чтобы основная таблица не росла.
+    Имя места копируется, а пользователь хранится только по id: данные удалённых пользователей в отчёт не попадают
+    """
+    booking_date = DateField(index=True)
+    parking_spot_id = IntegerField(null=True)
+    parking_spot_name = CharField(null=True)
+    user_id = IntegerField(null=True)
+    lot_id = IntegerField(null=True)
+    archived_at = DateTimeField()
+
+    class Meta:
+        table_name = 'reservations_archive'
+        indexes = (
+            (('lot_id', 'booking_date'), False),
+        )
+
+    @staticmethod
+    def get_report_rows(lot_id: int, since: date, until: date = date.max):
+        """ Строки отчёта из архива в том же формате, что и Reservation.get_report_rows """
+        return ArchivedReservation.select(
+            ArchivedReservation.booking_date,
+            ArchivedReservation.parking_spot_name,
+            User.id,
+            User.username,
+            User.first_name,
+            User.last_name
+        ).join(User, JOIN.LEFT_OUTER, on=(ArchivedReservation.user_id == User.id)).where(
+            ArchivedReservation.lot_id == lot_id,
+            ArchivedReservation.booking_date.between(since, until)
+        ).order_by(ArchivedReservation.booking_date, ArchivedReservation.parking_spot_id).tuples()
+
+
+class DailyOccupancy(BaseModel):
+    """
+    Итоги прошедшего дня по парковке: сколько мест было активно и сколько из них занято.
+    Строка есть на каждый свёрнутый день, даже без броней: по последней дате видно, докуда дошла свёртка
+    """
+    lot_id = IntegerField()
+    booking_date = DateField()
+    spots_count = IntegerField()
+    booked_count = IntegerField()
+
+    class Meta:
+        table_name = 'occupancy_daily'
+        indexes = (
+            (('lot_id', 'booking_date'), True),
+        )
+
+
+class MonthlyUsage(BaseModel):
+    """
+    Сколько дней за месяц пользователь занимал место на парковке.
+    Из этих строк складывается загрузка и по местам, и по пользователям, а строк в разы меньше, чем броней
+    """
+    lot_id = IntegerField()
+    month = DateField()  # <- Первое число месяца
+    parking_spot_id = IntegerField()
+    user_id = IntegerField()
+    booked_days = IntegerField()
+
+    class Meta:
+        table_name = 'usage_monthly'
+        indexes = (
+            (('lot_id', 'month', 'parking_spot_id', 'user_id'), True),
+        )
+
 
 class Guest(BaseModel):
     username = CharField(null=True)
     first_name = CharField(null=True)
     last_name = CharField(null=True)
-    telegram_id = IntegerField(null=False)
+    telegram_id = IntegerField(null=False, unique=True)
+    last_seen_at = DateTimeField(default=datetime.now, index=True)
 
     class Meta:
         table_name = 'guests'
@@ -229,6 +810,35 @@ class Guest(BaseModel):
     def __str__(self):
         return " ".join([str(self.username), str(self.first_name), str(self.last_name)])
 
+    @staticmethod
+    def register_guest(username: str, first_name: str, last_name: str, telegram_id: int,
+                       max_guests: Optional[int] = None) -> None:
+        """
+        Запоминает неизвестного пользователя одним upsert по telegram_id: повторное обращение обновляет имя и время.
+        Если гостей больше max_guests, удаляются те, кто обращался давнее всех
+        """
+        fields = {
+            Guest.username: username,
+            Guest.first_name: first_name,
+            Guest.last_name: last_name,
+            Guest.last_seen_at: datetime.now()
+        }
+        with db.atomic():
+            Guest.insert({Guest.telegram_id: telegram_id, **fields}).on_conflict(
+                conflict_target=[Guest.telegram_id],
+                update=fields
+            ).execute()
+
+            if max_guests is not None:
+                recent_guests = Guest.select(Guest.id).order_by(Guest.last_seen_at.desc()).limit(max_guests)
+                Guest.delete().where(Guest.id.not_in(recent_guests)).execute()
+
+    @staticmethod
+    def get_guests_page(page: int, page_size: int) -> tuple[list[Guest], int]:
+        """ Страница гостей (сначала обращавшиеся последними) и общее количество гостей """
+        guests = list(Guest.select().order_by(Guest.last_seen_at.desc(), Guest.id.desc()).paginate(page + 1, page_size))
+        return guests, Guest.select().count()
+
     def delete_guest(self) -> bool:
         is_success = True
 
@@ -239,3 +849,130 @@ class Guest(BaseModel):
             is_success = False
 
         return is_success
+
+
+class WaitlistEntry(BaseModel):
+    """
+    Очередь на дату, когда все места заняты. Место отдаётся по порядку постановки в очередь.
+    У каждой парковки своя очередь: парковка записи - парковка пользователя
+    """
+    user_id = ForeignKeyField(User, backref='waitlist_entries')
+    booking_date = DateField()
+    created_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        table_name = 'waitlist'
+        indexes = (
+            # В очереди на дату пользователь стоит только один раз
+            (('booking_date', 'user_id'), True),
+        )
+
+    @staticmethod
+    def add_user(user: User, booking_date: date) -> Optional[int]:
+        """ Ставит пользователя в очередь на дату. Возвращает место в очереди или None, если бронь уже есть """
+        with db.atomic():
+            if Reservation.get_user_reservation(user, booking_date) is not None:
+                return None
+
+            WaitlistEntry.insert(user_id=user.id, booking_date=booking_date).on_conflict_ignore().execute()
+            entry = WaitlistEntry.get(WaitlistEntry.user_id == user.id, WaitlistEntry.booking_date == booking_date)
+            return WaitlistEntry.select().join(User).where(
+                WaitlistEntry.booking_date == booking_date,
+                WaitlistEntry.id <= entry.id,
+                User.lot_id == user.lot_id_id
+            ).count()
+
+    @staticmethod
+    def get_first(lot_id: int, booking_date: date) -> Optional[WaitlistEntry]:
+        return WaitlistEntry.select().join(User).where(
+            WaitlistEntry.booking_date == booking_date,
+            User.lot_id == lot_id
+        ).order_by(WaitlistEntry.id).first()
+
+    @staticmethod
+    def delete_expired(lot_id: int, today: date) -> int:
+        """ Удаляет очереди парковки на прошедшие даты """
+        return WaitlistEntry.delete().where(
+            WaitlistEntry.booking_date < today,
+            WaitlistEntry.user_id.in_(User.select(User.id).where(User.lot_id == lot_id))
+        ).execute()
+
+
+class AllocationRequest(BaseModel):
+    """
+    Заявка на место в распределении. Заявки на дату собираются до дедлайна парковки,
+    а в дедлайн места по ним раздаются одним пакетом (allocation.py)
+    """
+    user_id = ForeignKeyField(User, backref='allocation_requests')
+    lot_id = ForeignKeyField(ParkingLot, backref='allocation_requests', index=False)
+    booking_date = DateField()
+    created_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        table_name = 'allocation_requests'
+        indexes = (
+            # На дату от пользователя одна заявка
+            (('lot_id', 'booking_date', 'user_id'), True),
+        )
+
+    @staticmethod
+    def add_user(user: User, booking_date: date) -> Optional[int]:
+        """ Принимает заявку пользователя на дату. Возвращает количество заявок на дату или None, если бронь уже есть """
+        with db.atomic():
+            if Reservation.get_user_reservation(user, booking_date) is not None:
+                return None
+
+            AllocationRequest.insert(
+                user_id=user.id, lot_id=user.lot_id_id, booking_date=booking_date
+            ).on_conflict_ignore().execute()
+            return AllocationRequest.select().where(
+                AllocationRequest.lot_id == user.lot_id_id,
+                AllocationRequest.booking_date == booking_date
+            ).count()
+
+
+class FSMRecord(BaseModel):
+    """ Состояние диалога (FSM) пользователя, сохранённое в БД, чтобы переживать перезапуски бота """
+    key = CharField(primary_key=True)
+    state = CharField(null=True)
+    data = TextField(default="{}")
+    updated_at = FloatField(index=True)  # <- Время последнего изменения (unix time)
+
+    class Meta:
+        table_name = 'fsm_states'
+
+
+def read_config_users(settings: Settings) -> list[dict]:
+    """
+    Пользователи из USERS и из CSV с колонками username,first_name,last_name,role,telegram_id
+    и необязательной lot (по умолчанию - первая парковка)
+    """
+    users = list(settings.users)
+    users_csv = settings.section('CONFIG_IMPORT').get('USERS_CSV')
+    if users_csv:
+        with open(users_csv, 'r', newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                users.append({
+                    "username": row.get("username") or None,
+                    "first_name": row.get("first_name") or None,
+                    "last_name": row.get("last_name") or None,
+                    "role": row["role"],
+                    "telegram_id": int(row["telegram_id"]),
+                    "lot": row.get("lot") or settings.parking_lots[0].name
+                })
+    return users
+
+
+def import_config(settings: Settings) -> tuple[tuple[int, int, int], tuple[int, int, int]]:
+    """
+    Приводит парковки, места и пользователей в БД к настройкам. Повторный вызов с теми же настройками ничего не меняет.
+    Возвращает (добавлено, включено, выключено) мест и (добавлено, обновлено, удалено) пользователей
+    """
+    lot_ids = ParkingLot.load_lots(settings.parking_lots)
+    users = [{**user, "lot_id": lot_ids.get(user["lot"])} for user in read_config_users(settings)]
+    spots_counts = ParkingSpot.load_spots({lot_ids[lot.name]: lot.parking_spots for lot in settings.parking_lots})
+    users_counts = User.load_users(
+        users,
+        remove_missing=settings.section('CONFIG_IMPORT').get('REMOVE_MISSING_USERS', False)
+    )
+    return spots_counts, users_counts
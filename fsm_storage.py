@@ -0,0 +1,84 @@
+"""
+Хранилище состояний диалогов (FSM) aiogram в БД бота.
+
+Состояния административных сценариев (добавление и удаление пользователей)
+сохраняются в таблице fsm_states и переживают перезапуск бота,
+а несколько процессов бота видят одни и те же состояния: каждое чтение - поиск по первичному ключу в БД.
+Изменение читает запись и пишет новую в одной транзакции. Пустые записи в БД не хранятся:
+очистка существующей записи - один DELETE, очистка несуществующей - без записи в БД.
+Состояния, которые не менялись дольше ttl_seconds, считаются брошенными и удаляются.
+"""
+import json
+import time
+from typing import Any, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+
+from entities import db, FSMRecord, run_in_db
+
+""" Значение по умолчанию для _update: поле не меняется """
+UNCHANGED = object()
+
+
+class SqliteStorage(BaseStorage):
+    def __init__(self, ttl_seconds: Optional[float] = None):
+        self.ttl_seconds = ttl_seconds
+        self.key_builder = DefaultKeyBuilder(with_destiny=True, with_bot_id=True)
+
+    def is_expired(self, record: FSMRecord) -> bool:
+        return self.ttl_seconds is not None and record.updated_at < time.time() - self.ttl_seconds
+
+    def _get_record(self, key: str) -> Optional[FSMRecord]:
+        record = FSMRecord.get_or_none(FSMRecord.key == key)
+        if record is not None and self.is_expired(record):
+            record.delete_instance()
+            return None
+        return record
+
+    def _update(self, key: str, state=UNCHANGED, data=UNCHANGED) -> None:
+        """ Меняет состояние и/или данные. Пустая запись удаляется, а если её и не было - в БД не пишем """
+        with db.atomic():
+            record = self._get_record(key)
+            if state is UNCHANGED:
+                state = None if record is None else record.state
+            if data is UNCHANGED:
+                data = {} if record is None else json.loads(record.data)
+
+            if state is None and not data:
+                if record is not None:
+                    record.delete_instance()
+                return
+
+            updated_at = time.time()
+            FSMRecord.insert(key=key, state=state, data=json.dumps(data), updated_at=updated_at).on_conflict(
+                conflict_target=[FSMRecord.key],
+                update={FSMRecord.state: state, FSMRecord.data: json.dumps(data), FSMRecord.updated_at: updated_at}
+            ).execute()
+
+    def _purge_expired(self) -> int:
+        if self.ttl_seconds is None:
+            return 0
+        return FSMRecord.delete().where(FSMRecord.updated_at < time.time() - self.ttl_seconds).execute()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_name = state.state if isinstance(state, State) else state
+        await run_in_db(self._update, self.key_builder.build(key), state=state_name)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await run_in_db(self._get_record, self.key_builder.build(key))
+        return None if record is None else record.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await run_in_db(self._update, self.key_builder.build(key), data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = await run_in_db(self._get_record, self.key_builder.build(key))
+        return {} if record is None else json.loads(record.data)
+
+    async def purge_expired(self) -> int:
+        """ Удаляет брошенные состояния. Возвращает количество удалённых записей """
+        return await run_in_db(self._purge_expired)
+
+    async def close(self) -> None:
+        pass
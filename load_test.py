@@ -0,0 +1,290 @@
+"""
+Нагрузочный тест: прогон синтетических обновлений Telegram через диспетчер бота.
+
+Запуск (из директории с settings.yml):
+    python3 load_test.py --users 3000 --spots 300 --scenario all
+
+Бот работает с временной БД, а вместо Bot API используется сессия-заглушка,
+которая только запоминает исходящие запросы. Заглушка передаётся в setup_bot, поэтому запросы идут
+через ту же очередь исходящих сообщений и метрики, что и в боевом режиме.
+Лимиты Telegram на частоту отправки в очереди по умолчанию сняты, иначе прогон измерял бы их,
+а не бота; --telegram-limits оставляет лимиты из settings.yml.
+Пользователи ведут себя как живые: дожидаются ответа бота и нажимают кнопки из последнего ответа.
+
+Сценарии:
+    burst   - утренний наплыв: /start, «Забронируй мне место», нажатие на место;
+    reports - аудиторы запрашивают отчёт и список свободных мест;
+    cancel  - отмена брони через кнопку;
+    mixed   - всё вместе.
+
+Для каждого сценария выводится пропускная способность, p50/p95/p99 времени
+обработки обновления и среднее количество запросов к БД на обновление.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from typing import Optional
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+from benchmark import format_latencies
+from callbacks import SEPARATOR, BookSpot, CancelReservation
+from config import get_settings
+from entities import db, init_db, Role, User, ParkingLot, ParkingSpot, Reservation
+from migrations import migrate
+
+import bot
+
+SCENARIOS = ["burst", "reports", "cancel", "mixed"]
+""" Частота отправки, которая в нагрузочном тесте заменяет лимиты Telegram """
+UNLIMITED_RATE = 1e9
+
+
+class RecordingSession(BaseSession):
+    """ Сессия-заглушка вместо Bot API: запоминает запросы и имитирует сетевую задержку """
+
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__()
+        self.api_latency = api_latency
+        self.requests_count = 0
+        self.last_inline_keyboard: dict[int, list[str]] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests_count += 1
+        chat_id = getattr(method, "chat_id", None)
+        reply_markup = getattr(method, "reply_markup", None)
+        inline_keyboard = getattr(reply_markup, "inline_keyboard", None)
+        if chat_id is not None and inline_keyboard:
+            self.last_inline_keyboard[chat_id] = [
+                button.callback_data for row in inline_keyboard for button in row if button.callback_data
+            ]
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.session = RecordingSession(api_latency=args.api_latency_ms / 1000)
+        if not args.telegram_limits:
+            outgoing_settings = get_settings().raw.setdefault('OUTGOING', {})
+            for key in ('GLOBAL_MESSAGES_PER_SECOND', 'CHAT_MESSAGES_PER_SECOND', 'CHAT_BURST'):
+                outgoing_settings[key] = UNLIMITED_RATE
+        bot.setup_bot(session=self.session)
+        self.update_ids = itertools.count(1)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.queries_count = 0
+        self.clients: list[int] = []
+        self.auditors: list[int] = []
+        self.clients_with_booking: list[int] = []
+        self.lot: Optional[ParkingLot] = None
+        db.query_listeners.append(self.count_query)
+
+    def count_query(self, sql: str, duration: float) -> None:
+        self.queries_count += 1
+
+    def prepare_database(self, db_path: str) -> None:
+        """ Создаёт временную БД с пользователями и местами """
+        init_db(db_path)
+        migrate()
+        Role.load_roles(["ADMINISTRATOR", "AUDITOR", "CLIENT"])
+        lot_settings = get_settings().parking_lots[0]
+        self.lot = ParkingLot.get_by_id(ParkingLot.load_lots([lot_settings])[lot_settings.name])
+        auditors_count = max(1, self.args.users // 100)
+        users = []
+        for i in range(self.args.users):
+            role = "AUDITOR" if i < auditors_count else "CLIENT"
+            users.append({
+                "username": f"user{i}",
+                "first_name": f"First{i}",
+                "last_name": f"Last{i}",
+                "role": role,
+                "telegram_id": 100000 + i,
+                "lot_id": self.lot.id
+            })
+            (self.auditors if role == "AUDITOR" else self.clients).append(100000 + i)
+
+        with db.atomic():
+            User.load_users(users)
+            ParkingSpot.load_spots({self.lot.id: [str(100 + i) for i in range(self.args.spots)]})
+        User.reload_cache()
+
+    def book_for_part_of_clients(self, share: float) -> None:
+        """ Заранее бронирует места части клиентов, чтобы было что отменять """
+        booking_date = bot.get_first_booking_date(self.lot)
+        spots = list(ParkingSpot.select().where(ParkingSpot.lot_id == self.lot.id))
+        self.clients_with_booking = random.sample(self.clients, min(int(len(spots) * share), len(self.clients)))
+        with db.atomic():
+            for spot, telegram_id in zip(spots, self.clients_with_booking):
+                Reservation.book_spot(spot.id, booking_date, User.get_user_by_id(telegram_id))
+
+    def message_update(self, telegram_id: int, text: str) -> Update:
+        update_id = next(self.update_ids)
+        return Update.model_validate({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": telegram_id, "type": "private"},
+                "from": {"id": telegram_id, "is_bot": False, "first_name": "Load", "username": f"user{telegram_id}"},
+                "text": text
+            }
+        })
+
+    def callback_update(self, telegram_id: int, data: str) -> Update:
+        update_id = next(self.update_ids)
+        return Update.model_validate({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "chat_instance": str(telegram_id),
+                "data": data,
+                "from": {"id": telegram_id, "is_bot": False, "first_name": "Load"},
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": telegram_id, "type": "private"},
+                    "text": "..."
+                }
+            }
+        })
+
+    async def feed(self, kind: str, update: Update) -> None:
+        started = time.perf_counter()
+        await bot.dp.feed_update(bot.bot, update)
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    @staticmethod
+    async def wait_for_delivery(telegram_id: int) -> None:
+        """ Ждёт, пока очередь исходящих сообщений доставит в чат всё, что хэндлеры туда отправили """
+        while bot.outgoing_queue is not None and telegram_id in bot.outgoing_queue.chat_queues:
+            await asyncio.sleep(0.005)
+
+    async def press_button(self, kind: str, telegram_id: int, opcode: str) -> None:
+        """ Нажимает случайную кнопку с нужным кодом операции из последнего ответа бота """
+        await self.wait_for_delivery(telegram_id)
+        buttons = [data for data in self.session.last_inline_keyboard.pop(telegram_id, []) if data.split(SEPARATOR)[0] == opcode]
+        if buttons:
+            await self.feed(kind, self.callback_update(telegram_id, random.choice(buttons)))
+
+    async def client_books(self, telegram_id: int) -> None:
+        await self.feed("start", self.message_update(telegram_id, "/start"))
+        await self.feed("book", self.message_update(telegram_id, bot.TEXT_BUTTON_1))
+        await self.press_button("book_callback", telegram_id, BookSpot.OPCODE)
+
+    async def auditor_reports(self, telegram_id: int) -> None:
+        await self.feed("report", self.message_update(telegram_id, bot.TEXT_BUTTON_2))
+        await self.feed("free_spots", self.message_update(telegram_id, bot.TEXT_BUTTON_4))
+
+    async def client_cancels(self, telegram_id: int) -> None:
+        await self.feed("cancel", self.message_update(telegram_id, bot.TEXT_BUTTON_3))
+        await self.press_button("cancel_callback", telegram_id, CancelReservation.OPCODE)
+
+    def build_flows(self, scenario: str) -> list:
+        clients = random.sample(self.clients, min(self.args.flows, len(self.clients)))
+        auditors = [random.choice(self.auditors) for _ in range(self.args.flows // 10 or 1)]
+
+        if scenario == "burst":
+            return [self.client_books(telegram_id) for telegram_id in clients]
+        if scenario == "reports":
+            return [self.auditor_reports(telegram_id) for telegram_id in auditors * 10]
+        if scenario == "cancel":
+            return [self.client_cancels(telegram_id) for telegram_id in self.clients_with_booking]
+
+        """ Смешанная нагрузка: половина бронирует, часть владельцев брони отменяет, аудиторы смотрят отчёты """
+        booked = set(self.clients_with_booking)
+        flows = [self.client_books(telegram_id) for telegram_id in clients[:len(clients) // 2] if telegram_id not in booked]
+        flows += [self.client_cancels(telegram_id) for telegram_id in self.clients_with_booking[:len(clients) // 4]]
+        flows += [self.auditor_reports(telegram_id) for telegram_id in auditors]
+        random.shuffle(flows)
+        return flows
+
+    async def run_flows(self, flows: list) -> None:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run_one(flow) -> None:
+            async with semaphore:
+                await flow
+
+        await asyncio.gather(*(run_one(flow) for flow in flows))
+
+    async def run_scenario(self, scenario: str) -> None:
+        Reservation.delete().execute()
+        self.clients_with_booking = []
+        if scenario in ("cancel", "mixed"):
+            self.book_for_part_of_clients(share=0.5)
+
+        """ Брони меняли в обход бота, поэтому индекс свободных мест перечитываем, как при старте """
+        await bot.reload_availability()
+
+        self.latencies.clear()
+        self.session.requests_count = 0
+        self.queries_count = 0
+
+        started = time.perf_counter()
+        await self.run_flows(self.build_flows(scenario))
+        elapsed = time.perf_counter() - started
+        """ Время доставки в замер не входит: её темп задают лимиты Telegram, а не бот """
+        if bot.outgoing_queue is not None:
+            await bot.outgoing_queue.join()
+
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        print(f"\n== {scenario}: {len(all_latencies)} обновлений за {elapsed:.2f} с, "
+              f"{len(all_latencies) / elapsed:.1f} upd/s, "
+              f"{self.queries_count / max(len(all_latencies), 1):.2f} запросов к БД на обновление, "
+              f"{self.session.requests_count} запросов к Bot API")
+        print_latencies("всего", all_latencies)
+        for kind, latencies in sorted(self.latencies.items()):
+            print_latencies(kind, latencies)
+
+
+def print_latencies(title: str, latencies: list[float]) -> None:
+    if not latencies:
+        return
+    print(f"{title:>16}: {len(latencies):6d} шт, {format_latencies(latencies)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест диспетчера бота")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+    parser.add_argument("--users", type=int, default=3000)
+    parser.add_argument("--spots", type=int, default=300)
+    parser.add_argument("--flows", type=int, default=1000, help="Сколько пользователей участвует в сценарии")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Имитация задержки Bot API")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="Оставить в очереди исходящих сообщений лимиты Telegram из settings.yml")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    load_test = LoadTest(args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        load_test.prepare_database(os.path.join(tmp_dir, "load_test.db"))
+        print(f"Пользователей: {args.users}, мест: {args.spots}, дата брони: {bot.get_first_booking_date(load_test.lot)}")
+
+        """ Все сценарии в одном event loop: очередь исходящих сообщений привязывается к нему при первом запуске """
+        async def run_scenarios() -> None:
+            for scenario in SCENARIOS if args.scenario == "all" else [args.scenario]:
+                await load_test.run_scenario(scenario)
+
+        asyncio.run(run_scenarios())
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
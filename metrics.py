@@ -0,0 +1,211 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Собираются:
+    - количество обновлений по типам и количество ошибок при их обработке;
+    - гистограмма времени работы каждого хэндлера;
+    - количество и длительность запросов к БД, медленные запросы пишутся в лог;
+    - время ответа Bot API по методам.
+
+Метрики отдаются локальным HTTP-сервером по адресу /metrics.
+"""
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+from entities import db
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ""
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        """ Для каждого набора меток: счётчики по корзинам, сумма и количество наблюдений """
+        self.values: dict[tuple, tuple[list[int], float, int]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        with self.lock:
+            bucket_counts, total, count = self.values.get(label_values, ([0] * len(self.buckets), 0.0, 0))
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[index] += 1
+            self.values[label_values] = (bucket_counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bucket_label_names = self.label_names + ("le",)
+        with self.lock:
+            for label_values, (bucket_counts, total, count) in sorted(self.values.items()):
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = format_labels(bucket_label_names, label_values + (upper_bound,))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = format_labels(bucket_label_names, label_values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+UPDATES_TOTAL = Counter("anna_updates_total", "Количество обновлений по типам", ("type",))
+UPDATE_ERRORS_TOTAL = Counter("anna_update_errors_total", "Ошибки при обработке обновлений", ("type",))
+HANDLER_SECONDS = Histogram("anna_handler_seconds", "Время работы хэндлеров", ("handler",))
+DB_QUERIES_TOTAL = Counter("anna_db_queries_total", "Количество запросов к БД", ("operation",))
+DB_QUERY_SECONDS = Histogram("anna_db_query_seconds", "Длительность запросов к БД", ("operation",))
+DB_SLOW_QUERIES_TOTAL = Counter("anna_db_slow_queries_total", "Количество медленных запросов к БД")
+BOT_API_SECONDS = Histogram("anna_bot_api_seconds", "Время ответа Bot API", ("method",))
+BOT_API_ERRORS_TOTAL = Counter("anna_bot_api_errors_total", "Ошибки запросов к Bot API", ("method",))
+
+ALL_METRICS = [
+    UPDATES_TOTAL, UPDATE_ERRORS_TOTAL, HANDLER_SECONDS,
+    DB_QUERIES_TOTAL, DB_QUERY_SECONDS, DB_SLOW_QUERIES_TOTAL,
+    BOT_API_SECONDS, BOT_API_ERRORS_TOTAL
+]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class UpdatesMiddleware(BaseMiddleware):
+    """ Считает обновления по типам и ошибки их обработки """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: dict[str, Any]) -> Any:
+        update_type = event.event_type
+        UPDATES_TOTAL.inc(update_type)
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS_TOTAL.inc(update_type)
+            raise
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Замеряет время работы конкретного хэндлера.
+    get_handler_name уточняет имя, если зарегистрированный хэндлер сам передаёт событие дальше
+    (так все нажатия кнопок проходят через один хэндлер). None от него - взять имя зарегистрированного
+    """
+
+    def __init__(self, get_handler_name: Optional[Callable[[TelegramObject, dict[str, Any]], Optional[str]]] = None):
+        self.get_handler_name = get_handler_name
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any]) -> Any:
+        handler_name = self.get_handler_name(event, data) if self.get_handler_name is not None else None
+        if handler_name is None:
+            handler_object = data.get("handler")
+            handler_name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler_name)
+
+
+class BotApiTimingMiddleware(BaseRequestMiddleware):
+    """ Замеряет время запросов к Bot API """
+
+    async def __call__(self, make_request, bot: Bot, method):
+        method_name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            BOT_API_ERRORS_TOTAL.inc(method_name)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, method_name)
+
+
+def create_query_listener(slow_query_seconds: float):
+    def on_query(sql: str, duration: float) -> None:
+        operation = sql.lstrip().split(" ", 1)[0].upper()
+        DB_QUERIES_TOTAL.inc(operation)
+        DB_QUERY_SECONDS.observe(duration, operation)
+        if duration >= slow_query_seconds:
+            DB_SLOW_QUERIES_TOTAL.inc()
+            print(f"Медленный запрос ({duration * 1000:.1f} мс): {sql}")
+
+    return on_query
+
+
+def setup_metrics(dispatcher: Dispatcher, bot: Bot, metrics_settings: dict,
+                  get_callback_handler_name: Optional[Callable[[TelegramObject, dict[str, Any]], Optional[str]]] = None
+                  ) -> None:
+    """
+    Подключает сбор метрик к диспетчеру, боту и БД и запускает HTTP-сервер /metrics.
+    get_callback_handler_name - имя хэндлера, который на самом деле обработает нажатие кнопки
+    """
+    dispatcher.update.outer_middleware(UpdatesMiddleware())
+    dispatcher.message.middleware(HandlerTimingMiddleware())
+    dispatcher.callback_query.middleware(HandlerTimingMiddleware(get_callback_handler_name))
+    bot.session.middleware(BotApiTimingMiddleware())
+    db.query_listeners.append(create_query_listener(metrics_settings.get("SLOW_QUERY_MS", 100) / 1000))
+
+    runner_holder = {}
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def start_metrics_server() -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, metrics_settings.get("HOST", "127.0.0.1"), metrics_settings.get("PORT", 9100)).start()
+        runner_holder["runner"] = runner
+
+    async def stop_metrics_server() -> None:
+        if "runner" in runner_holder:
+            await runner_holder["runner"].cleanup()
+
+    dispatcher.startup.register(start_metrics_server)
+    dispatcher.shutdown.register(stop_metrics_server)
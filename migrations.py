@@ -0,0 +1,342 @@
+"""
+Версионные миграции схемы БД.
+
+Номер применённой версии хранится в таблице schema_version.
+Новая БД создаётся сразу по актуальным моделям и помечается последней версией.
+Существующая БД без таблицы версий считается версией 0 (исходная схема)
+и обновляется на месте последовательным применением миграций.
+
+Проверка, что частые запросы используют индексы:
+    python3 migrations.py --check
+
+Перестроение файла БД (включает auto_vacuum = incremental в БД, созданной до этой настройки;
+бота на время выполнения лучше остановить):
+    python3 migrations.py --vacuum
+"""
+import sys
+from datetime import date, datetime
+
+from entities import *
+
+ALL_MODELS = [
+    ParkingLot, ParkingSpot, Reservation, User, Role, Guest, FSMRecord, ArchivedReservation, WaitlistEntry,
+    DailyOccupancy, MonthlyUsage, AllocationRequest
+]
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField()
+    description = CharField()
+    applied_at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        table_name = 'schema_version'
+
+
+def migration_unique_reservations() -> None:
+    """ Удаляет дубли броней и создаёт уникальные индексы (место, дата) и (пользователь, дата) """
+    db.execute_sql(
+        'DELETE FROM "reservations" WHERE "id" NOT IN '
+        '(SELECT MIN("id") FROM "reservations" GROUP BY "parking_spot_id", "booking_date")'
+    )
+    db.execute_sql(
+        'DELETE FROM "reservations" WHERE "id" NOT IN '
+        '(SELECT MIN("id") FROM "reservations" GROUP BY "user_id", "booking_date")'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "reservation_parking_spot_id_booking_date" '
+        'ON "reservations" ("parking_spot_id", "booking_date")'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "reservation_user_id_booking_date" '
+        'ON "reservations" ("user_id", "booking_date")'
+    )
+
+
+def migration_lookup_indexes() -> None:
+    """ Индексы для поиска пользователей, броней по дате и гостей """
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "user_telegram_id" ON "users" ("telegram_id")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "reservation_booking_date" ON "reservations" ("booking_date")')
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "guest_username_first_name_last_name" '
+        'ON "guests" ("username", "first_name", "last_name")'
+    )
+
+
+def migration_fsm_states() -> None:
+    """ Таблица для хранения состояний диалогов (FSM) """
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "fsm_states" ("key" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"state" VARCHAR(255), "data" TEXT NOT NULL, "updated_at" REAL NOT NULL)'
+    )
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "fsmrecord_updated_at" ON "fsm_states" ("updated_at")')
+
+
+def migration_reservations_archive() -> None:
+    """ Таблица архива старых броней """
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "reservations_archive" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"booking_date" DATE NOT NULL, "parking_spot_id" INTEGER, "parking_spot_name" VARCHAR(255), '
+        '"user_id" INTEGER, "archived_at" DATETIME NOT NULL)'
+    )
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "archivedreservation_booking_date" ON "reservations_archive" ("booking_date")'
+    )
+
+
+def migration_parking_spot_is_active() -> None:
+    """ Признак активности места: места, убранные из конфига, выключаются, а не удаляются """
+    db.execute_sql('ALTER TABLE "parking_spots" ADD COLUMN "is_active" INTEGER NOT NULL DEFAULT 1')
+
+
+def migration_waitlist() -> None:
+    """ Очередь на дату, когда все места заняты """
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "waitlist" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" INTEGER NOT NULL, "booking_date" DATE NOT NULL, "created_at" DATETIME NOT NULL, '
+        'FOREIGN KEY ("user_id") REFERENCES "users" ("id"))'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "waitlistentry_booking_date_user_id" '
+        'ON "waitlist" ("booking_date", "user_id")'
+    )
+
+
+def migration_guests_by_telegram_id() -> None:
+    """ Гости определяются по telegram_id, а не по изменяемым именам; время обращения нужно для вытеснения """
+    db.execute_sql(
+        'DELETE FROM "guests" WHERE "id" NOT IN (SELECT MAX("id") FROM "guests" GROUP BY "telegram_id")'
+    )
+    db.execute_sql('DROP INDEX IF EXISTS "guest_username_first_name_last_name"')
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "guest_telegram_id" ON "guests" ("telegram_id")')
+    db.execute_sql('ALTER TABLE "guests" ADD COLUMN "last_seen_at" DATETIME')
+    db.execute_sql('UPDATE "guests" SET "last_seen_at" = ?', (datetime.now(),))
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "guest_last_seen_at" ON "guests" ("last_seen_at")')
+
+
+def migration_parking_lots() -> None:
+    """
+    Парковки. Все существующие места, пользователи и брони относятся к первой парковке из настроек.
+    lot_id дублируется в бронях, чтобы выборки по парковке и дате шли по одному составному индексу
+    """
+    default_lot = get_settings().parking_lots[0]
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "parking_lots" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, '
+        '"today_deadline_clock_for_clients" INTEGER NOT NULL, "today_deadline_clock_for_auditors" INTEGER NOT NULL)'
+    )
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "parkinglot_name" ON "parking_lots" ("name")')
+    lot_id = db.execute_sql(
+        'INSERT INTO "parking_lots" ("name", "today_deadline_clock_for_clients", "today_deadline_clock_for_auditors") '
+        'VALUES (?, ?, ?)',
+        (default_lot.name, default_lot.today_deadline_clock_for_clients, default_lot.today_deadline_clock_for_auditors)
+    ).lastrowid
+
+    for table in ("parking_spots", "users", "reservations"):
+        db.execute_sql(f'ALTER TABLE "{table}" ADD COLUMN "lot_id" INTEGER REFERENCES "parking_lots" ("id")')
+        db.execute_sql(f'UPDATE "{table}" SET "lot_id" = ?', (lot_id,))
+    """ Архив не ссылается на другие таблицы: парковка хранится только по id, как и пользователь """
+    db.execute_sql('ALTER TABLE "reservations_archive" ADD COLUMN "lot_id" INTEGER')
+    db.execute_sql('UPDATE "reservations_archive" SET "lot_id" = ?', (lot_id,))
+
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "parkingspot_lot_id_name" ON "parking_spots" ("lot_id", "name")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "user_lot_id" ON "users" ("lot_id")')
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "reservation_lot_id_booking_date_parking_spot_id" '
+        'ON "reservations" ("lot_id", "booking_date", "parking_spot_id")'
+    )
+    db.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "archivedreservation_lot_id_booking_date" '
+        'ON "reservations_archive" ("lot_id", "booking_date")'
+    )
+
+
+def migration_occupancy_rollups() -> None:
+    """ Свёрнутые итоги загрузки для аналитики. Заполняются при первой свёртке """
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "occupancy_daily" ("id" INTEGER NOT NULL PRIMARY KEY, "lot_id" INTEGER NOT NULL, '
+        '"booking_date" DATE NOT NULL, "spots_count" INTEGER NOT NULL, "booked_count" INTEGER NOT NULL)'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "dailyoccupancy_lot_id_booking_date" '
+        'ON "occupancy_daily" ("lot_id", "booking_date")'
+    )
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "usage_monthly" ("id" INTEGER NOT NULL PRIMARY KEY, "lot_id" INTEGER NOT NULL, '
+        '"month" DATE NOT NULL, "parking_spot_id" INTEGER NOT NULL, "user_id" INTEGER NOT NULL, '
+        '"booked_days" INTEGER NOT NULL)'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "monthlyusage_lot_id_month_parking_spot_id_user_id" '
+        'ON "usage_monthly" ("lot_id", "month", "parking_spot_id", "user_id")'
+    )
+
+
+def migration_allocation_requests() -> None:
+    """ Заявки на распределение мест в дедлайн """
+    db.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "allocation_requests" ("id" INTEGER NOT NULL PRIMARY KEY, '
+        '"user_id" INTEGER NOT NULL, "lot_id" INTEGER NOT NULL, "booking_date" DATE NOT NULL, '
+        '"created_at" DATETIME NOT NULL, FOREIGN KEY ("user_id") REFERENCES "users" ("id"), '
+        'FOREIGN KEY ("lot_id") REFERENCES "parking_lots" ("id"))'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "allocationrequest_lot_id_booking_date_user_id" '
+        'ON "allocation_requests" ("lot_id", "booking_date", "user_id")'
+    )
+
+
+def migration_reservations_autoincrement() -> None:
+    """
+    Номера броней не переиспользуются (AUTOINCREMENT). SQLite не умеет менять первичный ключ,
+    поэтому таблица пересоздаётся. Счётчик начинается после самого большого номера, в том числе из архива
+    """
+    db.execute_sql(
+        'CREATE TABLE "reservations_new" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, '
+        '"booking_date" DATE NOT NULL, "user_id" INTEGER NOT NULL, "parking_spot_id" INTEGER NOT NULL, '
+        '"lot_id" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "users" ("id"), '
+        'FOREIGN KEY ("parking_spot_id") REFERENCES "parking_spots" ("id"), '
+        'FOREIGN KEY ("lot_id") REFERENCES "parking_lots" ("id"))'
+    )
+    db.execute_sql(
+        'INSERT INTO "reservations_new" ("id", "booking_date", "user_id", "parking_spot_id", "lot_id") '
+        'SELECT "id", "booking_date", "user_id", "parking_spot_id", "lot_id" FROM "reservations"'
+    )
+    db.execute_sql('DROP TABLE "reservations"')
+    db.execute_sql('ALTER TABLE "reservations_new" RENAME TO "reservations"')
+
+    db.execute_sql('DELETE FROM "sqlite_sequence" WHERE "name" = ?', ("reservations",))
+    db.execute_sql(
+        'INSERT INTO "sqlite_sequence" ("name", "seq") SELECT ?, MAX('
+        '(SELECT IFNULL(MAX("id"), 0) FROM "reservations"), (SELECT IFNULL(MAX("id"), 0) FROM "reservations_archive"))',
+        ("reservations",)
+    )
+
+    db.execute_sql('CREATE INDEX "reservation_booking_date" ON "reservations" ("booking_date")')
+    db.execute_sql('CREATE INDEX "reservation_user_id" ON "reservations" ("user_id")')
+    db.execute_sql('CREATE INDEX "reservation_parking_spot_id" ON "reservations" ("parking_spot_id")')
+    db.execute_sql(
+        'CREATE UNIQUE INDEX "reservation_parking_spot_id_booking_date" '
+        'ON "reservations" ("parking_spot_id", "booking_date")'
+    )
+    db.execute_sql(
+        'CREATE UNIQUE INDEX "reservation_user_id_booking_date" ON "reservations" ("user_id", "booking_date")'
+    )
+    db.execute_sql(
+        'CREATE INDEX "reservation_lot_id_booking_date_parking_spot_id" '
+        'ON "reservations" ("lot_id", "booking_date", "parking_spot_id")'
+    )
+
+
+""" Список миграций: (версия, описание, функция). Версии только растут, старые миграции не меняются """
+MIGRATIONS = [
+    (1, "Уникальные индексы броней", migration_unique_reservations),
+    (2, "Индексы для частых запросов", migration_lookup_indexes),
+    (3, "Хранение состояний диалогов", migration_fsm_states),
+    (4, "Архив старых броней", migration_reservations_archive),
+    (5, "Выключение парковочных мест", migration_parking_spot_is_active),
+    (6, "Очередь на занятые даты", migration_waitlist),
+    (7, "Гости по telegram_id", migration_guests_by_telegram_id),
+    (8, "Парковки", migration_parking_lots),
+    (9, "Итоги загрузки для аналитики", migration_occupancy_rollups),
+    (10, "Заявки на распределение мест", migration_allocation_requests),
+    (11, "Номера броней без повторов", migration_reservations_autoincrement),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version() -> Optional[int]:
+    """ Текущая версия схемы или None, если версия ещё не записывалась """
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar()
+
+
+def migrate() -> int:
+    """ Создаёт новую БД или обновляет существующую до последней версии. Возвращает итоговую версию """
+    db.connect(reuse_if_open=True)
+    db.create_tables([SchemaVersion])
+
+    current_version = get_schema_version()
+
+    if current_version is None:
+        if not Reservation.table_exists():
+            """ Новая БД: сразу создаём актуальную схему """
+            with db.atomic():
+                db.create_tables(ALL_MODELS)
+                SchemaVersion.create(version=LATEST_VERSION, description="Новая БД")
+            return LATEST_VERSION
+        current_version = 0
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(f"Применяю миграцию {version}: {description}")
+        with db.atomic():
+            migration()
+            SchemaVersion.create(version=version, description=description)
+        current_version = version
+
+    return current_version
+
+
+def get_query_plan(query) -> list[str]:
+    sql, params = query.sql()
+    return [row[-1] for row in db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_hot_queries() -> list[str]:
+    """ Проверяет через EXPLAIN QUERY PLAN, что частые запросы ищут по нужному индексу """
+    today = date.today()
+    booked_spots = Reservation.select(Reservation.parking_spot_id).where(
+        Reservation.lot_id == 0, Reservation.booking_date == today
+    )
+    hot_queries = [
+        ("Пользователь по telegram_id", "user_telegram_id",
+         User.select().where(User.telegram_id == 0)),
+        ("Бронь пользователя на дату", "reservation_user_id_booking_date",
+         Reservation.select().where(Reservation.user_id == 0, Reservation.booking_date == today)),
+        ("Отчёт по парковке за период", "reservation_lot_id_booking_date_parking_spot_id",
+         Reservation.select().where(Reservation.lot_id == 0, Reservation.booking_date >= today)),
+        ("Отчёт по парковке за период по архиву", "archivedreservation_lot_id_booking_date",
+         ArchivedReservation.select().where(ArchivedReservation.lot_id == 0, ArchivedReservation.booking_date >= today)),
+        ("Места парковки", "parkingspot_lot_id_name",
+         ParkingSpot.select().where(ParkingSpot.lot_id == 0, ParkingSpot.is_active)),
+        ("Свободные места парковки на дату", "reservation_lot_id_booking_date_parking_spot_id",
+         ParkingSpot.select().where(ParkingSpot.lot_id == 0, ParkingSpot.id.not_in(booked_spots))),
+        ("Брони парковки на даты окна", "reservation_lot_id_booking_date_parking_spot_id",
+         Reservation.select(Reservation.booking_date, Reservation.parking_spot_id).where(
+             Reservation.lot_id == 0, Reservation.booking_date.in_([today, today]))),
+        ("Первый в очереди на дату", "waitlistentry_booking_date_user_id",
+         WaitlistEntry.select().where(WaitlistEntry.booking_date == today).order_by(WaitlistEntry.id)),
+        ("Загрузка парковки по дням", "dailyoccupancy_lot_id_booking_date",
+         DailyOccupancy.select().where(DailyOccupancy.lot_id == 0, DailyOccupancy.booking_date >= today)),
+        ("Загрузка парковки по месяцам", "monthlyusage_lot_id_month_parking_spot_id_user_id",
+         MonthlyUsage.select().where(MonthlyUsage.lot_id == 0, MonthlyUsage.month >= today)),
+        ("Заявки на распределение на дату", "allocationrequest_lot_id_booking_date_user_id",
+         AllocationRequest.select().where(AllocationRequest.lot_id == 0, AllocationRequest.booking_date == today)),
+        ("Поиск гостя", "guest_telegram_id",
+         Guest.select().where(Guest.telegram_id == 0)),
+    ]
+
+    errors = []
+    for description, index_name, query in hot_queries:
+        plan = get_query_plan(query)
+        if not any(step.startswith("SEARCH") and f"INDEX {index_name} " in step for step in plan):
+            errors.append(f"{description}: {'; '.join(plan)}")
+    return errors
+
+
+if __name__ == '__main__':
+    init_db()
+    print(f"Версия схемы: {migrate()}")
+
+    if "--vacuum" in sys.argv:
+        db.execute_sql(f"PRAGMA auto_vacuum = {get_settings().section('DATABASE').get('AUTO_VACUUM', 'incremental')}")
+        db.execute_sql('VACUUM')
+        print("БД перестроена")
+
+    if "--check" in sys.argv:
+        errors = check_hot_queries()
+        for error in errors:
+            print(f"Запрос без индекса - {error}")
+        if errors:
+            sys.exit(1)
+        print("Все частые запросы используют индексы")
@@ -0,0 +1,182 @@
+"""
+Очередь исходящих сообщений с учётом ограничений Telegram.
+
+Подключается к сессии бота как middleware запросов к Bot API:
+    - отправка и редактирование сообщений ставятся в очередь чата и доставляются в фоне,
+      поэтому хэндлер не ждёт доставки (результат вызова для них - None);
+    - в каждом чате сообщения уходят по порядку, не чаще лимита на чат, и все вместе - не чаще общего лимита;
+    - при ответе 429 (Too Many Requests) запрос повторяется через указанное Telegram время;
+    - повторное редактирование ещё не отправленного сообщения заменяет предыдущее,
+      а повторный ответ на тот же callback не отправляется;
+    - очередь ограничена: если она заполнена, хэндлер ждёт, пока освободится место.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    AnswerCallbackQuery, EditMessageReplyMarkup, EditMessageText, SendDocument, SendMessage, TelegramMethod)
+
+""" Методы, которые доставляются через очередь чата """
+QUEUED_METHODS = (SendMessage, SendDocument, EditMessageText, EditMessageReplyMarkup)
+""" Методы редактирования: из нескольких ожидающих правок одного сообщения отправляется последняя """
+EDIT_METHODS = (EditMessageText, EditMessageReplyMarkup)
+""" Сколько последних ответов на callback помнить, чтобы не отвечать на один callback дважды """
+ANSWERED_CALLBACKS_LIMIT = 10000
+""" Сколько ведер простаивающих чатов держать, прежде чем выбросить заполненные """
+IDLE_CHAT_BUCKETS_LIMIT = 1000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        """ Забирает токен (можно в долг) и возвращает, сколько секунд нужно подождать перед отправкой """
+        self.refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class QueuedRequest:
+    def __init__(self, make_request, method: TelegramMethod):
+        self.make_request = make_request
+        self.method = method
+
+
+class OutgoingQueue(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_queue_size: int = 1000, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self.chat_queues: dict[Any, deque[QueuedRequest]] = {}
+        self.chat_buckets: dict[Any, TokenBucket] = {}
+        self.pending_edits: dict[tuple, QueuedRequest] = {}
+        self.answered_callbacks: OrderedDict[str, None] = OrderedDict()
+
+        self.free_slots = asyncio.Semaphore(max_queue_size)
+        self.senders: set[asyncio.Task] = set()
+        self.is_idle = asyncio.Event()
+        self.is_idle.set()
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        if isinstance(method, AnswerCallbackQuery):
+            if method.callback_query_id in self.answered_callbacks:
+                return True
+            self.answered_callbacks[method.callback_query_id] = None
+            if len(self.answered_callbacks) > ANSWERED_CALLBACKS_LIMIT:
+                self.answered_callbacks.popitem(last=False)
+
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(method, QUEUED_METHODS) or chat_id is None:
+            return await self.send_with_retry(make_request, bot, method)
+
+        edit_key = self.get_edit_key(method)
+        if edit_key is not None and edit_key in self.pending_edits:
+            """ Правка этого сообщения ещё не отправлена - просто заменяем её на новую """
+            self.pending_edits[edit_key].method = method
+            return None
+
+        await self.free_slots.acquire()
+        request = QueuedRequest(make_request, method)
+        if edit_key is not None:
+            self.pending_edits[edit_key] = request
+
+        chat_queue = self.chat_queues.get(chat_id)
+        if chat_queue is None:
+            chat_queue = self.chat_queues[chat_id] = deque()
+            self.start_sender(bot, chat_id, chat_queue)
+        chat_queue.append(request)
+        return None
+
+    @staticmethod
+    def get_edit_key(method: TelegramMethod) -> Optional[tuple]:
+        if not isinstance(method, EDIT_METHODS):
+            return None
+        return type(method).__name__, method.chat_id, method.message_id
+
+    def start_sender(self, bot: Bot, chat_id, chat_queue: deque) -> None:
+        if len(self.chat_buckets) > IDLE_CHAT_BUCKETS_LIMIT:
+            for idle_chat_id in [one for one, bucket in self.chat_buckets.items()
+                                 if one not in self.chat_queues and bucket.is_full()]:
+                del self.chat_buckets[idle_chat_id]
+
+        self.is_idle.clear()
+        task = asyncio.create_task(self.deliver_chat_queue(bot, chat_id, chat_queue))
+        self.senders.add(task)
+        task.add_done_callback(self.on_sender_done)
+
+    def on_sender_done(self, task: asyncio.Task) -> None:
+        self.senders.discard(task)
+        if not self.senders:
+            self.is_idle.set()
+
+    async def deliver_chat_queue(self, bot: Bot, chat_id, chat_queue: deque) -> None:
+        """ Отправляет сообщения одного чата по порядку, пока очередь чата не опустеет """
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if chat_bucket is None:
+            chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        try:
+            while chat_queue:
+                request = chat_queue[0]
+
+                await asyncio.sleep(chat_bucket.reserve())
+                await asyncio.sleep(self.global_bucket.reserve())
+
+                chat_queue.popleft()
+                edit_key = self.get_edit_key(request.method)
+                if edit_key is not None and self.pending_edits.get(edit_key) is request:
+                    del self.pending_edits[edit_key]
+
+                try:
+                    await self.send_with_retry(request.make_request, bot, request.method)
+                except Exception as error:
+                    print(f"Не удалось отправить {type(request.method).__name__} в чат {chat_id}: {error}")
+                finally:
+                    self.free_slots.release()
+        finally:
+            del self.chat_queues[chat_id]
+            """ Запросы, оставшиеся после отмены задачи, тоже освобождают место в очереди """
+            for request in chat_queue:
+                edit_key = self.get_edit_key(request.method)
+                if edit_key is not None and self.pending_edits.get(edit_key) is request:
+                    del self.pending_edits[edit_key]
+                self.free_slots.release()
+
+    async def send_with_retry(self, make_request, bot: Bot, method: TelegramMethod):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Telegram просит подождать {error.retry_after} с перед {type(method).__name__}")
+                await asyncio.sleep(error.retry_after)
+
+    async def join(self, timeout: Optional[float] = None) -> bool:
+        """ Ждёт доставки всех сообщений из очереди. Возвращает False, если не успели за timeout """
+        try:
+            await asyncio.wait_for(self.is_idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
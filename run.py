@@ -1,42 +1,25 @@
 from entities import *
-import yaml
+from migrations import migrate
+from config import ROLE_NAMES
 import bot
-import os
 
-""" Получаем данные из файла настроек """
-with open('settings.yml', 'r') as file:
-    CONSTANTS = yaml.safe_load(file)
+""" Открываем БД из файла настроек """
+init_db()
+
+""" Создаём новую БД или обновляем схему существующей до последней версии """
+migrate()
+
+"""
+Приводим роли, парковки, места и пользователей в БД к конфигу при каждом запуске.
+Повторный запуск с тем же конфигом ничего не меняет
+"""
+Role.load_roles(list(ROLE_NAMES))
+(spots_added, spots_reactivated, spots_deactivated), (users_added, users_updated, users_removed) = import_config(
+    get_settings()
+)
+print(
+    f"Места: добавлено {spots_added}, включено {spots_reactivated}, выключено {spots_deactivated}. "
+    f"Пользователи: добавлено {users_added}, обновлено {users_updated}, удалено {users_removed}"
+)
 
-parking_spots = CONSTANTS['PARKING_SPOTS']
-db_name = CONSTANTS['DB_NAME']
-
-
-def create_tables() -> None:
-    """ Создание таблиц при создании новой БД """
-    db.connect()
-    db.create_tables([ParkingSpot, Reservation, User, Role, Guest])
-
-
-""" Подгружаем названия ролей """
-administrator_role_name = "ADMINISTRATOR"
-auditor_role_name = "AUDITOR"
-client_role_name = "CLIENT"
-all_roles_names = [
-    administrator_role_name,
-    auditor_role_name,
-    client_role_name
-]
-
-all_users = CONSTANTS["USERS"]
-
-if not os.path.isfile(db_name):
-    create_tables()
-    all_roles_obj = Role.load_roles(all_roles_names)
-    all_users_obj = User.load_users(all_users)
-    all_spots_obj = ParkingSpot.load_spots(parking_spots)
-    data = {
-        "all_roles_obj": all_roles_obj,
-        "all_users_obj": all_users_obj,
-        "all_spots_obj": all_spots_obj
-    }
 bot.run_bot()
@@ -0,0 +1,114 @@
+"""
+Получение обновлений через webhook вместо long polling.
+
+Telegram отправляет обновления POST-запросами на встроенный aiohttp-сервер.
+Подлинность запросов проверяется по секретному токену
+(заголовок X-Telegram-Bot-Api-Secret-Token). Без WEBHOOK.SECRET_TOKEN сервер не запускается:
+иначе обновления мог бы прислать любой, кто узнал адрес.
+
+Для локальной проверки можно отправить на сервер записанные обновления
+(один JSON на строку):
+    python3 webhook.py replay updates.jsonl
+"""
+import argparse
+import asyncio
+import json
+import re
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web, ClientSession
+
+from config import get_settings
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+""" Допустимый секрет по документации Bot API: 1-256 символов A-Z, a-z, 0-9, _ и - """
+SECRET_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+
+def get_secret_token(webhook_settings: dict) -> str:
+    """ Секрет из WEBHOOK.SECRET_TOKEN. Если он не задан или недопустим, бросает ValueError """
+    secret_token = webhook_settings.get("SECRET_TOKEN") or ""
+    if not secret_token:
+        raise ValueError("Для webhook нужен WEBHOOK.SECRET_TOKEN: без него обновления может прислать кто угодно")
+    if not SECRET_TOKEN_PATTERN.fullmatch(secret_token):
+        raise ValueError("WEBHOOK.SECRET_TOKEN может содержать только A-Z, a-z, 0-9, _ и - (до 256 символов)")
+    return secret_token
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """ Обработчик webhook-запросов, который обрабатывает не больше max_concurrent_updates обновлений одновременно """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrent_updates: int, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, **kwargs)
+        self.updates_semaphore = asyncio.Semaphore(max_concurrent_updates)
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        async with self.updates_semaphore:
+            await super()._background_feed_update(bot, update)
+
+
+def create_webhook_app(dispatcher: Dispatcher, bot: Bot, webhook_settings: dict) -> web.Application:
+    """ Создаёт aiohttp-приложение, которое принимает обновления от Telegram. Запросы без секрета отклоняются """
+    app = web.Application()
+
+    request_handler = LimitedRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        max_concurrent_updates=webhook_settings.get("MAX_CONCURRENT_UPDATES", 20),
+        secret_token=get_secret_token(webhook_settings)
+    )
+    request_handler.register(app, path=webhook_settings.get("PATH", "/webhook"))
+    setup_application(app, dispatcher, bot=bot)
+
+    return app
+
+
+def run_webhook(dispatcher: Dispatcher, bot: Bot, webhook_settings: dict) -> None:
+    """ Запускает webhook-сервер. Если указан публичный URL, регистрирует его в Telegram """
+    webhook_url = webhook_settings.get("URL")
+    app = create_webhook_app(dispatcher, bot, webhook_settings)
+
+    async def on_startup() -> None:
+        if webhook_url:
+            await bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}{webhook_settings.get('PATH', '/webhook')}",
+                secret_token=get_secret_token(webhook_settings),
+                max_connections=webhook_settings.get("MAX_CONCURRENT_UPDATES", 20),
+                drop_pending_updates=False
+            )
+
+    dispatcher.startup.register(on_startup)
+    web.run_app(
+        app,
+        host=webhook_settings.get("HOST", "127.0.0.1"),
+        port=webhook_settings.get("PORT", 8080)
+    )
+
+
+async def replay_updates(updates_file: str, url: str, secret_token: str) -> None:
+    """ Отправляет записанные обновления на локальный webhook-сервер """
+    headers = {SECRET_TOKEN_HEADER: secret_token} if secret_token else {}
+
+    async with ClientSession() as session:
+        with open(updates_file, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                async with session.post(url, json=json.loads(line), headers=headers) as response:
+                    print(response.status, await response.text())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Проверка webhook-сервера записанными обновлениями")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("updates_file")
+    args = parser.parse_args()
+
+    WEBHOOK_SETTINGS = get_settings().section("WEBHOOK")
+
+    local_url = (
+        f"http://{WEBHOOK_SETTINGS.get('HOST', '127.0.0.1')}:{WEBHOOK_SETTINGS.get('PORT', 8080)}"
+        f"{WEBHOOK_SETTINGS.get('PATH', '/webhook')}"
+    )
+    asyncio.run(replay_updates(args.updates_file, local_url, WEBHOOK_SETTINGS.get("SECRET_TOKEN")))